@@ -0,0 +1,159 @@
+"""
+Compact memory-mapped training datasets
+
+Usage:
+python compact_dataset.py /data/library_pairs.jsonl.gz /data/library_pairs.textshard
+
+A .textshard directory holds:
+    texts.bin     UTF-8 bytes of all distinct texts, concatenated
+    offsets.npy   int64, offsets[i]:offsets[i+1] are the bytes of text i
+    examples.npy  int64 [num_examples, num_cols], text index of every column of every example
+    meta.json     num_cols, num_examples, num_texts
+
+Reading it needs no JSON parsing and no Python copy of the data: the arrays are memory-mapped and
+only the texts of the current shuffle buffer are decoded, so RAM stays flat however large the file is.
+
+Every reader takes a partition (producer_id, num_producers), so several producer processes can
+read disjoint parts of the same dataset.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+
+SHARD_SUFFIX = ".textshard"
+
+
+def read_examples(filepath, partition=(0, 1)):
+    """Examples of a .jsonl.gz file (list or {"texts": [...]} or reddit {"response", "context"} lines)
+
+    Lines are assigned to producers round-robin; lines of other producers are skipped without being parsed.
+    """
+    producer_id, num_producers = partition
+    with gzip.open(filepath, "rt") as fIn:
+        for line_idx, line in enumerate(fIn):
+            if line_idx % num_producers != producer_id:
+                continue
+            data = json.loads(line)
+            if isinstance(data, dict):
+                if "texts" in data:
+                    data = data["texts"]
+                elif "response" in data and "context" in data:
+                    data = [data["response"], data["context"]]
+                else:
+                    continue
+            yield data
+
+
+def shuffle_buffer(iterable, buffer_size, rng=random):
+    """Streaming shuffle: keep buffer_size items, yield a random one and replace it by the next item"""
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        idx = rng.randrange(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def block_order(num_examples, block_size, partition=(0, 1), rng=random):
+    """Example indices of this partition: blocks of consecutive examples in random order
+
+    Only the block list is materialized (num_examples / block_size ints), not a full permutation.
+    Combine with shuffle_buffer to also mix examples within and across neighbouring blocks.
+    """
+    producer_id, num_producers = partition
+    blocks = list(range(producer_id, -(-num_examples // block_size), num_producers))
+    rng.shuffle(blocks)
+    for block in blocks:
+        yield from range(block * block_size, min(num_examples, (block + 1) * block_size))
+
+
+def write_compact(filepath, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    text_ids = {}
+    offsets = [0]
+    examples = []
+    num_cols = None
+
+    with open(os.path.join(output_dir, "texts.bin"), "wb") as fOut:
+        for data in read_examples(filepath):
+            if num_cols is None:
+                num_cols = len(data)
+            assert len(data) == num_cols
+
+            row = []
+            for text in data:
+                encoded = text.encode("utf-8")
+                key = hashlib.md5(encoded).digest()
+                if key not in text_ids:
+                    text_ids[key] = len(text_ids)
+                    fOut.write(encoded)
+                    offsets.append(offsets[-1] + len(encoded))
+                row.append(text_ids[key])
+            examples.append(row)
+
+    np.save(os.path.join(output_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, "examples.npy"), np.asarray(examples, dtype=np.int64))
+    meta = {"num_cols": num_cols, "num_examples": len(examples), "num_texts": len(text_ids), "num_bytes": offsets[-1]}
+    with open(os.path.join(output_dir, "meta.json"), "w") as fOut:
+        json.dump(meta, fOut, indent=2)
+    return meta
+
+
+class CompactShard:
+    """Read-only, memory-mapped view on a .textshard directory"""
+
+    def __init__(self, shard_dir):
+        with open(os.path.join(shard_dir, "meta.json")) as fIn:
+            self.meta = json.load(fIn)
+        self.data = np.memmap(os.path.join(shard_dir, "texts.bin"), dtype=np.uint8, mode="r")
+        self.offsets = np.load(os.path.join(shard_dir, "offsets.npy"), mmap_mode="r")
+        self.examples = np.load(os.path.join(shard_dir, "examples.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.examples)
+
+    def text(self, text_idx):
+        return self.data[self.offsets[text_idx]:self.offsets[text_idx + 1]].tobytes().decode("utf-8")
+
+    def example(self, idx):
+        return [self.text(int(text_idx)) for text_idx in self.examples[idx]]
+
+
+class CompactDataset:
+    """Endless, shuffled iterator over a .textshard directory. Yields lists of texts like Dataset."""
+
+    def __init__(self, shard_dir, partition=(0, 1), block_size=4096, buffer_size=10000, seed=None):
+        self.shard_dir = shard_dir
+        self.partition = partition
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.rng = random.Random(seed)
+
+    def __iter__(self):
+        shard = CompactShard(self.shard_dir)
+        while True:
+            order = block_order(len(shard), self.block_size, self.partition, self.rng)
+            for idx in shuffle_buffer(order, self.buffer_size, self.rng):
+                yield shard.example(idx)
+
+
+def is_compact_dataset(path):
+    return path.endswith(SHARD_SUFFIX) and os.path.isdir(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help="A .jsonl.gz training file")
+    parser.add_argument('output', help="Output directory, should end with " + SHARD_SUFFIX)
+    args = parser.parse_args()
+
+    print(json.dumps(write_compact(args.input, args.output), indent=2))
@@ -0,0 +1,212 @@
+"""
+Export a trained model to ONNX for CPU inference
+
+Usage:
+python export_onnx.py output/all_datasets_v4_mpnet-base/final output/onnx --benchmark_file queries.txt
+
+Writes to the output folder:
+    model.onnx        fp32 graph: transformer + mean pooling + L2 normalization, returns sentence embeddings
+    model.int8.onnx   the same graph with int8 dynamically quantized weights (MatMul / Gemm)
+    tokenizer files
+
+Then both graphs are compared against eager PyTorch: latency / throughput on CPU and the cosine
+drift of their embeddings. The script exits with code 1 if the drift exceeds --max_drift.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import AutoModel, AutoTokenizer
+
+FP32_FILE = "model.onnx"
+INT8_FILE = "model.int8.onnx"
+
+
+class PooledEncoder(nn.Module):
+    """Transformer + mean pooling + normalization in one module, so that all three land in the ONNX graph"""
+
+    def __init__(self, model_path, normalize=True):
+        super(PooledEncoder, self).__init__()
+        self.model = AutoModel.from_pretrained(model_path)
+        self.normalize = normalize
+
+    def forward(self, input_ids, attention_mask):
+        token_embeddings = self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+        input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+        embeddings = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+        if self.normalize:
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        return embeddings
+
+
+def export(model_path, output_dir, opset=14):
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.save_pretrained(output_dir)
+
+    model = PooledEncoder(model_path).eval()
+    dummy = tokenizer(["export example", "a second, somewhat longer export example"], padding=True, return_tensors="pt")
+    fp32_path = os.path.join(output_dir, FP32_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (dummy["input_ids"], dummy["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["sentence_embedding"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "sentence_embedding": {0: "batch"}
+            },
+            opset_version=opset,
+            do_constant_folding=True
+        )
+    return fp32_path
+
+
+def quantize(fp32_path, int8_path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+class OnnxEncoder:
+    """CPU runner for an exported graph. Texts are sorted by length and batched, so each batch pads little."""
+
+    def __init__(self, model_dir, filename=FP32_FILE, batch_size=32, max_length=128, num_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(os.path.join(model_dir, filename), options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def encode_batch(self, texts):
+        features = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+        inputs = {"input_ids": features["input_ids"].astype(np.int64), "attention_mask": features["attention_mask"].astype(np.int64)}
+        return self.session.run(None, inputs)[0]
+
+    def encode(self, texts):
+        return encode_sorted(self.encode_batch, texts, self.batch_size)
+
+
+class TorchEncoder:
+    """Eager PyTorch baseline with the same batching"""
+
+    def __init__(self, model_path, batch_size=32, max_length=128):
+        self.model = PooledEncoder(model_path).eval()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def encode_batch(self, texts):
+        features = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+        with torch.no_grad():
+            return self.model(features["input_ids"], features["attention_mask"]).numpy()
+
+    def encode(self, texts):
+        return encode_sorted(self.encode_batch, texts, self.batch_size)
+
+
+def encode_sorted(encode_batch, texts, batch_size):
+    order = np.argsort([len(text) for text in texts])
+    embeddings = np.zeros((len(texts), 0), dtype=np.float32)
+    for start in range(0, len(texts), batch_size):
+        batch_idx = order[start:start+batch_size]
+        batch_emb = encode_batch([texts[idx] for idx in batch_idx])
+        if embeddings.shape[1] == 0:
+            embeddings = np.zeros((len(texts), batch_emb.shape[1]), dtype=np.float32)
+        embeddings[batch_idx] = batch_emb
+    return embeddings
+
+
+def benchmark(encoder, texts, batch_size, repeats=3):
+    """Single-text latency (p50 / p95, ms) and batched throughput (texts / sec)"""
+    encoder.encode_batch(texts[:batch_size])    #Warm-up
+
+    latencies = []
+    for text in texts[:200]:
+        start = time.perf_counter()
+        encoder.encode_batch([text])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        encoder.encode(texts)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p95_ms": float(np.percentile(latencies, 95)),
+        "throughput_texts_per_sec": len(texts) * repeats / elapsed
+    }
+
+
+def cosine_drift(reference, embeddings):
+    """1 - cosine similarity between the reference and the compared embedding of every text"""
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    drift = 1 - np.sum(reference * embeddings, axis=1)
+    return {"mean": float(drift.mean()), "max": float(drift.max())}
+
+
+def load_texts(filepath, limit):
+    if filepath is None:
+        return ["sentence embedding example number {}".format(idx) + " with some extra words" * (idx % 8) for idx in range(limit)]
+    with open(filepath, encoding="utf8") as fIn:
+        return [line.strip() for line in fIn if line.strip()][:limit]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--opset', type=int, default=14)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--max_length', type=int, default=128)
+    parser.add_argument('--num_threads', type=int, default=0, help="onnxruntime intra-op threads, 0 = all cores")
+    parser.add_argument('--benchmark_file', default=None, help="Text file with one text per line, default: synthetic texts")
+    parser.add_argument('--num_texts', type=int, default=1000)
+    parser.add_argument('--max_drift', type=float, default=0.01, help="Maximum allowed 1 - cosine similarity of the int8 model vs. PyTorch fp32")
+    parser.add_argument('--skip_benchmark', action='store_true')
+    parser.add_argument('model', help="Folder written by AutoModelForSentenceEmbedding.save_pretrained")
+    parser.add_argument('output')
+    args = parser.parse_args()
+
+    fp32_path = export(args.model, args.output, args.opset)
+    int8_path = quantize(fp32_path, os.path.join(args.output, INT8_FILE))
+    print("exported:", fp32_path, int8_path)
+    if args.skip_benchmark:
+        exit()
+
+    texts = load_texts(args.benchmark_file, args.num_texts)
+    encoders = {
+        "pytorch": TorchEncoder(args.model, args.batch_size, args.max_length),
+        "onnx_fp32": OnnxEncoder(args.output, FP32_FILE, args.batch_size, args.max_length, args.num_threads),
+        "onnx_int8": OnnxEncoder(args.output, INT8_FILE, args.batch_size, args.max_length, args.num_threads)
+    }
+
+    reference = encoders["pytorch"].encode(texts)
+    report = {}
+    for name, encoder in encoders.items():
+        report[name] = benchmark(encoder, texts, args.batch_size)
+        if name != "pytorch":
+            report[name]["cosine_drift"] = cosine_drift(reference, encoder.encode(texts))
+
+    print(json.dumps(report, indent=2))
+    with open(os.path.join(args.output, "benchmark.json"), "w") as fOut:
+        json.dump(report, fOut, indent=2)
+
+    drift = report["onnx_int8"]["cosine_drift"]["max"]
+    if drift > args.max_drift:
+        print("int8 cosine drift {:.4f} exceeds --max_drift {}".format(drift, args.max_drift))
+        exit(1)
+    print("int8 cosine drift {:.4f} within --max_drift {}".format(drift, args.max_drift))
@@ -0,0 +1,185 @@
+"""
+Offline pre-tokenization into memory-mapped token shards
+
+Usage:
+python pretokenize.py --model microsoft/mpnet-base --max_length 128 /data/library_pairs.jsonl.gz /data/library_pairs.tokshard
+
+A shard is a directory with:
+    tokens.bin    all token ids, concatenated (uint16 if the vocab fits, else uint32)
+    offsets.npy   int64, offsets[i]:offsets[i+1] are the tokens of text i
+    examples.npy  int64 [num_examples, num_cols], text index of every column of every example
+    meta.json     dtype, num_cols, model, max_length, pad_token_id
+
+Identical texts are stored once. Point data_config.json at the .tokshard directory instead of
+the .jsonl.gz file and train_script.py reads token ids directly, no tokenization in the training step.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+
+from compact_dataset import block_order, read_examples, shuffle_buffer
+
+SHARD_SUFFIX = ".tokshard"
+
+
+def pretokenize(filepath, output_dir, tokenizer, max_length, batch_size=1000):
+    os.makedirs(output_dir, exist_ok=True)
+    dtype = np.uint16 if len(tokenizer) < 2**16 else np.uint32
+
+    text_ids = {}
+    offsets = [0]
+    examples = []
+    num_cols = None
+    pending = []
+
+    with open(os.path.join(output_dir, "tokens.bin"), "wb") as fOut:
+        def flush():
+            encoded = tokenizer(pending, max_length=max_length, truncation=True)["input_ids"]
+            for ids in encoded:
+                fOut.write(np.asarray(ids, dtype=dtype).tobytes())
+                offsets.append(offsets[-1] + len(ids))
+            pending.clear()
+
+        for data in read_examples(filepath):
+            if num_cols is None:
+                num_cols = len(data)
+            assert len(data) == num_cols
+
+            row = []
+            for text in data:
+                key = hashlib.md5(text.encode("utf-8")).digest()    #16 bytes per distinct text instead of the string
+                if key not in text_ids:
+                    text_ids[key] = len(text_ids)
+                    pending.append(text)
+                    if len(pending) >= batch_size:
+                        flush()
+                row.append(text_ids[key])
+            examples.append(row)
+
+        if pending:
+            flush()
+
+    np.save(os.path.join(output_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, "examples.npy"), np.asarray(examples, dtype=np.int64))
+    meta = {
+        "dtype": np.dtype(dtype).name,
+        "num_cols": num_cols,
+        "num_examples": len(examples),
+        "num_texts": len(text_ids),
+        "num_tokens": offsets[-1],
+        "model": tokenizer.name_or_path,
+        "max_length": max_length,
+        "pad_token_id": tokenizer.pad_token_id
+    }
+    with open(os.path.join(output_dir, "meta.json"), "w") as fOut:
+        json.dump(meta, fOut, indent=2)
+    return meta
+
+
+class TokenShard:
+    """Read-only, memory-mapped view on a shard written by pretokenize()"""
+
+    def __init__(self, shard_dir):
+        with open(os.path.join(shard_dir, "meta.json")) as fIn:
+            self.meta = json.load(fIn)
+        self.tokens = np.memmap(os.path.join(shard_dir, "tokens.bin"), dtype=self.meta["dtype"], mode="r")
+        self.offsets = np.load(os.path.join(shard_dir, "offsets.npy"), mmap_mode="r")
+        self.examples = np.load(os.path.join(shard_dir, "examples.npy"), mmap_mode="r")
+        self.num_cols = self.meta["num_cols"]
+
+    def __len__(self):
+        return len(self.examples)
+
+    def text(self, text_idx):
+        return self.tokens[self.offsets[text_idx]:self.offsets[text_idx + 1]]
+
+    def example(self, idx):
+        return tuple(self.text(int(text_idx)) for text_idx in self.examples[idx])
+
+
+class TokenShardDataset:
+    """Endless, shuffled iterator over a token shard. Yields tuples of token id arrays.
+
+    Same block order + shuffle buffer as compact_dataset.CompactDataset, so no per-epoch permutation
+    of all example indices is kept in memory.
+    """
+
+    def __init__(self, shard_dir, partition=(0, 1), block_size=4096, buffer_size=10000, seed=None):
+        self.shard_dir = shard_dir
+        self.partition = partition
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.rng = random.Random(seed)
+
+    def __iter__(self):
+        shard = TokenShard(self.shard_dir)
+        while True:
+            order = block_order(len(shard), self.block_size, self.partition, self.rng)
+            for idx in shuffle_buffer(order, self.buffer_size, self.rng):
+                yield shard.example(idx)
+
+
+def is_token_shard(path):
+    return path.endswith(SHARD_SUFFIX) and os.path.isdir(path)
+
+
+def check_shard_meta(shard_dir, model, max_length, pad_token_id):
+    """Raise ValueError if the shard was written for another tokenizer, max_length or pad token"""
+    with open(os.path.join(shard_dir, "meta.json")) as fIn:
+        meta = json.load(fIn)
+    expected = {"model": model, "max_length": max_length, "pad_token_id": pad_token_id}
+    mismatched = ["{} {!r} (shard) != {!r} (training)".format(key, meta.get(key), value)
+                  for key, value in expected.items() if meta.get(key) != value]
+    if mismatched:
+        raise ValueError("{} was pre-tokenized with other settings: {}. Re-run pretokenize.py".format(
+            shard_dir, "; ".join(mismatched)))
+
+
+def text_key(text):
+    """Hashable key of a raw text or a token id array, for the in-batch duplicate check"""
+    return text.tobytes() if isinstance(text, np.ndarray) else text
+
+
+def sample_length(sample):
+    """Longest column of an example, in tokens (pre-tokenized) or characters (raw text)"""
+    return max(len(col) for col in sample)
+
+
+def collate(token_lists, pad_token_id, max_length, pad_to_max_length=False, pad_to_multiple_of=8):
+    """Pad a list of token id arrays to the longest one (or max_length). Returns input_ids / attention_mask tensors."""
+    import torch
+
+    longest = max(len(ids) for ids in token_lists)
+    if pad_to_max_length:
+        width = max_length
+    else:
+        width = min(max_length, -(-longest // pad_to_multiple_of) * pad_to_multiple_of)
+
+    input_ids = torch.full((len(token_lists), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_lists), width), dtype=torch.long)
+    for row, ids in enumerate(token_lists):
+        if len(ids) > width:    #Keep the trailing special token ([SEP], </s>) when cutting
+            ids = np.concatenate([ids[:width-1], ids[-1:]])
+        ids = torch.as_tensor(np.asarray(ids, dtype=np.int64))
+        input_ids[row, :len(ids)] = ids
+        attention_mask[row, :len(ids)] = 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='nreimers/MiniLM-L6-H384-uncased')
+    parser.add_argument('--max_length', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=1000, help="Texts per tokenizer call")
+    parser.add_argument('input', help="A .jsonl.gz training file")
+    parser.add_argument('output', help="Output shard directory, should end with " + SHARD_SUFFIX)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    meta = pretokenize(args.input, args.output, tokenizer, args.max_length, args.batch_size)
+    print(json.dumps(meta, indent=2))
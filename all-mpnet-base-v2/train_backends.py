@@ -0,0 +1,148 @@
+"""
+Training backends for train_script.py
+
+Both backends expose the same small interface that train_function uses:
+spawning the worker processes, the device, a differentiable all_gather for in-batch negatives,
+gradient reduction + optimizer step, the RNG state (for gradient caching), and master-only printing / saving.
+
+xla:  TPU via torch_xla (the original path)
+gloo: CPU via torch.distributed with the gloo backend. One process per --nprocs on each node,
+      multiple nodes with --nnodes / --node_rank / --master_addr / --master_port.
+"""
+import os
+
+import torch
+import torch.multiprocessing as mp
+
+
+class XLABackend:
+    name = "xla"
+
+    def __init__(self, args):
+        import torch_xla.core.functions
+        import torch_xla.core.xla_model as xm
+        import torch_xla.distributed.xla_multiprocessing as xmp
+        self.args = args
+        self.xm = xm
+        self.xmp = xmp
+        self.functions = torch_xla.core.functions
+
+    def spawn(self, fn, args):
+        self.xmp.spawn(fn, args=args, nprocs=self.args.nprocs, start_method='fork')
+
+    def setup(self, index):
+        pass
+
+    def device(self):
+        return self.xm.xla_device()
+
+    def is_master(self):
+        return self.xm.is_master_ordinal()
+
+    def world_size(self):
+        return self.xm.xrt_world_size()
+
+    def all_gather(self, tensor):
+        return self.functions.all_gather(tensor)
+
+    def optimizer_step(self, optimizer):
+        self.xm.optimizer_step(optimizer, barrier=True)
+
+    def get_rng_state(self):
+        return self.xm.get_rng_state()
+
+    def set_rng_state(self, state):
+        self.xm.set_rng_state(state)
+
+    def master_print(self, text):
+        self.xm.master_print(text)
+
+    def save(self, state_dict, path):
+        self.xm.save(state_dict, path)
+
+    def cleanup(self):
+        pass
+
+
+class GlooBackend:
+    """torch.distributed + gloo on CPU
+
+    Gradients are averaged over all processes in optimizer_step, the same semantics as
+    xm.optimizer_step, so the loss/clipping code in train_function is shared unchanged.
+    """
+    name = "gloo"
+
+    def __init__(self, args):
+        self.args = args
+        self.rank = 0
+        self._world_size = args.nprocs * args.nnodes
+
+    def spawn(self, fn, args):
+        # fork, like xmp.spawn, so the producer queue is inherited by the workers
+        mp.start_processes(fn, args=args, nprocs=self.args.nprocs, start_method='fork')
+
+    def setup(self, index):
+        import torch.distributed as dist
+
+        self.rank = self.args.node_rank * self.args.nprocs + index
+        os.environ.setdefault("MASTER_ADDR", self.args.master_addr)
+        os.environ.setdefault("MASTER_PORT", str(self.args.master_port))
+        dist.init_process_group("gloo", rank=self.rank, world_size=self._world_size)
+
+        # Split the cores of this node between the local processes
+        threads = self.args.threads_per_proc or max(1, (os.cpu_count() or 1) // self.args.nprocs)
+        torch.set_num_threads(threads)
+
+    def device(self):
+        return torch.device("cpu")
+
+    def is_master(self):
+        return self.rank == 0
+
+    def world_size(self):
+        return self._world_size
+
+    def all_gather(self, tensor):
+        # Differentiable all_gather: gradients flow back to the rank that produced each slice
+        import torch.distributed.nn.functional as dist_fn
+        return torch.cat(dist_fn.all_gather(tensor), dim=0)
+
+    def optimizer_step(self, optimizer):
+        import torch.distributed as dist
+
+        # Average gradients over all processes with one flattened all_reduce per dtype
+        grads = [p.grad for group in optimizer.param_groups for p in group['params'] if p.grad is not None]
+        for dtype in {grad.dtype for grad in grads}:
+            bucket = [grad for grad in grads if grad.dtype == dtype]
+            flat = torch._utils._flatten_dense_tensors(bucket)
+            dist.all_reduce(flat)
+            flat /= self._world_size
+            for grad, reduced in zip(bucket, torch._utils._unflatten_dense_tensors(flat, bucket)):
+                grad.copy_(reduced)
+        optimizer.step()
+
+    def get_rng_state(self):
+        return torch.get_rng_state()
+
+    def set_rng_state(self, state):
+        torch.set_rng_state(state)
+
+    def master_print(self, text):
+        if self.is_master():
+            print(text)
+
+    def save(self, state_dict, path):
+        if self.is_master():
+            torch.save(state_dict, path)
+
+    def cleanup(self):
+        import torch.distributed as dist
+        if dist.is_initialized():
+            dist.destroy_process_group()
+
+
+BACKENDS = {"xla": XLABackend, "gloo": GlooBackend}
+
+
+def get_backend(args):
+    return BACKENDS[args.backend](args)
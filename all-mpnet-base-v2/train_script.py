@@ -1,8 +1,12 @@
 """
 Train script for a single file
 
-Need to set the TPU address first:
+TPU (default backend): need to set the TPU address first:
 export XRT_TPU_CONFIG="localservice;0;localhost:51011"
+
+CPU: --backend gloo runs --nprocs processes per node with torch.distributed (gloo).
+For several nodes, start the script on each node with the same --nnodes / --master_addr
+and its own --node_rank.
 """
 
 import torch.multiprocessing as mp
@@ -11,23 +15,19 @@ import time
 import random
 import sys
 import argparse
-import gzip
 import json
 import logging
 import tqdm
 import torch
 from torch import nn
 from torch.utils.data import DataLoader
-import torch
-import torch_xla
-import torch_xla.core
-import torch_xla.core.functions
-import torch_xla.core.xla_model as xm
-import torch_xla.distributed.xla_multiprocessing as xmp
-import torch_xla.distributed.parallel_loader as pl
 import os
 from shutil import copyfile
 
+from train_backends import get_backend
+from pretokenize import TokenShardDataset, check_shard_meta, collate, is_token_shard, sample_length, text_key
+from compact_dataset import CompactDataset, is_compact_dataset, read_examples, shuffle_buffer
+
 
 from transformers import (
     AdamW,
@@ -58,23 +58,67 @@ class AutoModelForSentenceEmbedding(nn.Module):
         input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
         return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
-    def save_pretrained(self, output_path):
-        if xm.is_master_ordinal():
+    def save_pretrained(self, output_path, backend):
+        if backend.is_master():
             self.tokenizer.save_pretrained(output_path)
             self.model.config.save_pretrained(output_path)
 
-        xm.save(self.model.state_dict(), os.path.join(output_path, "pytorch_model.bin"))
+        backend.save(self.model.state_dict(), os.path.join(output_path, "pytorch_model.bin"))
        
 
 
 
-def train_function(index, args, queue):
+def contrastive_loss(embeddings, scale, cross_entropy_loss):
+    """In-batch negatives loss over the embeddings gathered from all devices
+
+    [anchor, positive]: symmetric loss as in CLIP
+    [anchor, positive, negative]: one-way loss, the negatives are additional candidates
+    """
+    embeddings_a = embeddings[0]
+    embeddings_b = torch.cat(embeddings[1:])
+
+    ### Compute similarity scores 512 x 512 (or 512 x 1024 with negatives)
+    scores = torch.mm(embeddings_a, embeddings_b.transpose(0, 1)) * scale
+
+    ### Compute cross-entropy loss
+    labels = torch.tensor(range(len(scores)), dtype=torch.long, device=embeddings_a.device)  # Example a[i] should match with b[i]
+
+    if len(embeddings) == 2:
+        ## Symmetric loss as in CLIP
+        return (cross_entropy_loss(scores, labels) + cross_entropy_loss(scores.transpose(0, 1), labels)) / 2
+
+    ## One-way loss
+    return cross_entropy_loss(scores, labels)
+
+
+def split_features(features, chunk_size):
+    size = features["input_ids"].size(0)
+    return [{key: value[start:start+chunk_size] for key, value in features.items()} for start in range(0, size, chunk_size)]
+
+
+class RandContext:
+    """RNG state of one chunk forward pass, restored for its re-computation so that dropout masks match"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.state = backend.get_rng_state()
+
+    def __enter__(self):
+        self.outer_state = self.backend.get_rng_state()
+        self.backend.set_rng_state(self.state)
+
+    def __exit__(self, *exc):
+        self.backend.set_rng_state(self.outer_state)
+
+
+def train_function(index, args, queue, backend):
+    backend.setup(index)
     tokenizer = AutoTokenizer.from_pretrained(args.model)
     model = AutoModelForSentenceEmbedding(args.model, tokenizer)
     
   
     ### Train Loop
-    device = xm.xla_device()
+    device = backend.device()
     model = model.to(device)
 
     # Instantiate optimizer
@@ -91,94 +135,127 @@ def train_function(index, args, queue):
     max_grad_norm = 1
 
     model.train()
-   
-    for global_step in tqdm.trange(args.steps, disable=not xm.is_master_ordinal()):
-        #### Get the batch data
-        batch = queue.get()
-        #print(index, "batch {}x{}".format(len(batch), ",".join([str(len(b)) for b in batch])))
-        
 
-        if len(batch[0]) == 2: #(anchor, positive)
-            text1 = tokenizer([b[0] for b in batch], return_tensors="pt", max_length=args.max_length, truncation=True, padding="max_length")
-            text2 = tokenizer([b[1] for b in batch], return_tensors="pt", max_length=args.max_length, truncation=True, padding="max_length")
+    # XLA recompiles for every new input shape, so it keeps fixed max_length padding.
+    # On CPU, pad each batch only to its longest text.
+    padding = args.padding or ("max_length" if backend.name == "xla" else "longest")
+    stats = {"tokens": 0, "padded_tokens": 0}
+
+    def encode(texts):
+        if isinstance(texts[0], str):
+            features = tokenizer(texts, return_tensors="pt", max_length=args.max_length, truncation=True,
+                                 padding=padding, pad_to_multiple_of=8 if padding == "longest" else None)
+        else:   #Pre-tokenized token id arrays
+            features = collate(texts, tokenizer.pad_token_id, args.max_length, pad_to_max_length=(padding == "max_length"))
+        stats["tokens"] += int(features["attention_mask"].sum())
+        stats["padded_tokens"] += features["attention_mask"].numel()
+        return {key: value.to(device) for key, value in features.items()}
+
+    def grad_cache_step(columns):
+        """Gradient caching (Gao et al., 2021): same loss and gradients, but activations of only one chunk in memory
+
+        1. embed every column chunk by chunk without a graph
+        2. gather the full batch, compute the loss and backprop it to the embeddings only
+        3. re-run every chunk with a graph and backprop the cached embedding gradients into the model
+        """
+        chunks = [split_features(features, args.grad_cache_chunk) for features in columns]
+
+        reps, rand_states = [], []
+        with torch.no_grad():
+            for col_chunks in chunks:
+                states, embeddings = [], []
+                for chunk in col_chunks:
+                    states.append(RandContext(backend))     #RNG state before this chunk's forward pass
+                    embeddings.append(model(**chunk))
+                rand_states.append(states)
+                reps.append(torch.cat(embeddings).requires_grad_())
+
+        loss = contrastive_loss([backend.all_gather(r) for r in reps], args.scale, cross_entropy_loss)
+        loss.backward()
 
-            ### Compute embeddings
-            embeddings_a = model(**text1.to(device))
-            embeddings_b = model(**text2.to(device))
-            
-            ### Gather all embedings 
-            embeddings_a = torch_xla.core.functions.all_gather(embeddings_a)
-            embeddings_b = torch_xla.core.functions.all_gather(embeddings_b)
+        for col_chunks, states, r in zip(chunks, rand_states, reps):
+            for chunk, state, grad in zip(col_chunks, states, r.grad.split(args.grad_cache_chunk)):
+                with state:     #Same dropout masks as in the first pass
+                    embeddings = model(**chunk)
+                embeddings.backward(gradient=grad)
 
-            ### Compute similarity scores 512 x 512
-            scores = torch.mm(embeddings_a, embeddings_b.transpose(0, 1)) * args.scale
-        
-            ### Compute cross-entropy loss
-            labels = torch.tensor(range(len(scores)), dtype=torch.long, device=embeddings_a.device)  # Example a[i] should match with b[i]
-            
-            ## Symmetric loss as in CLIP
-            loss = (cross_entropy_loss(scores, labels) + cross_entropy_loss(scores.transpose(0, 1), labels)) / 2
+        return loss.detach()
 
-        else:   #(anchor, positive, negative)
-            text1 = tokenizer([b[0] for b in batch], return_tensors="pt", max_length=args.max_length, truncation=True, padding="max_length")
-            text2 = tokenizer([b[1] for b in batch], return_tensors="pt", max_length=args.max_length, truncation=True, padding="max_length")
-            text3 = tokenizer([b[2] for b in batch], return_tensors="pt", max_length=args.max_length, truncation=True, padding="max_length")
-
-            embeddings_a  = model(**text1.to(device))
-            embeddings_b1 = model(**text2.to(device))
-            embeddings_b2 = model(**text3.to(device))
+    log_start = time.time()
+    for global_step in tqdm.trange(args.steps, disable=not backend.is_master()):
+        #### Get the batch data
+        batch = queue.get()
+        #print(index, "batch {}x{}".format(len(batch), ",".join([str(len(b)) for b in batch])))
+        
 
-            embeddings_a  = torch_xla.core.functions.all_gather(embeddings_a)
-            embeddings_b1 = torch_xla.core.functions.all_gather(embeddings_b1)
-            embeddings_b2 = torch_xla.core.functions.all_gather(embeddings_b2)
+        ### Tokenize every column: (anchor, positive) or (anchor, positive, negative)
+        columns = [encode([b[col] for b in batch]) for col in range(len(batch[0]))]
 
-            embeddings_b = torch.cat([embeddings_b1, embeddings_b2])
+        optimizer.zero_grad()
+        if args.grad_cache_chunk > 0:
+            loss = grad_cache_step(columns)
+        else:
+            ### Compute embeddings and gather all embeddings
+            embeddings = [backend.all_gather(model(**features)) for features in columns]
+            loss = contrastive_loss(embeddings, args.scale, cross_entropy_loss)
 
-            ### Compute similarity scores 512 x 1024
-            scores = torch.mm(embeddings_a, embeddings_b.transpose(0, 1)) * args.scale
-        
-            ### Compute cross-entropy loss
-            labels = torch.tensor(range(len(scores)), dtype=torch.long, device=embeddings_a.device)  # Example a[i] should match with b[i]
-            
-            ## One-way loss
-            loss = cross_entropy_loss(scores, labels)
+            # Backward pass
+            loss.backward()
 
-        
-        # Backward pass
-        optimizer.zero_grad()
-        loss.backward()
         torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
         
-        xm.optimizer_step(optimizer, barrier=True)
+        backend.optimizer_step(optimizer)
         lr_scheduler.step()
 
+        #Throughput of this process: real (non-padding) tokens per second and padding overhead
+        if args.log_steps > 0 and (global_step+1) % args.log_steps == 0:
+            elapsed = time.time() - log_start
+            backend.master_print("step {}: {:.0f} tokens/s ({:.0f} incl. padding), padding efficiency {:.1%}".format(
+                global_step+1, stats["tokens"] / elapsed, stats["padded_tokens"] / elapsed,
+                stats["tokens"] / max(1, stats["padded_tokens"])))
+            stats = {"tokens": 0, "padded_tokens": 0}
+            log_start = time.time()
+
 
         #Save model
         if (global_step+1) % args.save_steps == 0:
             output_path = os.path.join(args.output, str(global_step+1))
-            xm.master_print("save model: "+output_path)
-            model.save_pretrained(output_path)
+            backend.master_print("save model: "+output_path)
+            model.save_pretrained(output_path, backend)
           
             
     output_path = os.path.join(args.output, "final")
-    xm.master_print("save model final: "+ output_path)
-    model.save_pretrained(output_path)
+    backend.master_print("save model final: "+ output_path)
+    model.save_pretrained(output_path, backend)
+    backend.cleanup()
 
 
-def produce_data(args, queue, filepaths, dataset_indices):
+def produce_data(args, queue, lock, filepaths, dataset_indices, producer_id=0):
     global_batch_size = args.batch_size*args.nprocs    #Global batch size
     size_per_dataset = int(global_batch_size / args.datasets_per_batch)    #How many datasets per batch
     num_same_dataset = int(size_per_dataset / args.batch_size)
-    print("producer", "global_batch_size", global_batch_size)
-    print("producer", "size_per_dataset", size_per_dataset)
-    print("producer", "num_same_dataset", num_same_dataset)
+    if producer_id == 0:
+        print("producer", "global_batch_size", global_batch_size)
+        print("producer", "size_per_dataset", size_per_dataset)
+        print("producer", "num_same_dataset", num_same_dataset)
+        print("producer", "num_producers", args.num_producers)
+
+    #Forked producers inherit the same random state
+    random.seed(os.getpid() + time.time_ns())
+
+    #Each producer (of every node) reads a disjoint part of every dataset
+    partition = (args.node_rank * args.num_producers + producer_id, args.nnodes * args.num_producers)
     
     datasets = []
     for filepath in filepaths:
-        if "reddit_" in filepath:       #Special dataset class for Reddit files
-            data_obj = RedditDataset(filepath)
+        if is_token_shard(filepath):    #Pre-tokenized shard written by pretokenize.py
+            data_obj = TokenShardDataset(filepath, partition, buffer_size=args.shuffle_buffer)
+        elif is_compact_dataset(filepath):  #Memory-mapped text written by compact_dataset.py
+            data_obj = CompactDataset(filepath, partition, buffer_size=args.shuffle_buffer)
+        elif "reddit_" in filepath:       #Special dataset class for Reddit files
+            data_obj = RedditDataset(filepath, partition, args.shuffle_buffer)
         else:
-            data_obj = Dataset(filepath)
+            data_obj = Dataset(filepath, partition, args.shuffle_buffer)
         datasets.append(iter(data_obj)) 
     
     # Store if dataset is in a 2 col or 3 col format
@@ -187,6 +264,7 @@ def produce_data(args, queue, filepaths, dataset_indices):
     while True:
         texts_in_batch = set()
         batch_format = None     #2 vs 3 col format for this batch
+        device_batches = []
         
         #Add data from several sub datasets
         for _ in range(args.datasets_per_batch):
@@ -201,79 +279,58 @@ def produce_data(args, queue, filepaths, dataset_indices):
             
             #Get data from this dataset
             dataset = datasets[data_idx]
-            for _ in range(num_same_dataset):
-                for _ in range(args.nprocs):
-                    batch_device = []   #A batch for one device
-                    while len(batch_device) < args.batch_size:
-                        sample = next(dataset)
-                        in_batch = False
-                        for text in sample:
-                            if text in texts_in_batch:
-                                in_batch = True
-                                break
-                        
-                        if not in_batch:
-                            for text in sample:
-                                texts_in_batch.add(text)
-                            batch_device.append(sample)
-
-                    queue.put(batch_device)
+            samples = []
+            while len(samples) < num_same_dataset * args.nprocs * args.batch_size:
+                sample = next(dataset)
+                keys = [text_key(text) for text in sample]
+                if any(key in texts_in_batch for key in keys):
+                    continue
+                texts_in_batch.update(keys)
+                samples.append(sample)
+
+            #Length bucketing: sort this part of the global batch by length, so that
+            #each device batch holds texts of similar length and dynamic padding pads little
+            if args.length_bucketing:
+                samples.sort(key=sample_length)
+
+            for start in range(0, len(samples), args.batch_size):
+                device_batches.append(samples[start:start+args.batch_size])   #A batch for one device
+
+        #All device batches of one global step are put back to back, so that with several
+        #producers the devices never mix 2 col and 3 col batches of different producers in one step
+        with lock:
+            for batch in device_batches:
+                queue.put(batch)
                       
 
-class RedditDataset:
+class Dataset:
     """
-    A class that handles the reddit data files
+    A class that handles one dataset, streamed from the .jsonl.gz file through a shuffle buffer
+
+    Only buffer_size examples are held in memory. Large datasets should be converted once with
+    compact_dataset.py: the memory-mapped .textshard is not re-parsed every epoch.
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, partition=(0, 1), buffer_size=10000):
         self.filepath = filepath
+        self.partition = partition
+        self.buffer_size = buffer_size
 
     def __iter__(self):
+        data_format = None
         while True:
-            with gzip.open(self.filepath, "rt") as fIn:
-                    for line in fIn:
-                        data = json.loads(line)
+            for data in shuffle_buffer(read_examples(self.filepath, self.partition), self.buffer_size):
+                if data_format is None:
+                    data_format = len(data)
+
+                #Ensure that all entries are of the same 2/3 col format
+                assert len(data) == data_format
+                yield data
 
-                        if "response" in data and "context" in data:
-                            yield [data["response"], data["context"]]
 
-class Dataset:
+class RedditDataset(Dataset):
     """
-    A class that handles one dataset
+    A class that handles the reddit data files ({"response", "context"} lines)
     """
-    def __init__(self, filepath):
-        self.filepath = filepath
-
-    def __iter__(self):
-        max_dataset_size = 10*1000*1000    #Cache small datasets in memory
-        dataset = []
-        data_format = None
-
-        while dataset is None or len(dataset) == 0:
-            with gzip.open(self.filepath, "rt") as fIn:
-                for line in fIn:
-                    data = json.loads(line)
-                    if isinstance(data, dict):
-                        data = data['texts']
-
-                    if data_format is None:
-                        data_format = len(data)
-                    
-                    #Ensure that all entries are of the same 2/3 col format
-                    assert len(data) == data_format
-
-                    if dataset is not None:
-                        dataset.append(data)
-                        if len(dataset) >= max_dataset_size:
-                            dataset = None
-
-                    yield data
-                
-        # Data loaded. Now stream to the queue
-        # Shuffle for each epoch
-        while True:
-            random.shuffle(dataset)
-            for data in dataset:
-                yield data
                 
                
 
@@ -284,7 +341,19 @@ if __name__ == "__main__":
     parser.add_argument('--save_steps', type=int, default=10000)
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--max_length', type=int, default=128)
-    parser.add_argument('--nprocs', type=int, default=8)
+    parser.add_argument('--nprocs', type=int, default=8, help="Processes per node (TPU cores, or CPU worker processes)")
+    parser.add_argument('--backend', choices=['xla', 'gloo'], default='xla', help="xla: TPU via torch_xla, gloo: CPU via torch.distributed")
+    parser.add_argument('--padding', choices=['max_length', 'longest'], default=None, help="Default: max_length on xla, longest (dynamic) on gloo")
+    parser.add_argument('--length_bucketing', action='store_true', help="Group texts of similar length into the same device batch")
+    parser.add_argument('--log_steps', type=int, default=100, help="Log tokens/sec every N steps, 0 to disable")
+    parser.add_argument('--nnodes', type=int, default=1, help="gloo: number of nodes")
+    parser.add_argument('--node_rank', type=int, default=0, help="gloo: rank of this node")
+    parser.add_argument('--master_addr', default="127.0.0.1", help="gloo: address of node 0")
+    parser.add_argument('--master_port', type=int, default=29500, help="gloo: port of node 0")
+    parser.add_argument('--threads_per_proc', type=int, default=0, help="gloo: torch threads per process, 0 = cores / nprocs")
+    parser.add_argument('--num_producers', type=int, default=1, help="Producer processes per node, each reads its own part of every dataset")
+    parser.add_argument('--shuffle_buffer', type=int, default=10000, help="Examples per dataset held in the streaming shuffle buffer")
+    parser.add_argument('--grad_cache_chunk', type=int, default=0, help="Gradient caching: forward/backward in chunks of this many texts, 0 to disable. Peak memory then depends on the chunk, not the batch size")
     parser.add_argument('--datasets_per_batch', type=int, default=2, help="Number of datasets per batch")
     parser.add_argument('--scale', type=float, default=20, help="Use 20 for cossim, and 1 when you work with unnormalized embeddings with dot product")
     parser.add_argument('--data_folder', default="/data", help="Folder with your dataset files")
@@ -295,6 +364,15 @@ if __name__ == "__main__":
     # Ensure global batch size is divisble by data_sample_size
     assert (args.batch_size*args.nprocs) % args.datasets_per_batch == 0
 
+    #Token shards must match the tokenizer and max_length used for training, check before writing any output
+    with open(args.data_config) as fIn:
+        shard_paths = [os.path.join(os.path.expanduser(args.data_folder), data['name']) for data in json.load(fIn)]
+    shard_paths = [filepath for filepath in shard_paths if is_token_shard(filepath)]
+    if shard_paths:
+        tokenizer = AutoTokenizer.from_pretrained(args.model)
+        for filepath in shard_paths:
+            check_shard_meta(filepath, tokenizer.name_or_path, args.max_length, tokenizer.pad_token_id)
+
     logging.info("Output: "+args.output)
     if os.path.exists(args.output):
         print("Output folder already exists.")
@@ -308,6 +386,8 @@ if __name__ == "__main__":
 
     train_script_path = os.path.join(args.output, 'train_script.py')
     copyfile(__file__, train_script_path)
+    for module in ['train_backends.py', 'pretokenize.py', 'compact_dataset.py']:
+        copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), os.path.join(args.output, module))
     with open(train_script_path, 'a') as fOut:
         fOut.write("\n\n# Script was called via:\n#python " + " ".join(sys.argv))
 
@@ -325,17 +405,23 @@ if __name__ == "__main__":
         filepaths.append(os.path.join(os.path.expanduser(args.data_folder), data['name']))
         dataset_indices.extend([idx]*data['weight'])
 
-    # Start producer
-    p = mp.Process(target=produce_data, args=(args, queue, filepaths, dataset_indices))
-    p.start()
+    # Start producers
+    lock = mp.Lock()
+    producers = []
+    for producer_id in range(args.num_producers):
+        p = mp.Process(target=produce_data, args=(args, queue, lock, filepaths, dataset_indices, producer_id))
+        p.start()
+        producers.append(p)
 
     # Run training
-    print("Start processes:", args.nprocs)
-    xmp.spawn(train_function, args=(args, queue), nprocs=args.nprocs, start_method='fork')
+    print("Start processes:", args.nprocs, "backend:", args.backend)
+    backend = get_backend(args)
+    backend.spawn(train_function, args=(args, queue, backend))
     print("Training done")
     print("It might be that not all processes exit automatically. In that case you must manually kill this process.")
     print("With 'pkill python' you can kill all remaining python processes")
-    p.kill()
+    for p in producers:
+        p.kill()
     exit()
 
 
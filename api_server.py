@@ -0,0 +1,398 @@
+# api_server.py
+"""
+无界面 HTTP API 服务
+
+在 MultiAgentOrchestrator 外包一层 JSON 接口，供高并发调用：
+    POST /query   {"query": "...", "session_id": "...", "timeout": 30}
+    POST /search  {"query": "...", "k": 10, "timeout": 5}          仅检索，不调用 LLM
+    POST /batch   {"queries": [...], "mode": "query|search", "timeout": 60}
+    GET  /metrics                                                   运行指标
+    GET  /health
+
+三个 POST 接口都可带 "library" 指定分馆（Config.LIBRARIES），缺省为默认分馆，未知分馆返回 404。
+k 必须为正整数（超过 Config.API_MAX_K 时按上限处理），timeout 必须为正数，否则返回 400。
+请求进入有界队列后由固定数量的工作线程处理；队列满时立即返回 503，
+超过请求期限返回 504。线程无法被强行中断：已开始执行的 /query 在意图规划结束后检查期限，
+超时则跳过任务执行和总结，但正在进行的那次 LLM 调用或检索仍会占用工作线程直到返回。
+
+示例:
+    python api_server.py --port 8000 --workers 4
+    LIBRARY_BACKEND_MODE=fake python api_server.py
+"""
+import argparse
+import json
+import math
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import Config
+from libraries import UnknownLibrary, resolve_library, use_library
+from metrics import latency_summary
+from records import BookHit, to_jsonable
+
+
+class Overloaded(Exception):
+    """请求队列已满"""
+
+
+class DeadlineExceeded(Exception):
+    """请求在期限内未完成"""
+
+
+class BadRequest(ValueError):
+    """请求参数不合法"""
+
+
+class WorkerPool:
+    """有界队列 + 固定数量工作线程；出队时已过期的任务直接丢弃，不浪费算力"""
+
+    def __init__(self, workers=4, queue_size=64):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._admit_lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self.expired = 0
+        self._threads = [threading.Thread(target=self._run, daemon=True, name=f"api-worker-{i}")
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args, deadline=None):
+        """提交任务，队列满时抛出 Overloaded"""
+        return self.submit_many([(fn, args)], deadline)[0]
+
+    def submit_many(self, calls, deadline=None):
+        """原子地提交一组任务：要么全部入队，要么抛出 Overloaded"""
+        futures = []
+        with self._admit_lock:
+            if self._queue.qsize() + len(calls) > self.queue_size:
+                raise Overloaded(f"请求队列已满 ({self._queue.qsize()}/{self.queue_size})")
+            for fn, args in calls:
+                future = Future()
+                self._queue.put_nowait((fn, args, deadline, future))
+                futures.append(future)
+        return futures
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            fn, args, deadline, future = item
+            if deadline is not None and time.monotonic() > deadline:
+                self.expired += 1
+                future.set_exception(DeadlineExceeded("请求在队列中等待超时"))
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with self._in_flight_lock:
+                self._in_flight += 1
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight -= 1
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize(),
+            "in_flight": self._in_flight,
+            "expired_in_queue": self.expired
+        }
+
+    def shutdown(self):
+        # 工作线程为守护线程，队列满时不等待退出信号入队
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+
+
+class ServerMetrics:
+    """按接口统计请求数、状态码和最近一段时间的延迟"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._status = {}
+        self._latencies = {}
+
+    def record(self, endpoint, status, latency):
+        with self._lock:
+            counts = self._status.setdefault(endpoint, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+            self._latencies.setdefault(endpoint, deque(maxlen=self.window)).append(latency)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": time.time() - self.started,
+                "status": {endpoint: dict(counts) for endpoint, counts in self._status.items()},
+                "latency": {endpoint: latency_summary(list(values)) for endpoint, values in self._latencies.items()}
+            }
+
+
+class LibraryAPIServer:
+    """图书馆问答 HTTP API 服务"""
+
+    def __init__(self, orchestrator=None, host=Config.API_HOST, port=Config.API_PORT,
+                 workers=Config.API_WORKERS, queue_size=Config.API_QUEUE_SIZE):
+        if orchestrator is None:
+            from orchestrator import MultiAgentOrchestrator
+            orchestrator = MultiAgentOrchestrator()
+
+        self.orchestrator = orchestrator
+        self.pool = WorkerPool(workers, queue_size)
+        self.metrics = ServerMetrics(Config.API_METRICS_WINDOW)
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.pool.shutdown()
+        if self.orchestrator.query_log is not None:
+            self.orchestrator.query_log.close()
+
+    # ---- 业务处理（在工作线程中执行） ----
+
+    def run_query(self, query, session_id, library=None, deadline=None):
+        return self.orchestrator.process_user_query(query, session_id, library, deadline=deadline)
+
+    def run_search(self, query, k, library=None):
+        tools = self.orchestrator.library_agent.tools_manager
+        with use_library(library):
+            candidates = tools.retrieve(query, max(k, Config.RETRIEVAL_POOL_SIZE))[:k]
+        return {"query": query, "hits": [BookHit.from_candidate(c).to_dict() for c in candidates]}
+
+    # ---- 接口 ----
+
+    @staticmethod
+    def _deadline(body, default):
+        try:
+            timeout = float(body.get("timeout", default))
+        except (TypeError, ValueError):
+            raise BadRequest("timeout 必须是数字")
+        if not math.isfinite(timeout) or timeout <= 0:
+            raise BadRequest("timeout 必须大于 0")
+        return timeout, time.monotonic() + timeout
+
+    @staticmethod
+    def _k(body):
+        """请求体中的 k：必须为正整数，超过 API_MAX_K 时按上限处理"""
+        try:
+            k = int(body.get("k", 10))
+        except (TypeError, ValueError, OverflowError):
+            raise BadRequest("k 必须是整数")
+        if k <= 0:
+            raise BadRequest("k 必须大于 0")
+        return min(k, Config.API_MAX_K)
+
+    @staticmethod
+    def _library(body):
+        """请求体中的 library 字段，缺省为默认分馆；未配置的分馆抛出 UnknownLibrary（404）"""
+        return resolve_library(body.get("library"))
+
+    @staticmethod
+    def _wait(future, deadline):
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            raise DeadlineExceeded("请求处理超时")
+
+    def handle_query(self, body):
+        query = str(body.get("query", "")).strip()
+        if not query:
+            return 400, {"error": "缺少 query"}
+        library = self._library(body)
+        _, deadline = self._deadline(body, Config.API_DEFAULT_DEADLINE)
+        # 未带 session_id 的请求各自使用新会话，匿名客户端之间不共享多轮状态和记忆
+        session_id = str(body.get("session_id") or f"api-{uuid.uuid4().hex}")
+        future = self.pool.submit(self.run_query, query, session_id, library, deadline, deadline=deadline)
+        return 200, self._wait(future, deadline)
+
+    def handle_search(self, body):
+        query = str(body.get("query", "")).strip()
+        if not query:
+            return 400, {"error": "缺少 query"}
+        k = self._k(body)
+        library = self._library(body)
+        _, deadline = self._deadline(body, Config.API_SEARCH_DEADLINE)
+        future = self.pool.submit(self.run_search, query, k, library, deadline=deadline)
+        return 200, self._wait(future, deadline)
+
+    def handle_batch(self, body):
+        queries = [str(q).strip() for q in body.get("queries", []) if str(q).strip()]
+        if not queries:
+            return 400, {"error": "缺少 queries"}
+        if len(queries) > Config.API_MAX_BATCH:
+            return 400, {"error": f"批量请求最多 {Config.API_MAX_BATCH} 条"}
+
+        mode = body.get("mode", "search")
+        library = self._library(body)
+        if mode == "query":
+            _, deadline = self._deadline(body, Config.API_DEFAULT_DEADLINE)
+            session_id = str(body.get("session_id") or f"api-batch-{uuid.uuid4().hex}")
+            calls = [(self.run_query, (q, f"{session_id}-{i}", library, deadline)) for i, q in enumerate(queries)]
+        elif mode == "search":
+            k = self._k(body)
+            _, deadline = self._deadline(body, Config.API_SEARCH_DEADLINE)
+            calls = [(self.run_search, (q, k, library)) for q in queries]
+        else:
+            return 400, {"error": f"未知 mode: {mode}"}
+
+        futures = self.pool.submit_many(calls, deadline=deadline)
+
+        results = []
+        for query, future in zip(queries, futures):
+            try:
+                results.append(self._wait(future, deadline))
+            except DeadlineExceeded as e:
+                future.cancel()
+                results.append({"query": query, "error": str(e)})
+            except Exception as e:
+                results.append({"query": query, "error": str(e)})
+        return 200, {"mode": mode, "results": results}
+
+    def handle_metrics(self):
+        tools = self.orchestrator.library_agent.tools_manager
+        coalescer = getattr(tools.embeddings, "coalescer", None)
+        return 200, {
+            **self.metrics.snapshot(),
+            "pool": self.pool.stats(),
+            "caches": {
+                "query_embedding": tools.embeddings.query_cache.stats(),
+                "retrieval": tools.retrieval_cache.stats(),
+                "answer": self.orchestrator.answer_cache.stats()
+            },
+            "query_log": self.orchestrator.query_log.stats() if self.orchestrator.query_log is not None else None,
+            "warmup": self.orchestrator.warmer.stats() if self.orchestrator.warmer is not None else None,
+            "embedding_coalescer": coalescer.stats() if coalescer is not None else None,
+            "speculation": self.orchestrator.speculation_stats(),
+            "index": tools.index_stats(),
+            "libraries": tools.libraries.stats(),
+            "shards": tools.shard_coordinator.stats() if tools.shard_coordinator is not None else None,
+            "memory": {
+                "user_agent": self.orchestrator.user_agent.memory_stats(),
+                "library_agent": self.orchestrator.library_agent.memory_stats()
+            }
+        }
+
+
+def _make_handler(app):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        routes = {
+            ("POST", "/query"): app.handle_query,
+            ("POST", "/search"): app.handle_search,
+            ("POST", "/batch"): app.handle_batch,
+        }
+
+        def do_GET(self):
+            start = time.perf_counter()
+            if self.path == "/metrics":
+                status, payload = app.handle_metrics()
+            elif self.path == "/health":
+                status, payload = 200, {"status": "ok"}
+            else:
+                status, payload = 404, {"error": f"未知路径: {self.path}"}
+            self._send(status, payload)
+            app.metrics.record(f"GET {self.path}", status, time.perf_counter() - start)
+
+        def do_POST(self):
+            start = time.perf_counter()
+            headers = {}
+            handler = self.routes.get(("POST", self.path))
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if handler is None:
+                    status, payload = 404, {"error": f"未知路径: {self.path}"}
+                elif not isinstance(body, dict):
+                    status, payload = 400, {"error": "请求体必须是 JSON 对象"}
+                else:
+                    status, payload = handler(body)
+            except json.JSONDecodeError:
+                status, payload = 400, {"error": "请求体不是合法的 JSON"}
+            except BadRequest as e:
+                status, payload = 400, {"error": str(e)}
+            except UnknownLibrary as e:
+                status, payload = 404, {"error": str(e)}
+            except Overloaded as e:
+                status, payload = 503, {"error": str(e)}
+                headers["Retry-After"] = "1"
+            except DeadlineExceeded as e:
+                status, payload = 504, {"error": str(e)}
+            except Exception as e:
+                status, payload = 500, {"error": str(e)}
+
+            self._send(status, payload, headers)
+            app.metrics.record(f"POST {self.path}", status, time.perf_counter() - start)
+
+        def _send(self, status, payload, headers=None):
+            data = json.dumps(payload, ensure_ascii=False, default=to_jsonable).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图书馆问答 HTTP API 服务")
+    parser.add_argument("--host", default=Config.API_HOST)
+    parser.add_argument("--port", type=int, default=Config.API_PORT)
+    parser.add_argument("--workers", type=int, default=Config.API_WORKERS)
+    parser.add_argument("--queue-size", type=int, default=Config.API_QUEUE_SIZE)
+    parser.add_argument("--backend", choices=["siliconflow", "fake"], default=Config.BACKEND_MODE)
+    args = parser.parse_args()
+
+    Config.BACKEND_MODE = args.backend
+    server = LibraryAPIServer(host=args.host, port=args.port, workers=args.workers, queue_size=args.queue_size)
+    print(f"🚀 API 服务已启动: {server.address}  工作线程: {args.workers}  队列: {args.queue_size}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 正在关闭服务...")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
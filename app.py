@@ -1,7 +1,12 @@
 import streamlit as st
 from orchestrator import MultiAgentOrchestrator
+from config import Config
+from libraries import library_names
 import time
+import uuid
 import pandas as pd
+from records import render_task_result
+from tracing import trace_to_jsonl
 
 # 设置页面配置
 st.set_page_config(
@@ -29,20 +34,13 @@ def display_search_results(result):
     """显示搜索结果"""
     st.subheader("📚 找到的书籍")
 
-    # 从结果中提取书籍信息
-    books_found = []
-    if "task_results" in result:
-        for task in result["task_results"]:
-            if "result" in task and "《" in task["result"]:
-                # 简单解析书籍信息
-                lines = task["result"].split('\n')
-                for line in lines:
-                    if "《" in line and "》" in line:
-                        books_found.append(line.strip())
-
-    if books_found:
-        for i, book in enumerate(books_found[:10]):  # 最多显示10本
-            st.write(f"{i + 1}. {book}")
+    books = result.get("books", [])
+    if books:
+        for i, book in enumerate(books[:10]):  # 最多显示10本
+            line = f"{i + 1}. {book.label()}"
+            if book.year != "未知年份":
+                line += f"（{book.year}）"
+            st.write(line)
     else:
         st.info("未找到具体书籍信息")
 
@@ -68,7 +66,52 @@ def display_processing_details(result):
             st.subheader("任务执行详情")
             for task in result["task_results"]:
                 with st.expander(f"任务 {task['task_id']}: {task['description']}", expanded=False):
-                    st.text_area("", task['result'], height=150, key=f"task_{task['task_id']}")
+                    st.text_area("", render_task_result(task), height=150, key=f"task_{task['task_id']}")
+
+        # 显示分阶段耗时
+        if result.get("trace"):
+            display_trace(result["trace"])
+
+
+def display_trace(trace):
+    """显示分阶段追踪信息"""
+    st.subheader("分阶段耗时")
+    summary = trace.get("summary", {})
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("输入token", summary.get("input_tokens", 0))
+    with col2:
+        st.metric("输出token", summary.get("output_tokens", 0))
+    with col3:
+        st.metric("缓存命中", f"{summary.get('cache_hits', 0)}/"
+                              f"{summary.get('cache_hits', 0) + summary.get('cache_misses', 0)}")
+
+    # 按父子关系计算缩进层级
+    depths = {}
+    rows = []
+    for span in trace["spans"]:
+        depth = depths.get(span["parent_id"], -1) + 1
+        depths[span["span_id"]] = depth
+        attributes = span["attributes"]
+        rows.append({
+            "阶段": "　" * depth + span["name"],
+            "开始(ms)": round(span["start_ms"], 1),
+            "耗时(ms)": round(span["duration_ms"], 1),
+            "token": attributes.get("input_tokens", 0) + attributes.get("output_tokens", 0),
+            "缓存命中": {True: "是", False: "否"}.get(attributes.get("cache_hit"), "")
+        })
+
+    if rows:
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
+    st.download_button(
+        "导出 Trace (JSON lines)",
+        data=trace_to_jsonl(trace),
+        file_name=f"trace_{trace['trace_id']}.jsonl",
+        mime="application/jsonl",
+        key=f"trace_{trace['trace_id']}"
+    )
 
 
 def main():
@@ -84,6 +127,10 @@ def main():
         else:
             st.error("❌ 系统初始化失败")
 
+        # 配置了多个分馆时选择查询的分馆
+        if Config.LIBRARIES:
+            st.session_state.library = st.selectbox("🏛️ 分馆", library_names())
+
         st.markdown("---")
         st.markdown("### 使用说明")
         st.info("""
@@ -96,13 +143,7 @@ def main():
 
         st.markdown("---")
         st.markdown("### 示例问题")
-        examples = [
-            "推荐几本巴金的小说",
-            "鲁迅的作品有哪些？",
-            "找一些历史类的书籍",
-            "老舍的代表作"
-        ]
-        for example in examples:
+        for example in Config.EXAMPLE_QUERIES:
             if st.button(example, key=example):
                 st.session_state.user_query = example
 
@@ -145,7 +186,10 @@ def main():
 
             # 执行查询
             start_time = time.time()
-            result = st.session_state.orchestrator.process_user_query(user_query)
+            if "session_id" not in st.session_state:
+                st.session_state.session_id = uuid.uuid4().hex
+            result = st.session_state.orchestrator.process_user_query(user_query, st.session_state.session_id,
+                                                                  st.session_state.get("library"))
             processing_time = time.time() - start_time
 
             progress_bar.progress(100)
@@ -2,6 +2,10 @@ from abc import ABC, abstractmethod
 from typing import Dict, Any, List
 import pandas as pd
 import json
+from config import Config
+from memory import MemoryStore
+
+DEFAULT_SESSION = "default"
 
 
 class BaseAgent(ABC):
@@ -10,15 +14,26 @@ class BaseAgent(ABC):
     def __init__(self, name: str, role: str):
         self.name = name
         self.role = role
-        self.memory = []
+        self.memory = MemoryStore(
+            max_sessions=Config.MEMORY_MAX_SESSIONS,
+            max_entries=Config.MEMORY_MAX_ENTRIES,
+            compaction=Config.MEMORY_COMPACTION,
+            compact_batch=Config.MEMORY_COMPACT_BATCH,
+            max_summaries=Config.MEMORY_MAX_SUMMARIES,
+            summary_chars=Config.MEMORY_SUMMARY_CHARS
+        )
 
-    def remember(self, message: str, agent: str = "system"):
-        """记忆对话历史"""
-        self.memory.append({"agent": agent, "message": message})
+    def remember(self, message: str, agent: str = "system", session_id: str = DEFAULT_SESSION):
+        """记忆对话历史（按会话隔离，容量有上限）"""
+        self.memory.session(session_id).append({"agent": agent, "message": message})
 
-    def get_recent_memory(self, n: int = 5) -> List[Dict]:
+    def get_recent_memory(self, n: int = 5, session_id: str = DEFAULT_SESSION) -> List[Dict]:
         """获取最近的记忆"""
-        return self.memory[-n:] if self.memory else []
+        return self.memory.session(session_id).recent(n)
+
+    def memory_stats(self) -> Dict[str, Any]:
+        """记忆占用统计"""
+        return self.memory.stats()
 
     @abstractmethod
     def process_query(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
@@ -32,4 +47,4 @@ class BaseAgent(ABC):
             "content": content,
             "task_type": task_type,
             "timestamp": str(pd.Timestamp.now())
-        }
\ No newline at end of file
+        }
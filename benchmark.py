@@ -0,0 +1,406 @@
+# benchmark.py
+"""
+离线检索基准测试
+
+不依赖网络：使用固定种子生成的合成书目（1万~500万条分块向量）和基于真实作者/书名构造的
+标注查询集，对每种索引/存储配置统计 recall@k、MRR、延迟分位数、QPS、建索引耗时和峰值内存，
+并将结果保存为 JSON，便于在版本之间对比回归。
+
+示例:
+    python benchmark.py --chunks 10000
+    python benchmark.py --chunks 1000000 --dim 256 --configs flat ivf_sq8 hnsw32
+    python benchmark.py --chunks 10000 --compare benchmark_results/baseline.json
+    python benchmark.py --chunks 100000 --configs flat pca pca_rerank --reduced-dim 256 --rerank-factor 4
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+import numpy as np
+
+from labeled_books import load_labeled_books
+from metrics import latency_summary
+
+# 索引/存储配置：名称 -> faiss index_factory 描述串
+INDEX_CONFIGS = {
+    "flat": "Flat",                     # 与 LangChain FAISS 默认一致的精确检索
+    "flat_fp16": "SQfp16",              # 半精度存储
+    "hnsw32": "HNSW32",                 # 图索引
+    "ivf_flat": "IVF{nlist},Flat",      # 倒排 + 原始向量
+    "ivf_sq8": "IVF{nlist},SQ8",        # 倒排 + 8bit 标量量化
+    "ivf_pq": "IVF{nlist},PQ{pq_m}",    # 倒排 + 乘积量化
+}
+
+# 降维检索 + 全维重排配置（reduced_index.py）：名称 -> (降维方式, 是否重排)
+REDUCED_CONFIGS = {
+    "pca": ("pca", False),                      # 只在 PCA 低维空间检索，作为对照
+    "pca_rerank": ("pca", True),
+    "matryoshka_rerank": ("matryoshka", True),  # 截取前若干维，只对 Matryoshka 训练的模型有意义
+}
+
+BLOCK_BOOKS = 2048  # 每次生成的书籍数，控制生成时的内存占用
+
+
+class SyntheticCatalog:
+    """可复现的合成书目
+
+    书籍属于若干主题，书籍中心向量围绕主题中心扰动，分块向量围绕书籍中心扰动。
+    前 len(labeled_books) 本书对应真实作者/书名，同一作者的书共享一个主题。
+    向量按块生成，不需要一次性持有整个语料。
+    """
+
+    def __init__(self, num_chunks, dim=1024, chunks_per_book=4, num_topics=1024, seed=42,
+                 book_spread=0.8, chunk_noise=0.35, labeled_books=None):
+        self.num_chunks = num_chunks
+        self.dim = dim
+        self.chunks_per_book = chunks_per_book
+        self.num_books = (num_chunks + chunks_per_book - 1) // chunks_per_book
+        self.seed = seed
+        self.book_spread = book_spread
+        self.chunk_noise = chunk_noise
+        self.labeled_books = labeled_books if labeled_books is not None else load_labeled_books()
+
+        authors = sorted({author for _, author in self.labeled_books})
+        self.author_topics = {author: i for i, author in enumerate(authors)}
+        self.num_topics = max(num_topics, len(authors))
+
+        rng = np.random.default_rng([seed, 0])
+        self.topic_centers = self._normalize(rng.standard_normal((self.num_topics, dim), dtype=np.float32))
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def book_topic(self, book_ids):
+        """书籍所属主题：标注书籍按作者分配，其余按乘法哈希分配"""
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        topics = (book_ids * 2654435761) % self.num_topics
+        for i, (_, author) in enumerate(self.labeled_books):
+            topics[book_ids == i] = self.author_topics[author]
+        return topics
+
+    def num_blocks(self):
+        return (self.num_books + BLOCK_BOOKS - 1) // BLOCK_BOOKS
+
+    def block(self, block_idx):
+        """生成一个块：返回 (分块向量, 分块所属 book_id, 书籍中心向量)"""
+        first_book = block_idx * BLOCK_BOOKS
+        last_book = min(first_book + BLOCK_BOOKS, self.num_books)
+        book_ids = np.arange(first_book, last_book)
+
+        rng = np.random.default_rng([self.seed, 1, block_idx])
+        spread = rng.standard_normal((len(book_ids), self.dim), dtype=np.float32)
+        spread *= self.book_spread / np.sqrt(self.dim)
+        centers = self._normalize(self.topic_centers[self.book_topic(book_ids)] + spread)
+
+        first_chunk = first_book * self.chunks_per_book
+        last_chunk = min(last_book * self.chunks_per_book, self.num_chunks)
+        chunk_books = np.arange(first_chunk, last_chunk) // self.chunks_per_book
+
+        noise = rng.standard_normal((len(chunk_books), self.dim), dtype=np.float32)
+        noise *= self.chunk_noise / np.sqrt(self.dim)
+        vectors = self._normalize(centers[chunk_books - first_book] + noise)
+
+        return vectors.astype(np.float32), chunk_books, centers
+
+    def iter_blocks(self, stride=1):
+        for block_idx in range(0, self.num_blocks(), stride):
+            yield self.block(block_idx)
+
+    def book_chunks(self, book_id):
+        first = book_id * self.chunks_per_book
+        return set(range(first, min(first + self.chunks_per_book, self.num_chunks)))
+
+    def labeled_queries(self, seed=7):
+        """根据真实作者/书名构造标注查询，返回 [(查询文本, 查询向量, 相关分块集合)]"""
+        rng = np.random.default_rng([self.seed, 2, seed])
+        num_labeled = min(len(self.labeled_books), self.num_books)
+        centers = self.block(0)[2][:num_labeled]
+        queries = []
+
+        # 书名查询 / 作者+书名查询：相关集合为该书的所有分块
+        for book_id in range(num_labeled):
+            title, author = self.labeled_books[book_id]
+            for text, noise_level in ((f"《{title}》", 0.7), (f"{author} {title}", 0.5)):
+                noise = rng.standard_normal(self.dim).astype(np.float32) * noise_level / np.sqrt(self.dim)
+                vector = self._normalize((centers[book_id] + noise)[None, :])[0]
+                queries.append((text, vector, self.book_chunks(book_id)))
+
+        # 作者查询：相关集合为该作者所有书籍的分块
+        for author, topic in self.author_topics.items():
+            relevant = set()
+            for book_id in range(num_labeled):
+                if self.labeled_books[book_id][1] == author:
+                    relevant |= self.book_chunks(book_id)
+            if not relevant:
+                continue
+            noise = rng.standard_normal(self.dim).astype(np.float32) * 0.5 / np.sqrt(self.dim)
+            vector = self._normalize((self.topic_centers[topic] + noise)[None, :])[0]
+            queries.append((f"{author}的作品", vector, relevant))
+
+        return queries
+
+
+def current_rss_mb():
+    """当前常驻内存（MB）"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return 0.0
+
+
+def peak_rss_mb():
+    """进程峰值常驻内存（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 下单位为 KB，macOS 下为字节
+    return peak / 1024 / 1024 if platform.system() == "Darwin" else peak / 1024
+
+
+def build_index(catalog, factory, args):
+    """按配置构建 faiss 索引，返回 (index, 训练耗时, 添加耗时)"""
+    import faiss
+
+    nlist = args.nlist or max(16, int(4 * np.sqrt(catalog.num_chunks)))
+    pq_m = args.pq_m or max(1, catalog.dim // 16)
+    index = faiss.index_factory(catalog.dim, factory.format(nlist=nlist, pq_m=pq_m))
+
+    train_time = 0.0
+    if not index.is_trained:
+        # 从等距抽样的块中取训练样本，避免只用前几个主题训练
+        stride = max(1, catalog.num_blocks() // 8)
+        samples = []
+        sample_count = 0
+        for vectors, _, _ in catalog.iter_blocks(stride):
+            samples.append(vectors)
+            sample_count += len(vectors)
+            if sample_count >= args.train_size:
+                break
+        train_vectors = np.concatenate(samples)[:args.train_size]
+
+        start = time.perf_counter()
+        index.train(train_vectors)
+        train_time = time.perf_counter() - start
+        del train_vectors, samples
+
+    add_time = 0.0
+    for vectors, _, _ in catalog.iter_blocks():
+        start = time.perf_counter()
+        index.add(vectors)
+        add_time += time.perf_counter() - start
+
+    # 检索参数
+    if hasattr(index, "nprobe"):
+        index.nprobe = args.nprobe
+    else:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = args.nprobe
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = args.ef_search
+
+    return index, train_time, add_time
+
+
+def build_reduced(catalog, name, args):
+    """全维 Flat 索引 + 低维索引，返回 (RerankedIndex, 训练耗时, 添加耗时)"""
+    from reduced_index import RerankedIndex, build_reduced_index
+
+    full_index, _, add_time = build_index(catalog, "Flat", args)
+    method, rerank = REDUCED_CONFIGS[name]
+    start = time.perf_counter()
+    reduced = build_reduced_index(full_index.reconstruct_n(0, full_index.ntotal), args.reduced_dim, method,
+                                  args.train_size, args.seed)
+    reduce_time = time.perf_counter() - start
+    return RerankedIndex(full_index, reduced, args.rerank_factor if rerank else 0), reduce_time, add_time
+
+
+def evaluate(index, queries, k, repeat):
+    """计算 recall@k、MRR 以及单查询延迟和批量 QPS"""
+    query_vectors = np.stack([vector for _, vector, _ in queries]).astype(np.float32)
+
+    # 逐条查询统计延迟
+    latencies = []
+    all_ids = None
+    for _ in range(repeat):
+        round_ids = []
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            _, ids = index.search(query_vectors[i:i + 1], k)
+            latencies.append(time.perf_counter() - start)
+            round_ids.append(ids[0])
+        all_ids = round_ids
+
+    # 批量查询吞吐
+    start = time.perf_counter()
+    for _ in range(repeat):
+        index.search(query_vectors, k)
+    batch_time = time.perf_counter() - start
+
+    recalls = []
+    reciprocal_ranks = []
+    for (_, _, relevant), ids in zip(queries, all_ids):
+        hits = [int(i) in relevant for i in ids]
+        recalls.append(sum(hits) / min(k, len(relevant)))
+        first_hit = next((rank for rank, hit in enumerate(hits, 1) if hit), None)
+        reciprocal_ranks.append(1.0 / first_hit if first_hit else 0.0)
+
+    return {
+        f"recall@{k}": float(np.mean(recalls)),
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "latency": latency_summary(latencies),
+        "qps": len(latencies) / sum(latencies) if latencies else 0.0,
+        "batch_qps": len(queries) * repeat / batch_time if batch_time > 0 else 0.0
+    }
+
+
+def run_config(name, args):
+    """在独立子进程中运行单个配置，使峰值内存互不干扰"""
+    import faiss
+    faiss.omp_set_num_threads(args.threads)
+
+    catalog = SyntheticCatalog(args.chunks, dim=args.dim, chunks_per_book=args.chunks_per_book,
+                               num_topics=args.topics, seed=args.seed)
+    queries = catalog.labeled_queries()
+    rss_before = current_rss_mb()
+
+    if name in REDUCED_CONFIGS:
+        index, train_time, add_time = build_reduced(catalog, name, args)
+        factory = f"{REDUCED_CONFIGS[name][0]}{args.reduced_dim}" + (f",rerank{args.rerank_factor}x" if index.rerank_factor else "")
+    else:
+        index, train_time, add_time = build_index(catalog, INDEX_CONFIGS[name], args)
+        factory = INDEX_CONFIGS[name]
+    result = evaluate(index, queries, args.k, args.repeat)
+    result.update({
+        "factory": factory,
+        "ntotal": int(index.ntotal),
+        "num_queries": len(queries),
+        "train_time_s": train_time,
+        "add_time_s": add_time,
+        "build_time_s": train_time + add_time,
+        "rss_before_build_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb()
+    })
+    return name, result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def compare_results(current, baseline_path, tolerance):
+    """与基线结果对比，返回回归项列表"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for name, result in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or "error" in old or "error" in result:
+            continue  # 任一侧运行失败时没有可比的指标
+
+        for metric in [key for key in result if key.startswith("recall@")] + ["mrr"]:
+            if metric in old and result[metric] < old[metric] - 0.01:
+                regressions.append(f"{name}: {metric} {old[metric]:.4f} -> {result[metric]:.4f}")
+
+        for metric in ["p50_ms", "p95_ms"]:
+            new_value, old_value = result["latency"][metric], old["latency"][metric]
+            if old_value > 0 and new_value > old_value * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {old_value:.3f} -> {new_value:.3f}")
+
+        for metric in ["build_time_s", "peak_rss_mb"]:
+            if old.get(metric, 0) > 0 and result[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {old[metric]:.1f} -> {result[metric]:.1f}")
+
+    return regressions
+
+
+def print_result(name, result, k):
+    latency = result["latency"]
+    print(f"  {name:<12} recall@{k}={result[f'recall@{k}']:.4f}  MRR={result['mrr']:.4f}  "
+          f"p50={latency['p50_ms']:.3f}ms p95={latency['p95_ms']:.3f}ms p99={latency['p99_ms']:.3f}ms  "
+          f"QPS={result['qps']:.0f}  构建={result['build_time_s']:.2f}s  峰值内存={result['peak_rss_mb']:.0f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线检索基准测试")
+    parser.add_argument("--chunks", type=int, default=10000, help="合成分块数量（1万~500万）")
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度，bge-m3 为 1024")
+    parser.add_argument("--chunks-per-book", type=int, default=4)
+    parser.add_argument("--topics", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--configs", nargs="+", default=list(INDEX_CONFIGS),
+                        choices=list(INDEX_CONFIGS) + list(REDUCED_CONFIGS))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3, help="查询集重复次数")
+    parser.add_argument("--nlist", type=int, default=0, help="IVF 聚类中心数，0 表示 4*sqrt(N)")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--pq-m", type=int, default=0, help="PQ 子空间数，0 表示 dim/16")
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--train-size", type=int, default=100000)
+    parser.add_argument("--reduced-dim", type=int, default=256, help="降维检索的目标维度")
+    parser.add_argument("--rerank-factor", type=int, default=4, help="降维检索取 k * 该倍数个候选重排")
+    parser.add_argument("--threads", type=int, default=1, help="faiss OpenMP 线程数")
+    parser.add_argument("--output", default=None, help="结果 JSON 路径")
+    parser.add_argument("--compare", default=None, help="基线结果 JSON，用于检测回归")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="延迟/耗时/内存允许的相对回退")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"📊 离线检索基准测试: {args.chunks} 条分块, {args.dim} 维")
+    print("=" * 60)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "params": vars(args)
+        },
+        "results": {}
+    }
+
+    ctx = mp.get_context("spawn")
+    for name in args.configs:
+        print(f"🔄 运行配置: {name} ({INDEX_CONFIGS.get(name, 'reduced')})")
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            try:
+                _, result = executor.submit(run_config, name, args).result()
+            except Exception as e:
+                print(f"  ❌ 配置 {name} 失败: {e}")
+                report["results"][name] = {"error": str(e)}
+                continue
+        report["results"][name] = result
+        print_result(name, result, args.k)
+
+    output = args.output or os.path.join("benchmark_results", f"retrieval_{args.chunks}_{int(time.time())}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 结果已保存: {output}")
+
+    if args.compare:
+        ok_results = {"results": {n: r for n, r in report["results"].items() if "error" not in r}}
+        regressions = compare_results(ok_results, args.compare, args.tolerance)
+        if regressions:
+            print("❌ 检测到性能回归:")
+            for item in regressions:
+                print(f"   - {item}")
+            raise SystemExit(1)
+        print("✅ 与基线相比无回归")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# benchmark_http.py
+"""
+嵌入接口连接池基准测试
+
+在本地启动一个模拟 /embeddings 接口的 HTTP/1.1 服务，分别用连接池（keep-alive）和
+每次新建连接两种方式调用 SiliconFlowEmbeddings.embed_query，对比单请求开销和新建连接数。
+测试期间关闭查询嵌入合并（EMBED_COALESCE），保证每次调用都是一次独立的 HTTP 请求。
+真实环境下每个新连接还需要 TLS 握手，实际差距会比本地测试更大。
+
+示例:
+    python benchmark_http.py --requests 500 --threads 4
+"""
+import argparse
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import Config, SiliconFlowEmbeddings
+from metrics import latency_summary
+
+
+class _EmbeddingStandInHandler(BaseHTTPRequestHandler):
+    """模拟嵌入接口：为每条输入返回一个固定的 1024 维向量"""
+
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive
+    connections = 0
+    connections_lock = threading.Lock()
+    embedding = [0.01] * 1024
+
+    def setup(self):
+        super().setup()
+        # 头部和正文分两次写出，关闭 Nagle 避免与延迟 ACK 叠加产生 40ms 停顿
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with _EmbeddingStandInHandler.connections_lock:
+            _EmbeddingStandInHandler.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        texts = json.loads(self.rfile.read(length) or b"{}").get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        body = json.dumps({
+            "data": [{"embedding": self.embedding, "index": i} for i in range(len(texts))],
+            "usage": {"prompt_tokens": 4 * len(texts), "total_tokens": 4 * len(texts)}
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _EmbeddingStandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_mode(api_url, pooled, requests_count, threads):
+    """用指定模式发送请求，返回延迟统计和新建连接数"""
+    client = SiliconFlowEmbeddings(api_url=api_url, pooled=pooled)
+    client.query_cache.maxsize = 0  # 关闭查询缓存，保证每次都发请求
+
+    _EmbeddingStandInHandler.connections = 0
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        for i in range(count):
+            start = time.perf_counter()
+            client.embed_query(f"查询 {i}")
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    per_thread = requests_count // threads
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(worker, per_thread) for _ in range(threads)]:
+            future.result()
+    wall_time = time.perf_counter() - start
+
+    return {
+        "pooled": pooled,
+        "requests": len(latencies),
+        "new_connections": _EmbeddingStandInHandler.connections,
+        "throughput_rps": len(latencies) / wall_time,
+        "latency": latency_summary(latencies)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="嵌入接口连接池基准测试")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--output", default=None, help="结果 JSON 路径")
+    args = parser.parse_args()
+
+    # 合并会把并发的相同查询合成一次请求，测得的就不再是每个请求的连接开销
+    Config.EMBED_COALESCE = False
+    server = start_stand_in_server()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}/v1/embeddings"
+    print(f"🧪 本地替身服务: {api_url}  连接池大小: {Config.HTTP_POOL_SIZE}")
+
+    results = {}
+    # 预热一次，排除首次请求的导入等开销
+    run_mode(api_url, False, args.threads, args.threads)
+    for name, pooled in (("unpooled", False), ("pooled", True)):
+        results[name] = run_mode(api_url, pooled, args.requests, args.threads)
+
+    server.shutdown()
+
+    print(f"{'模式':<10}{'请求数':>8}{'新建连接':>10}{'吞吐(rps)':>12}{'mean(ms)':>10}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for name, result in results.items():
+        latency = result["latency"]
+        print(f"{name:<10}{result['requests']:>8}{result['new_connections']:>10}{result['throughput_rps']:>12.1f}"
+              f"{latency['mean_ms']:>10.3f}{latency['p50_ms']:>10.3f}{latency['p99_ms']:>10.3f}")
+
+    saved = results["unpooled"]["latency"]["mean_ms"] - results["pooled"]["latency"]["mean_ms"]
+    print(f"📉 连接池使单请求平均开销减少 {saved:.3f}ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+查询嵌入微批合并
+
+并发的 embed_query 调用各自只有一条输入，而嵌入接口接受列表。合并器把一个短时间窗口内
+（或凑满 max_batch 条）的请求合成一次批量调用，再把结果分发回各调用方。
+
+没有后台线程：窗口内第一个到达的调用方作为"领头者"，等待窗口结束或批次满后代表整批发起请求，
+其余调用方等待结果。
+"""
+import threading
+import time
+from collections import deque
+
+from metrics import latency_summary
+
+
+class _Batch:
+    def __init__(self):
+        self.texts = []
+        self.results = None
+        self.error = None
+        self.closed = False
+        self.dispatched_at = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class EmbeddingCoalescer:
+    """合并并发的单条嵌入请求
+
+    batch_fn(texts) 返回与 texts 等长的结果列表；抛出异常时整批调用方都会收到该异常。
+    """
+
+    def __init__(self, batch_fn, window=0.003, max_batch=16, metrics_window=1000):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self._lock = threading.Lock()
+        self._pending = None
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = {}
+        self.requests = 0
+        self.batches = 0
+        self._queue_delays = deque(maxlen=metrics_window)
+
+    def embed(self, text):
+        """提交一条文本，阻塞直到所在批次完成，返回该文本的结果"""
+        arrived = time.perf_counter()
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _Batch()
+            position = len(batch.texts)
+            batch.texts.append(text)
+            if len(batch.texts) >= self.max_batch:
+                self._close(batch)
+
+        if leader:
+            # 等待窗口结束或批次凑满
+            batch.full.wait(self.window)
+            with self._lock:
+                self._close(batch)
+            self._dispatch(batch)
+        else:
+            batch.done.wait()
+
+        with self._stats_lock:
+            self._queue_delays.append(batch.dispatched_at - arrived)
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[position]
+
+    def _close(self, batch):
+        """停止向批次追加请求（需持有 self._lock）"""
+        if not batch.closed:
+            batch.closed = True
+            batch.full.set()
+            if self._pending is batch:
+                self._pending = None
+
+    def _dispatch(self, batch):
+        # 同一批次内的重复文本只请求一次
+        unique = list(dict.fromkeys(batch.texts))
+        batch.dispatched_at = time.perf_counter()
+        try:
+            outputs = self.batch_fn(unique)
+            if len(outputs) != len(unique):
+                raise ValueError(f"批量嵌入返回 {len(outputs)} 条结果，请求了 {len(unique)} 条")
+            results = dict(zip(unique, outputs))
+            batch.results = [results[text] for text in batch.texts]
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._stats_lock:
+                size = len(batch.texts)
+                self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+                self.requests += size
+                self.batches += 1
+            batch.done.set()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "requests": self.requests,
+                "batches": self.batches,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "queue_delay": latency_summary(list(self._queue_delays))
+            }
@@ -1,11 +1,21 @@
 import os
+import re
+import time
+from contextlib import contextmanager
 from langchain_community.tools import Tool
 from langchain_community.vectorstores import FAISS
 from langchain_text_splitters import CharacterTextSplitter
 from langchain_community.document_loaders import TextLoader, PyPDFLoader
+import threading
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+from cache import LRUCache
+from coalescer import EmbeddingCoalescer
+from records import BookHit, ToolResult
+from tracing import span
 
 
 class Config:
@@ -22,45 +32,227 @@ class Config:
     # 知识库路径
     KNOWLEDGE_BASE_PATH = "./knowledge_docs"
 
+    # 后端模式: "siliconflow" 调用真实API, "fake" 使用本地确定性替身（压测/离线测试）
+    BACKEND_MODE = os.environ.get("LIBRARY_BACKEND_MODE", "siliconflow")
+    FAKE_LLM_LATENCY = 0.0         # 模拟LLM延迟（秒）
+    FAKE_LLM_LATENCY_JITTER = 0.0  # 延迟抖动（秒）
+    FAKE_LLM_ERROR_RATE = 0.0      # 模拟LLM错误率
+    FAKE_EMBED_LATENCY = 0.0       # 模拟嵌入接口延迟（秒）
+    FAKE_EMBED_ERROR_RATE = 0.0    # 模拟嵌入接口错误率
+    FAKE_CATALOG_SIZE = 2000       # 合成书目规模
+    FAKE_SEED = 42
+
+    # 缓存与追踪
+    QUERY_EMBEDDING_CACHE_SIZE = 1024  # 查询向量 LRU 缓存条数，0 表示关闭
+    TRACE_EXPORT_PATH = None           # 设置后每次查询的 Trace 以 JSON lines 追加写入该文件
+
+    # 并发查询嵌入微批合并
+    EMBED_COALESCE = True            # 合并并发的 embed_query 为一次批量请求
+    EMBED_COALESCE_WINDOW = 0.003    # 合并窗口（秒），即单个请求最多额外等待的时间
+    EMBED_COALESCE_MAX_BATCH = 16    # 凑满该条数立即发送
+
+    # 嵌入接口 HTTP 连接池
+    HTTP_POOL_SIZE = 16              # 每个主机保持的最大连接数
+    HTTP_CONNECT_TIMEOUT = 5         # 建立连接超时（秒）
+    HTTP_READ_TIMEOUT = 30           # 查询向量读超时（秒）
+    HTTP_BATCH_READ_TIMEOUT = 60     # 批量文档向量读超时（秒）
+
+    # 智能体记忆（按会话隔离）
+    MEMORY_MAX_ENTRIES = 50      # 每个会话保留的最近记忆条数
+    MEMORY_MAX_SESSIONS = 1000   # 同时保留的会话数，超出后淘汰最久未使用的会话
+    MEMORY_COMPACTION = True     # 写满时将最早的记忆压缩为摘要，而不是直接丢弃
+    MEMORY_COMPACT_BATCH = 10    # 每次压缩的条数
+    MEMORY_MAX_SUMMARIES = 5     # 每个会话保留的摘要条数
+    MEMORY_SUMMARY_CHARS = 200   # 单条摘要的最大字符数
+
+    # 检索候选集与多轮对话
+    RETRIEVAL_POOL_SIZE = 30        # 每次检索保留的候选数（工具取其前若干条，追问时在其中筛选）
+    RETRIEVAL_CACHE_SIZE = 256      # 检索结果 LRU 缓存条数，0 表示关闭
+    CONVERSATION_MAX_SESSIONS = 1000
+    FOLLOWUP_PAGE_SIZE = 5          # 追问时每次展示的书籍数
+
+    # 建索引前去除重复文本块（重印本、不同版次）
+    DEDUP_ENABLED = True
+    DEDUP_JACCARD_THRESHOLD = 0.9    # 字符 3-gram Jaccard 相似度不低于该值视为近似重复，1.0 表示只做精确去重
+    DEDUP_NUM_PERM = 64              # MinHash 签名长度
+    DEDUP_BANDS = 8                  # LSH 分段数（每段 DEDUP_NUM_PERM / DEDUP_BANDS 行，约 0.77 相似度起成为候选）
+
+    # 降维检索 + 全维重排（reduced_index.py）
+    REDUCED_SEARCH = False           # 在低维空间检索候选，再用全维向量重排
+    REDUCED_METHOD = "pca"           # pca 或 matryoshka（直接截取前 REDUCED_DIM 维）
+    REDUCED_DIM = 256
+    REDUCED_RERANK_FACTOR = 4        # 低维检索取 k * 该倍数个候选参与重排
+    REDUCED_TRAIN_SIZE = 20000       # PCA 训练样本数
+
+    # 分片检索（sharding.py）：按 book_id 哈希切分索引，协调器并发查询并合并 top-k
+    SHARD_MODE = None                # None: 单索引; "local": 进程内分片; "remote": 连接 SHARD_ENDPOINTS 的分片服务
+    SHARD_COUNT = 4
+    SHARD_INDEX_DIR = "./faiss_shards"
+    SHARD_ENDPOINTS = []             # 如 ["http://10.0.0.2:9100", "http://10.0.0.3:9100"]
+    SHARD_DEADLINE = 0.5             # 等待分片返回的期限（秒），超时的分片被跳过
+    SHARD_RETURN_VECTORS = False     # 分片是否随结果返回候选向量（仅多轮追问按关键词重排时用到）
+
+    # 查询日志（query_log.py）：后台线程异步追加写入，replay.py 可重放
+    QUERY_LOG_PATH = None            # 设置后记录每次查询（文本、规划、各阶段耗时、结果 ID）
+    QUERY_LOG_QUEUE_SIZE = 10000     # 待写入记录上限，写入跟不上时丢弃并计数
+
+    # 启动预热（warmup.py）：后台预先计算常见查询的向量和检索结果
+    WARMUP_ENABLED = True
+    WARMUP_QUERY_LOG = None          # JSON lines 查询日志（每行含 query 字段），默认使用 QUERY_LOG_PATH 或 TRACE_EXPORT_PATH
+    WARMUP_TOP_N = 50                # 取日志中出现次数最多的前 N 条
+    WARMUP_ANSWERS = False           # 同时完整运行流水线（调用 LLM），配合 ANSWER_CACHE_SIZE 使用
+    WARMUP_WORKERS = 2
+    ANSWER_CACHE_SIZE = 0            # 完整回答 LRU 缓存条数（按归一化查询），0 表示关闭
+    EXAMPLE_QUERIES = [              # 界面侧边栏的示例查询，启动时总会预热
+        "推荐几本巴金的小说",
+        "鲁迅的作品有哪些？",
+        "找一些历史类的书籍",
+        "老舍的代表作"
+    ]
+
+    # 版本化索引与热切换（index_versions.py）
+    INDEX_VERSIONS_DIR = "./faiss_versions"  # 存在 CURRENT 指针时优先于 FAISS_INDEX_PATH
+    INDEX_HOT_SWAP = True                    # 后台监视 CURRENT，变化时加载新版本并原子切换
+    INDEX_WATCH_INTERVAL = 5.0               # 轮询间隔（秒）
+
+    # 多馆（libraries.py）
+    DEFAULT_LIBRARY = "main"         # 即上面的 FAISS_INDEX_PATH / BOOKS_DATA_PATH / INDEX_VERSIONS_DIR，启动时加载并常驻
+    LIBRARIES = {}                   # 其他分馆，如 {"east": {"index_path": ..., "books_data_path": ..., "versions_dir": ...}}
+    LIBRARY_MEMORY_BUDGET_MB = 4096  # 已加载索引的估算内存上限，超出时淘汰最久未使用的分馆，0 表示不限
+
+    # 重新生成书籍嵌入（regenerate_embeddings.py）
+    REGEN_BATCH_SIZE = 20
+    REGEN_CONCURRENCY = 4            # 同时进行的批次请求数
+    REGEN_REQUESTS_PER_MINUTE = 30   # 嵌入接口限速
+
+    # 推测检索：意图 LLM 调用的同时按原始查询检索，规划结果的检索词一致时直接复用
+    SPECULATIVE_RETRIEVAL = True
+    SPECULATIVE_WORKERS = 4
+
+    # 摘要提示词上下文打包
+    CONTEXT_TOKENIZER = LLM_MODEL       # 与服务端 LLM 一致的分词器（HuggingFace 模型名或 tiktoken 编码名）
+    CONTEXT_TOKENIZER_PATH = "./tokenizer/tokenizer.json"  # 随部署打包的分词器文件，存在时离线加载
+    CONTEXT_TOKENIZER_TIMEOUT = 10      # 启动时加载分词器最多等待的秒数，超时先按字符估算
+    CONTEXT_ESTIMATE_MARGIN = 0.85      # 分词器不可用、按字符估算时只使用预算的该比例
+    TASK_SUMMARY_CONTEXT_TOKENS = 600   # 单任务总结提示词中检索结果的 token 预算
+    FINAL_SUMMARY_CONTEXT_TOKENS = 800  # 最终总结提示词中检索结果的 token 预算
+    SUMMARY_MAX_BOOKS = 10              # 提示词中最多列出的书籍数
+    SUMMARY_PREVIEW_CHARS = 60          # 每本书简介截断长度
+
+    # HTTP API 服务
+    API_HOST = "127.0.0.1"
+    API_PORT = 8000
+    API_WORKERS = 4                 # 工作线程数
+    API_QUEUE_SIZE = 64             # 等待队列长度，满时返回 503
+    API_DEFAULT_DEADLINE = 30.0     # /query 默认期限（秒），超时返回 504
+    API_SEARCH_DEADLINE = 5.0       # /search 默认期限（秒）
+    API_MAX_BATCH = 32              # /batch 单次最多查询数
+    API_MAX_K = 100                 # /search、/batch 的 k 上限，超出时按上限处理
+    API_METRICS_WINDOW = 1000       # 每个接口保留的最近延迟样本数
+
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def get_http_session(api_key):
+    """获取共享的 HTTP 会话：keep-alive 连接池，请求头只构建一次
+
+    同一 api_key 的所有嵌入客户端实例共用一个会话。
+    """
+    with _http_sessions_lock:
+        session = _http_sessions.get(api_key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=Config.HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json"
+            })
+            _http_sessions[api_key] = session
+        return session
+
+
+def split_usage(usage, texts):
+    """将批量请求的 token 用量按文本长度分摊到每条文本（估算值）"""
+    total_tokens = usage.get("prompt_tokens", 0)
+    total_chars = sum(len(text) for text in texts) or 1
+    return [{"prompt_tokens": round(total_tokens * len(text) / total_chars), "batch_size": len(texts)}
+            for text in texts]
+
 
 class SiliconFlowEmbeddings(Embeddings):
     """硅基流动嵌入模型 - 修复版"""
 
-    def __init__(self, model_name=Config.EMBED_MODEL, api_key=Config.SILICONFLOW_API_KEY):
+    def __init__(self, model_name=Config.EMBED_MODEL, api_key=Config.SILICONFLOW_API_KEY,
+                 api_url=f"{Config.SILICONFLOW_API_BASE}/embeddings", pooled=True):
         self.model_name = model_name
         self.api_key = api_key
-        self.api_url = "https://api.siliconflow.cn/v1/embeddings"
+        self.api_url = api_url
         self.dimension = 1024
+        self.query_cache = LRUCache(Config.QUERY_EMBEDDING_CACHE_SIZE)
+        # pooled=False 时每次请求新建连接，仅用于对比测试
+        self.session = get_http_session(api_key) if pooled else None
+        self.coalescer = EmbeddingCoalescer(
+            self._request_query_embeddings,
+            window=Config.EMBED_COALESCE_WINDOW,
+            max_batch=Config.EMBED_COALESCE_MAX_BATCH
+        ) if Config.EMBED_COALESCE else None
+
+    def _post(self, data, read_timeout):
+        """发送嵌入请求，优先复用连接池"""
+        timeout = (Config.HTTP_CONNECT_TIMEOUT, read_timeout)
+        if self.session is not None:
+            return self.session.post(self.api_url, json=data, timeout=timeout)
 
-    def embed_query(self, text):
-        """为查询生成嵌入向量"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        return requests.post(self.api_url, headers=headers, json=data, timeout=timeout)
 
+    def embed_query(self, text):
+        """为查询生成嵌入向量"""
+        with span("embedding.query", model=self.model_name) as s:
+            cached = self.query_cache.get(text)
+            s.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached
+
+            embedding, usage = self._request_query_embedding(text)
+            if usage is not None:
+                s.set(input_tokens=usage.get("prompt_tokens", 0), batch_size=usage.get("batch_size", 1))
+                self.query_cache.put(text, embedding)
+            return embedding
+
+    def _request_query_embedding(self, text):
+        """请求查询向量，返回 (向量, usage)；开启合并时与并发请求合为一批发送"""
+        if self.coalescer is not None:
+            return self.coalescer.embed(text)
+        return self._request_query_embeddings([text])[0]
+
+    def _request_query_embeddings(self, texts):
+        """一次请求多条查询向量，返回 [(向量, usage)]；失败时 usage 为 None 且向量为随机降级值"""
         data = {
             "model": self.model_name,
-            "input": [text],
+            "input": texts,
             "encoding_format": "float"
         }
 
         try:
-            response = requests.post(self.api_url, headers=headers, json=data, timeout=30)
+            response = self._post(data, Config.HTTP_READ_TIMEOUT)
             response.raise_for_status()
             result = response.json()
-            return result["data"][0]["embedding"]
+            embeddings = [item["embedding"] for item in sorted(result["data"], key=lambda item: item.get("index", 0))]
+            return list(zip(embeddings, split_usage(result.get("usage", {}), texts)))
         except Exception as e:
             print(f"❌ 查询向量生成失败: {e}")
-            return np.random.normal(0, 0.1, self.dimension).tolist()
+            return [(np.random.normal(0, 0.1, self.dimension).tolist(), None) for _ in texts]
 
     def embed_documents(self, texts):
         """为文档生成嵌入向量"""
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-
         # 分批处理，避免请求过大
         batch_size = 10
         all_embeddings = []
@@ -77,16 +269,19 @@ class SiliconFlowEmbeddings(Embeddings):
                 "encoding_format": "float"
             }
 
-            try:
-                response = requests.post(self.api_url, headers=headers, json=data, timeout=60)
-                response.raise_for_status()
-                result = response.json()
-                batch_embeddings = [item["embedding"] for item in result["data"]]
-                all_embeddings.extend(batch_embeddings)
-            except Exception as e:
-                print(f"  ❌ 文档嵌入批次失败: {e}")
-                # 为失败的批次生成随机向量
-                all_embeddings.extend([np.random.normal(0, 0.1, self.dimension).tolist() for _ in batch_texts])
+            with span("embedding.batch", model=self.model_name, batch_size=len(batch_texts)) as s:
+                try:
+                    response = self._post(data, Config.HTTP_BATCH_READ_TIMEOUT)
+                    response.raise_for_status()
+                    result = response.json()
+                    batch_embeddings = [item["embedding"] for item in result["data"]]
+                    all_embeddings.extend(batch_embeddings)
+                    s.set(input_tokens=result.get("usage", {}).get("prompt_tokens", 0))
+                except Exception as e:
+                    print(f"  ❌ 文档嵌入批次失败: {e}")
+                    s.set(error=str(e))
+                    # 为失败的批次生成随机向量
+                    all_embeddings.extend([np.random.normal(0, 0.1, self.dimension).tolist() for _ in batch_texts])
 
             # 避免API限制
             if batch_num < total_batches:
@@ -96,19 +291,148 @@ class SiliconFlowEmbeddings(Embeddings):
         return all_embeddings
 
 
+def create_embeddings():
+    """根据后端模式创建嵌入模型"""
+    if Config.BACKEND_MODE == "fake":
+        from fake_backends import FakeEmbeddings
+        return FakeEmbeddings(
+            latency=Config.FAKE_EMBED_LATENCY,
+            error_rate=Config.FAKE_EMBED_ERROR_RATE,
+            seed=Config.FAKE_SEED,
+            cache_size=Config.QUERY_EMBEDDING_CACHE_SIZE,
+            coalesce=Config.EMBED_COALESCE,
+            coalesce_window=Config.EMBED_COALESCE_WINDOW,
+            coalesce_max_batch=Config.EMBED_COALESCE_MAX_BATCH
+        )
+    return SiliconFlowEmbeddings()
+
+
+def create_llm(max_tokens=1000, temperature=0.1):
+    """根据后端模式创建LLM"""
+    if Config.BACKEND_MODE == "fake":
+        from fake_backends import FakeChatModel
+        return FakeChatModel(
+            latency=Config.FAKE_LLM_LATENCY,
+            jitter=Config.FAKE_LLM_LATENCY_JITTER,
+            error_rate=Config.FAKE_LLM_ERROR_RATE,
+            seed=Config.FAKE_SEED,
+            max_tokens=max_tokens
+        )
+
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        api_key=Config.SILICONFLOW_API_KEY,
+        base_url=Config.SILICONFLOW_API_BASE,
+        model=Config.LLM_MODEL,
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+
+
+_QUERY_PUNCT = re.compile(r"[\s'\"“”‘’「」《》，。！？、,.!?：:；;（）()]+")
+_CJK_SPACE = re.compile(r"(?<=[\u2e80-\u9fff]) (?=[\u2e80-\u9fff])")
+# 只去掉开头和结尾整段的任务描述套话，不删除查询中间的字词
+_QUERY_PREFIX = re.compile(
+    r"^(请问|请(?=[帮给推找搜查])|麻烦|帮我|给我|我想找|我想要|有没有|推荐|搜索|查找|找一下|找一些|找几本|关于|几本|一些|一本)+"
+)
+_QUERY_SUFFIX = re.compile(
+    r"(书籍信息|相关的书籍|相关书籍|相关的书|相关图书|的书籍|的图书|的书|书籍|图书|有哪些|是什么|有什么|吗|呢|吧)+$"
+)
+
+
+def normalize_query(query: str) -> str:
+    """检索词归一化：去掉首尾的任务描述套话、标点，合并空白并转小写
+
+    只用作检索缓存、推测检索和查询日志的键，不用于嵌入（嵌入的是原始检索词）。
+    意图规划生成的检索词（如 "'几本巴金小说'书籍信息"）和同一方式提取的原始查询归一化后一致。
+    全部被去掉时退回原文。
+    """
+    normalized = _CJK_SPACE.sub("", _QUERY_PUNCT.sub(" ", query).strip()).lower()
+    normalized = _QUERY_SUFFIX.sub("", _QUERY_PREFIX.sub("", normalized)).strip()
+    return normalized or " ".join(query.split()).lower()
+
+
+def dedup_for_index(texts, metadatas, embeddings_list):
+    """建索引前去除重复文本块并打印缩减情况；关闭或失败时原样返回"""
+    if not Config.DEDUP_ENABLED or not texts:
+        return texts, metadatas, embeddings_list
+
+    from dedup import deduplicate_chunks, print_dedup_report
+    try:
+        texts, metadatas, embeddings_list, report = deduplicate_chunks(
+            texts, metadatas, embeddings_list,
+            threshold=Config.DEDUP_JACCARD_THRESHOLD,
+            num_perm=Config.DEDUP_NUM_PERM,
+            bands=Config.DEDUP_BANDS
+        )
+        print_dedup_report(report)
+    except Exception as e:
+        print(f"⚠️ 去重失败，使用全部文本块建索引: {e}")
+    return texts, metadatas, embeddings_list
+
+
 class LibraryTools:
     """图书馆智能体可用的工具集"""
 
     def __init__(self):
-        self.vectorstore = None
-        self.embeddings = SiliconFlowEmbeddings()
+        from index_versions import IndexHandle
+
+        # 当前索引版本：向量库和检索索引（降维检索开启时为 RerankedIndex）一起切换
+        self._handle = IndexHandle(None, None, path=Config.FAISS_INDEX_PATH)
+        self._swap_lock = threading.Lock()
+        self.index_swaps = 0
+        self.index_watcher = None
+        self.embeddings = create_embeddings()
+        self.retrieval_cache = LRUCache(Config.RETRIEVAL_CACHE_SIZE)
+        self.shard_coordinator = None
         self.init_tools()
+        self._init_reduced_index()
+        self._init_shards()
+        self._start_index_watcher()
+        self._init_libraries()
+
+    @property
+    def vectorstore(self):
+        return self._handle.vectorstore
+
+    @vectorstore.setter
+    def vectorstore(self, value):
+        self._handle.vectorstore = value
+
+    @property
+    def search_index(self):
+        return self._handle.search_index
+
+    @search_index.setter
+    def search_index(self, value):
+        self._handle.search_index = value
 
     def init_tools(self):
         """初始化向量数据库"""
+        # 远程分片模式下本进程不加载索引
+        if Config.SHARD_MODE == "remote":
+            return
+
+        # 替身模式使用内存中的合成书目，不读写磁盘索引
+        if Config.BACKEND_MODE == "fake":
+            from fake_backends import build_fake_vectorstore
+            self.vectorstore = build_fake_vectorstore(self.embeddings, Config.FAKE_CATALOG_SIZE, Config.FAKE_SEED)
+            print(f"🧪 替身模式: 已构建 {Config.FAKE_CATALOG_SIZE} 本合成书籍索引")
+            return
+
+        # 版本化索引目录中有 CURRENT 指针时加载当前版本
+        from index_versions import read_current
+        version = read_current()
+        if version is not None:
+            self._handle.version = version
+            self._handle.path = os.path.join(Config.INDEX_VERSIONS_DIR, version)
+            self.vectorstore = FAISS.load_local(self._handle.path, self.embeddings, allow_dangerous_deserialization=True)
+            print(f"📂 加载FAISS书籍索引成功 (版本 {version})")
+            return
+
         # 如果FAISS索引不存在，创建它
         if not os.path.exists(Config.FAISS_INDEX_PATH):
-            self._create_books_vectorstore()
+            self.vectorstore = self._create_books_vectorstore()
         else:
             self.vectorstore = FAISS.load_local(
                 Config.FAISS_INDEX_PATH,
@@ -117,27 +441,183 @@ class LibraryTools:
             )
             print(f"📂 加载FAISS书籍索引成功")
 
+    def _init_reduced_index(self):
+        index_dir = None if Config.BACKEND_MODE == "fake" else self._handle.path
+        self.search_index = self._build_search_index(self.vectorstore, index_dir)
+
+    @staticmethod
+    def _build_search_index(vectorstore, index_dir):
+        """加载或构建低维检索索引；未开启或失败时返回 None（使用全维检索）"""
+        if not Config.REDUCED_SEARCH or vectorstore is None:
+            return None
+
+        from reduced_index import RerankedIndex, load_or_build
+        try:
+            full_index = vectorstore.index
+            reduced = load_or_build(full_index, index_dir, Config.REDUCED_DIM, Config.REDUCED_METHOD,
+                                    Config.REDUCED_TRAIN_SIZE)
+            print(f"📉 降维检索: {full_index.d} -> {min(Config.REDUCED_DIM, full_index.d)} 维 ({Config.REDUCED_METHOD}), "
+                  f"重排候选 {Config.REDUCED_RERANK_FACTOR}x")
+            return RerankedIndex(full_index, reduced, Config.REDUCED_RERANK_FACTOR)
+        except Exception as e:
+            print(f"⚠️ 降维索引构建失败，使用全维检索: {e}")
+            return None
+
+    def _start_index_watcher(self):
+        """监视版本化索引的 CURRENT 指针（替身模式和分片模式下不启用）"""
+        if not Config.INDEX_HOT_SWAP or Config.BACKEND_MODE == "fake" or Config.SHARD_MODE:
+            return
+
+        from index_versions import IndexWatcher
+        self.index_watcher = IndexWatcher(self.load_index_version, Config.INDEX_VERSIONS_DIR,
+                                          Config.INDEX_WATCH_INTERVAL, current=self._handle.version)
+
+    def _load_handle(self, version, path):
+        from index_versions import IndexHandle
+
+        start = time.perf_counter()
+        vectorstore = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+        handle = IndexHandle(version, vectorstore, self._build_search_index(vectorstore, path), path)
+        print(f"📂 索引 {version or path} 加载完成 ({vectorstore.index.ntotal} 条, {time.perf_counter() - start:.1f}s)")
+        return handle
+
+    def load_index_version(self, version, path):
+        """在调用线程（监视线程）中加载新版本，完成后原子切换"""
+        self.swap_index(self._load_handle(version, path))
+
+    def swap_index(self, handle):
+        """切换到新版本：新查询立即使用新索引，旧版本在进行中的查询结束后释放，检索缓存清空"""
+        with self._swap_lock:
+            old, self._handle = self._handle, handle
+            self.index_swaps += 1
+        # 检索缓存键包含版本号，旧版本的条目不会再被命中；清空只是为了尽早释放内存
+        self.retrieval_cache.clear()
+        print(f"🔀 索引已切换: {old.version} -> {handle.version}（旧版本进行中的查询 {old.readers} 个）")
+        old.retire()
+        self._pin_default_library()
+
+    @contextmanager
+    def _use_index(self):
+        """取得当前分馆的当前索引版本并在使用期间持有，切换或淘汰不会释放正在使用的版本"""
+        from libraries import current_library
+
+        library = current_library()
+        if library != Config.DEFAULT_LIBRARY:
+            with self.libraries.use(library) as handle:
+                yield handle
+            return
+
+        with self._swap_lock:
+            handle = self._handle
+            handle.acquire()
+        try:
+            yield handle
+        finally:
+            handle.release()
+
+    def index_version(self):
+        """当前分馆正在使用的索引版本（分馆未加载时会先加载）"""
+        with self._use_index() as handle:
+            return handle.version
+
+    def index_stats(self):
+        handle = self._handle
+        return {"version": handle.version, "path": handle.path, "swaps": self.index_swaps, "readers": handle.readers}
+
+    def _init_libraries(self):
+        """其他分馆的索引注册表：首次请求时加载，超出内存预算时按 LRU 淘汰"""
+        from libraries import LibraryRegistry
+
+        self.libraries = LibraryRegistry(self._load_library, Config.LIBRARY_MEMORY_BUDGET_MB * 1024 * 1024,
+                                         self._watch_library)
+        self._pin_default_library()
+        if Config.LIBRARIES:
+            print(f"🏛️ 多馆模式: 默认 {Config.DEFAULT_LIBRARY}，另有 {len(Config.LIBRARIES)} 个分馆按需加载，"
+                  f"内存预算 {Config.LIBRARY_MEMORY_BUDGET_MB} MB")
+
+    def _pin_default_library(self):
+        """默认分馆常驻内存，其占用计入多馆内存预算"""
+        from libraries import estimate_bytes
+
+        libraries = getattr(self, "libraries", None)
+        if libraries is not None:
+            handle = self._handle
+            libraries.pin(Config.DEFAULT_LIBRARY, estimate_bytes(handle.vectorstore, handle.search_index))
+
+    def _load_library(self, name):
+        """加载一个分馆的索引：版本目录的当前版本 > index_path > 由 books_data_path 构建"""
+        from index_versions import IndexHandle, read_current
+
+        spec = Config.LIBRARIES[name]
+        if Config.BACKEND_MODE == "fake":
+            from fake_backends import build_fake_vectorstore
+            # 每个分馆使用不同的随机种子，得到不同的合成书目
+            seed = spec.get("fake_seed", Config.FAKE_SEED + 1 + list(Config.LIBRARIES).index(name))
+            vectorstore = build_fake_vectorstore(self.embeddings, spec.get("fake_catalog_size", Config.FAKE_CATALOG_SIZE),
+                                                 seed)
+            return IndexHandle(None, vectorstore, self._build_search_index(vectorstore, None))
+
+        versions_dir = spec.get("versions_dir")
+        version = read_current(versions_dir) if versions_dir else None
+        if version is not None:
+            return self._load_handle(version, os.path.join(versions_dir, version))
+
+        index_path = spec["index_path"]
+        if not os.path.exists(index_path):
+            if not spec.get("books_data_path"):
+                raise ValueError(f"分馆 {name} 的索引不存在且未配置 books_data_path: {index_path}")
+            vectorstore = self._create_books_vectorstore(spec["books_data_path"], index_path)
+            return IndexHandle(None, vectorstore, self._build_search_index(vectorstore, index_path), index_path)
+        return self._load_handle(None, index_path)
+
+    def _watch_library(self, name, handle):
+        """分馆配置了 versions_dir 时监视其 CURRENT 指针，淘汰时由注册表停止"""
+        versions_dir = Config.LIBRARIES[name].get("versions_dir")
+        if not Config.INDEX_HOT_SWAP or Config.BACKEND_MODE == "fake" or not versions_dir:
+            return None
+
+        from index_versions import IndexWatcher
+        return IndexWatcher(lambda version, path: self.libraries.replace(name, self._load_handle(version, path)),
+                            versions_dir, Config.INDEX_WATCH_INTERVAL, current=handle.version)
+
+    def _init_shards(self):
+        """按 Config.SHARD_MODE 创建分片协调器，失败时退回单索引检索"""
+        if not Config.SHARD_MODE:
+            return
+
+        from sharding import create_shard_coordinator
+        try:
+            self.shard_coordinator = create_shard_coordinator(self.vectorstore, self.embeddings, self._handle.version)
+            print(f"🧩 分片检索: {len(self.shard_coordinator.clients)} 个分片 ({Config.SHARD_MODE}), "
+                  f"期限 {Config.SHARD_DEADLINE}s")
+        except Exception as e:
+            print(f"⚠️ 分片检索初始化失败，使用单索引检索: {e}")
+            self.shard_coordinator = None
+
     # config.py 中的 _create_books_vectorstore 方法替换为：
 
-    def _create_books_vectorstore(self):
-        """创建基于书籍数据的FAISS向量数据库"""
+    def _create_books_vectorstore(self, books_data_path=None, index_path=None):
+        """创建基于书籍数据的FAISS向量数据库并保存，返回向量库（默认使用 Config 中的路径）"""
         import pandas as pd
 
+        books_data_path = books_data_path or Config.BOOKS_DATA_PATH
+        index_path = index_path or Config.FAISS_INDEX_PATH
+
         # 检查书籍数据文件是否存在
-        if not os.path.exists(Config.BOOKS_DATA_PATH):
-            print(f"❌ 书籍数据文件不存在: {Config.BOOKS_DATA_PATH}")
+        if not os.path.exists(books_data_path):
+            print(f"❌ 书籍数据文件不存在: {books_data_path}")
             # 创建空的向量存储
-            self.vectorstore = FAISS.from_texts(
+            vectorstore = FAISS.from_texts(
                 texts=["暂无书籍数据"],
                 embedding=self.embeddings
             )
-            self.vectorstore.save_local(Config.FAISS_INDEX_PATH)
-            print(f"💾 创建空FAISS索引: {Config.FAISS_INDEX_PATH}")
-            return
+            vectorstore.save_local(index_path)
+            print(f"💾 创建空FAISS索引: {index_path}")
+            return vectorstore
 
         try:
             # 读取书籍数据
-            df = pd.read_csv(Config.BOOKS_DATA_PATH, encoding="utf-8-sig")
+            df = pd.read_csv(books_data_path, encoding="utf-8-sig")
             print(f"📖 读取到 {len(df)} 条书籍数据")
 
             # 准备数据
@@ -204,138 +684,152 @@ class LibraryTools:
                 except:
                     embeddings_list.append([0.0] * 1024)
 
+            texts, metadatas, embeddings_list = dedup_for_index(texts, metadatas, embeddings_list)
+
             # 创建FAISS索引
             import numpy as np
-            self.vectorstore = FAISS.from_embeddings(
+            vectorstore = FAISS.from_embeddings(
                 text_embeddings=list(zip(texts, embeddings_list)),
                 embedding=self.embeddings,
                 metadatas=metadatas
             )
 
             # 保存索引
-            self.vectorstore.save_local(Config.FAISS_INDEX_PATH)
-            print(f"💾 书籍FAISS索引已保存到: {Config.FAISS_INDEX_PATH}")
-            print(f"📚 索引包含: {success_count} 本书籍")
+            vectorstore.save_local(index_path)
+            print(f"💾 书籍FAISS索引已保存到: {index_path}")
+            print(f"📚 索引包含: {len(texts)} 个文本块")
 
         except Exception as e:
             print(f"❌ 创建书籍向量库失败: {e}")
             # 创建空的向量存储作为降级方案
-            self.vectorstore = FAISS.from_texts(
+            vectorstore = FAISS.from_texts(
                 texts=["书籍数据库初始化失败"],
                 embedding=self.embeddings
             )
-            self.vectorstore.save_local(Config.FAISS_INDEX_PATH)
-
-    # 替换 config.py 中的 search_knowledge_base 方法：
-
-    def search_knowledge_base(self, query: str) -> str:
-        """搜索知识库工具 - 基于书籍数据"""
-        if self.vectorstore is None:
-            return "书籍数据库尚未初始化"
-
+            vectorstore.save_local(index_path)
+        return vectorstore
+
+    def retrieve(self, query: str, k: int = None) -> list:
+        """检索候选集：按相似度排序的候选（文档、距离、分数、向量），结果按查询缓存
+
+        两个检索工具和多轮追问共用同一份候选集，同一查询只做一次嵌入和 FAISS 检索。
+        返回的列表会被缓存共享，调用方不要修改。检索的是当前分馆（libraries.use_library）的索引。
+        """
+        from libraries import current_library
+
+        k = k or Config.RETRIEVAL_POOL_SIZE
+        text = " ".join(query.split())  # 嵌入原始检索词，归一化结果只作缓存键
+        query = normalize_query(query)
+        library = current_library()
+        with span("retrieval", k=k, query=query, library=library) as s, self._use_index() as handle:
+            key = (library, handle.version, query, k)
+            cached = self.retrieval_cache.get(key)
+            s.set(cache_hit=cached is not None, index_version=handle.version)
+            if cached is not None:
+                return cached
+
+            embedding = self.embeddings.embed_query(text)
+            # 分片只覆盖默认分馆
+            if self.shard_coordinator is not None and library == Config.DEFAULT_LIBRARY:
+                candidates, missing = self._search_shards(embedding, k)
+                s.set(missing_shards=len(missing))
+                if missing:
+                    return candidates  # 有分片超时或出错时结果不完整，不缓存
+            else:
+                candidates = self._search_by_vector(handle, embedding, k)
+            self.retrieval_cache.put(key, candidates)
+            return candidates
+
+    def is_retrieval_cached(self, query: str, k: int = None) -> bool:
+        """当前分馆、当前索引版本下该查询的候选集是否已在检索缓存中（不计入命中统计）"""
+        from libraries import current_library
+
+        key = (current_library(), self.index_version(), normalize_query(query), k or Config.RETRIEVAL_POOL_SIZE)
+        return key in self.retrieval_cache
+
+    def _search_by_vector(self, handle, embedding, k: int) -> list:
+        """在给定索引版本上 FAISS 检索并取回文档和候选向量"""
+        vectorstore = handle.vectorstore
+        index = vectorstore.index
+        search_index = handle.search_index or index
+        with span("faiss.search", k=k, ntotal=index.ntotal, reduced=handle.search_index is not None) as s:
+            distances, ids = search_index.search(np.asarray([embedding], dtype=np.float32), k)
+            s.set(results=int((ids[0] >= 0).sum()))
+
+        valid = [(float(distance), int(idx)) for distance, idx in zip(distances[0], ids[0]) if idx >= 0]
+        try:
+            vectors = index.reconstruct_batch(np.array([idx for _, idx in valid], dtype=np.int64))
+        except Exception:
+            vectors = [None] * len(valid)  # 部分索引类型不支持取回原始向量
+
+        candidates = []
+        for (distance, idx), vector in zip(valid, vectors):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[idx])
+            candidates.append({
+                "doc": doc,
+                "index_id": idx,
+                "distance": distance,
+                "score": 1.0 - distance / 2.0,  # 归一化向量的 L2 距离换算为余弦相似度
+                "vector": vector
+            })
+        return candidates
+
+    def _search_shards(self, embedding, k: int):
+        """分片检索，返回 (候选列表, 缺失的分片)；index_id 形如 分片号:分片内序号
+
+        默认不取候选向量（vector 为 None，追问时不按关键词向量重排）。
+        """
+        from sharding import decode_vector
+
+        results, missing = self.shard_coordinator.search(embedding, k, with_vectors=Config.SHARD_RETURN_VECTORS)
+        candidates = []
+        for result in results:
+            candidates.append({
+                "doc": Document(page_content=result["page_content"], metadata=result["metadata"]),
+                "index_id": f"{result['shard']}:{result['id']}",
+                "distance": result["distance"],
+                "score": 1.0 - result["distance"] / 2.0,
+                "vector": decode_vector(result["vector"]) if result.get("vector") else None
+            })
+        return candidates, missing
+
+    def _search_hits(self, tool: str, query: str, k: int, limit: int) -> ToolResult:
+        """取候选集前 k 条，按 book_id 去重后最多保留 limit 本"""
+        from libraries import current_library
+
+        default = current_library() == Config.DEFAULT_LIBRARY
+        if default and self.vectorstore is None and self.shard_coordinator is None:
+            return ToolResult(tool, query, error="书籍数据库尚未初始化")
+
+        hits = []
+        seen = set()
+        for candidate in self.retrieve(query, max(k, Config.RETRIEVAL_POOL_SIZE))[:k]:
+            hit = BookHit.from_candidate(candidate)
+            if hit.book_id in seen:
+                continue
+            seen.add(hit.book_id)
+            hits.append(hit)
+            if len(hits) >= limit:
+                break
+        return ToolResult(tool, query, hits)
+
+    def search_knowledge_base(self, query: str) -> ToolResult:
+        """搜索知识库工具 - 基于书籍数据，最多返回8本书"""
         try:
             print(f"🔍 搜索查询: '{query}'")
-            docs = self.vectorstore.similarity_search(query, k=10)  # 增加检索数量
-            print(f"📄 找到 {len(docs)} 个相关文档")
-
-            if not docs:
-                return "未找到相关书籍信息"
-
-            results = []
-            seen_books = set()
-
-            for i, doc in enumerate(docs):
-                title = doc.metadata.get('title', '无题名')
-                author = doc.metadata.get('author', '未知作者')
-                book_key = f"{title}-{author}"
-
-                # 去重
-                if book_key in seen_books:
-                    continue
-                seen_books.add(book_key)
-
-                publisher = doc.metadata.get('publisher', '未知出版社')
-                year = doc.metadata.get('year', '未知年份')
-
-                book_info = f"《{title}》\n   作者: {author}"
-                if publisher != '未知出版社':
-                    book_info += f"\n   出版社: {publisher}"
-                if year != '未知年份':
-                    book_info += f"\n   出版年: {year}"
-
-                # 添加内容预览
-                content_preview = doc.page_content[:100] + "..." if len(doc.page_content) > 100 else doc.page_content
-                book_info += f"\n   简介: {content_preview}"
-
-                results.append(book_info)
-
-                # 最多返回8本书
-                if len(results) >= 8:
-                    break
-
-            return "\n\n".join(results) if results else "未找到相关书籍"
-
+            result = self._search_hits("knowledge_base_search", query, k=10, limit=8)
+            print(f"📄 找到 {len(result.hits)} 本相关书籍")
+            return result
         except Exception as e:
             print(f"❌ 搜索错误: {e}")
-            return f"搜索过程中出错: {str(e)}"
-
-    def search_book_catalog(self, query: str) -> str:
-        """图书目录搜索工具 - 增强版"""
-        if self.vectorstore is None:
-            return "书籍数据库尚未初始化"
+            return ToolResult("knowledge_base_search", query, error=f"搜索过程中出错: {str(e)}")
 
+    def search_book_catalog(self, query: str) -> ToolResult:
+        """图书目录搜索工具 - 增强版，结果渲染时按作者和类别分组"""
         try:
-            # 使用向量搜索找到相关书籍
-            docs = self.vectorstore.similarity_search(query, k=8)
-            if not docs:
-                return "未找到相关图书"
-
-            # 按作者和类别分组
-            author_books = {}
-            category_books = {}
-
-            for doc in docs:
-                title = doc.metadata.get('title', '无题名')
-                author = doc.metadata.get('author', '未知作者')
-                publisher = doc.metadata.get('publisher', '未知出版社')
-                year = doc.metadata.get('year', '未知年份')
-
-                # 按作者分组
-                if author not in author_books:
-                    author_books[author] = []
-                author_books[author].append(f"《{title}》({year})")
-
-                # 简单分类（根据查询关键词）
-                if "小说" in query or "文学" in query:
-                    category = "文学小说"
-                elif "历史" in query:
-                    category = "历史"
-                elif "科学" in query or "技术" in query:
-                    category = "科学技术"
-                else:
-                    category = "其他"
-
-                if category not in category_books:
-                    category_books[category] = []
-                category_books[category].append(f"《{title}》 - {author}")
-
-            # 构建结果
-            results = []
-
-            if author_books:
-                results.append("按作者分类:")
-                for author, books in list(author_books.items())[:3]:  # 最多3个作者
-                    results.append(f"  {author}: {', '.join(books[:3])}")
-
-            if category_books:
-                results.append("\n按类别分类:")
-                for category, books in category_books.items():
-                    results.append(f"  {category}: {', '.join(books[:3])}")
-
-            return "\n".join(results) if results else "未找到相关图书"
-
+            return self._search_hits("book_catalog_search", query, k=8, limit=8)
         except Exception as e:
-            return f"目录搜索过程中出错: {str(e)}"
+            return ToolResult("book_catalog_search", query, error=f"目录搜索过程中出错: {str(e)}")
 
     def get_tools(self):
         """返回所有工具"""
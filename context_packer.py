@@ -0,0 +1,227 @@
+"""
+摘要提示词的上下文打包
+
+从结构化检索候选（LibraryTools.retrieve 的返回值）构建提示词中的书籍列表：
+跨工具、跨任务按书籍去重，按相关度排序，截断简介，在 token 预算内尽量多放书籍。
+
+token 数用服务端 LLM 自己的分词器计算，依次尝试:
+    1. Config.CONTEXT_TOKENIZER_PATH: 随部署打包的 tokenizer.json（离线可用，python context_packer.py --download 生成）
+    2. 按 Config.CONTEXT_TOKENIZER（模型名）从 HuggingFace 加载（需要网络）
+    3. Config.CONTEXT_TOKENIZER 是 tiktoken 编码名时使用 tiktoken
+都不可用时按字符数估算：用量标记为估算值（tokens_estimated），且只使用预算的 CONTEXT_ESTIMATE_MARGIN 比例。
+
+分词器在服务启动时（MultiAgentOrchestrator 初始化）由 load_tokenizer 在后台线程加载，最多等待
+CONTEXT_TOKENIZER_TIMEOUT 秒；请求路径上不会触发下载。加载完成前按字符数估算，完成后自动切换为精确计数。
+"""
+import argparse
+import os
+import threading
+from dataclasses import dataclass
+
+_counter = None
+_counter_lock = threading.Lock()
+_loader = None
+
+
+def _load_counter():
+    """返回 (计数函数, 分词器来源)；全部失败时抛出最后一个异常"""
+    from config import Config
+
+    error = None
+    try:
+        from tokenizers import Tokenizer
+        if os.path.exists(Config.CONTEXT_TOKENIZER_PATH):
+            tokenizer, source = Tokenizer.from_file(Config.CONTEXT_TOKENIZER_PATH), Config.CONTEXT_TOKENIZER_PATH
+        else:
+            tokenizer, source = Tokenizer.from_pretrained(Config.CONTEXT_TOKENIZER), Config.CONTEXT_TOKENIZER
+        return (lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)), source
+    except Exception as e:
+        error = e
+
+    try:
+        import tiktoken
+        encoder = tiktoken.get_encoding(Config.CONTEXT_TOKENIZER)
+        return (lambda text: len(encoder.encode(text, disallowed_special=()))), f"tiktoken:{Config.CONTEXT_TOKENIZER}"
+    except Exception:
+        raise error
+
+
+def _load_in_background():
+    global _counter
+    try:
+        counter, source = _load_counter()
+        _counter = counter
+        print(f"🔤 上下文分词器: {source}")
+    except Exception as e:
+        print(f"⚠️ LLM 分词器不可用，按字符数估算 token（用量为估算值）: {e}")
+
+
+def load_tokenizer(timeout=None) -> bool:
+    """在后台线程加载分词器（只加载一次），最多等待 timeout 秒（默认 Config.CONTEXT_TOKENIZER_TIMEOUT）
+
+    返回分词器是否已可用；超时后继续在后台加载，期间按字符数估算。
+    """
+    global _loader
+    from config import Config
+
+    with _counter_lock:
+        if _loader is None:
+            _loader = threading.Thread(target=_load_in_background, daemon=True, name="tokenizer-load")
+            _loader.start()
+    timeout = Config.CONTEXT_TOKENIZER_TIMEOUT if timeout is None else timeout
+    _loader.join(timeout)
+    if _loader.is_alive():
+        print(f"⚠️ LLM 分词器 {timeout}s 内未加载完成，暂按字符数估算 token（加载完成后自动切换）")
+    return _counter is not None
+
+
+def _get_counter():
+    if _loader is None:
+        load_tokenizer()  # 未在启动时加载（如单独使用本模块）时，首次计数时加载
+    return _counter
+
+
+def tokens_estimated() -> bool:
+    """token 数是否为按字符估算的值"""
+    return _get_counter() is None
+
+
+def effective_budget(budget: int) -> int:
+    """实际可用的预算：估算 token 时留出余量"""
+    if not tokens_estimated():
+        return budget
+    from config import Config
+    return int(budget * Config.CONTEXT_ESTIMATE_MARGIN)
+
+
+def count_tokens(text: str) -> int:
+    """计算文本 token 数"""
+    counter = _get_counter()
+    if counter is not None:
+        return counter(text)
+    # 估算：中文约 1 字 1 token，其余约 4 字符 1 token
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@dataclass
+class PackedContext:
+    text: str
+    tokens: int           # text 的 token 数
+    budget: int
+    books_included: int
+    books_total: int      # 去重后的书籍数
+
+    def usage(self) -> dict:
+        return {
+            "context_tokens": self.tokens,
+            "context_budget": self.budget,
+            "books_included": self.books_included,
+            "books_total": self.books_total,
+            "tokens_estimated": tokens_estimated()
+        }
+
+
+def _book_key(metadata):
+    return metadata.get("title", "无题名"), metadata.get("author", "未知作者")
+
+
+def rank_books(candidate_groups):
+    """合并多组候选并按书籍去重
+
+    同一本书保留最高分的候选；被多个工具/任务同时检索到的书排在同分书之前。
+    返回 [(候选, 命中次数)]，按 (分数, 命中次数) 降序。
+    """
+    books = {}
+    for candidates in candidate_groups:
+        seen = set()
+        for candidate in candidates:
+            key = _book_key(candidate["doc"].metadata)
+            best, hits = books.get(key, (candidate, 0))
+            if candidate["score"] > best["score"]:
+                best = candidate
+            books[key] = (best, hits + (key not in seen))
+            seen.add(key)
+    return sorted(books.values(), key=lambda item: (item[0]["score"], item[1]), reverse=True)
+
+
+def render_book(index, candidate, preview_chars):
+    """一本书渲染为一行"""
+    metadata = candidate["doc"].metadata
+    parts = [f"{index}. 《{metadata.get('title', '无题名')}》 作者: {metadata.get('author', '未知作者')}"]
+    if metadata.get("publisher", "未知出版社") != "未知出版社":
+        parts.append(f"出版社: {metadata['publisher']}")
+    if metadata.get("year", "未知年份") != "未知年份":
+        parts.append(f"出版年: {metadata['year']}")
+
+    preview = " ".join(candidate["doc"].page_content.split())
+    if preview_chars > 0 and preview:
+        if len(preview) > preview_chars:
+            preview = preview[:preview_chars] + "..."
+        parts.append(f"简介: {preview}")
+    return " | ".join(parts)
+
+
+def pack_context(candidate_groups, budget, preview_chars=60, max_books=None):
+    """在 token 预算内按相关度依次放入书籍，返回 PackedContext"""
+    ranked = rank_books(candidate_groups)
+    lines = []
+    tokens = 0
+    for candidate, _ in ranked:
+        if max_books is not None and len(lines) >= max_books:
+            break
+        line = render_book(len(lines) + 1, candidate, preview_chars)
+        line_tokens = count_tokens(line) + 1  # 换行
+        if tokens + line_tokens > budget:
+            break
+        lines.append(line)
+        tokens += line_tokens
+
+    text = "\n".join(lines)
+    return PackedContext(text, count_tokens(text) if text else 0, budget, len(lines), len(ranked))
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """将文本截断到不超过 budget 个 token"""
+    if budget <= 0:
+        return ""
+    if count_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle] + "...") <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + "..." if low else ""
+
+
+def download_tokenizer(model=None, path=None):
+    """下载 LLM 的 tokenizer.json 到 Config.CONTEXT_TOKENIZER_PATH，随部署一起打包"""
+    from config import Config
+    from tokenizers import Tokenizer
+
+    model = model or Config.CONTEXT_TOKENIZER
+    path = path or Config.CONTEXT_TOKENIZER_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    Tokenizer.from_pretrained(model).save(path)
+    print(f"💾 分词器 {model} 已保存到: {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上下文打包分词器")
+    parser.add_argument("--download", action="store_true", help="下载 LLM 分词器到 Config.CONTEXT_TOKENIZER_PATH")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--path", default=None)
+    parser.add_argument("text", nargs="?", default=None, help="计算这段文本的 token 数")
+    args = parser.parse_args()
+
+    if args.download:
+        download_tokenizer(args.model, args.path)
+    if args.text:
+        print(f"{count_tokens(args.text)} tokens" + ("（估算）" if tokens_estimated() else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+多轮对话状态
+
+每个会话保存上一轮完整检索得到的候选集（含向量）。"再推荐几本"、"只要1949年以后的"、
+"按年份排序" 这类追问直接在候选集上筛选/重排，不再调用意图 LLM，也不重新检索。
+"""
+import re
+import threading
+
+import numpy as np
+
+_MORE = re.compile(r"再(推荐|来|找|给|列|看)?(几本|几个|一些|几|点|些)|更多|换(几本|一批|一些|几)|还有(吗|呢|别的|其他|什么)|其他的")
+_RANGE = re.compile(r"(\d{4})\s*年?\s*(到|至|-|~)\s*(\d{4})\s*年?")
+_AFTER = re.compile(r"(\d{4})\s*年?\s*(以后|之后|以来|后)")
+_BEFORE = re.compile(r"(\d{4})\s*年?\s*(以前|之前|前)")
+_SORT_DESC = re.compile(r"最新|从新到旧|新的在前|按(出版)?(年份|时间)倒序")
+_SORT_ASC = re.compile(r"最早|从旧到新|早的在前|按(出版)?(年份|时间)(排序|排列|排)?")
+_RESTRICT = re.compile(r"^(只要|只看|仅要|仅看|只需要)")
+_REFER = re.compile(r"其中|里面|这些|这几本|上面|刚才")  # 明确指向上一轮结果
+_FILLER = re.compile(r"几本|几个|一些|只要|只看|仅要|仅看|只需要|其中|里面|这些|这几本|上面|刚才|给我|帮我|推荐|有没有|关于|哪本|哪几本|哪些"
+                     r"|书籍|书|作品|出版|的|吧|呢|吗|呀|啊|了|请|[，。！？、,.!?\s]")
+
+
+def parse_refinement(query: str, candidates=None):
+    """识别追问意图，返回筛选条件；不是追问时返回 None
+
+    明确指向上一轮结果（其中/这些/上面...）时总是追问，剩余关键词用于在候选集上重排。
+    其他情况（更多/只要/年份/排序）下，剩余关键词为空，或与上一轮候选集（candidates）中的
+    书名/作者相符，才视为追问；否则（如 "再推荐几本鲁迅的书"、"2020年后出版的科幻小说"）
+    是新查询，需要重新检索。
+    """
+    text = query.strip()
+    refinement = {"more": False, "min_year": None, "max_year": None, "sort": None, "focus": ""}
+    residual = text
+
+    match = _RANGE.search(text)
+    if match:
+        refinement["min_year"], refinement["max_year"] = sorted((int(match.group(1)), int(match.group(3))))
+        residual = _RANGE.sub("", residual)
+    else:
+        match = _AFTER.search(text)
+        if match:
+            refinement["min_year"] = int(match.group(1))
+            residual = _AFTER.sub("", residual)
+        match = _BEFORE.search(text)
+        if match:
+            refinement["max_year"] = int(match.group(1))
+            residual = _BEFORE.sub("", residual)
+
+    if _SORT_DESC.search(text):
+        refinement["sort"] = "desc"
+        residual = _SORT_DESC.sub("", residual)
+    elif _SORT_ASC.search(text):
+        refinement["sort"] = "asc"
+        residual = _SORT_ASC.sub("", residual)
+
+    if _MORE.search(text):
+        refinement["more"] = True
+        residual = _MORE.sub("", residual)
+
+    restricted = bool(_RESTRICT.search(text))
+    refers = bool(_REFER.search(text))
+    focus = _FILLER.sub("", residual)
+
+    has_condition = refinement["min_year"] or refinement["max_year"] or refinement["sort"]
+    if not (refinement["more"] or restricted or refers or has_condition):
+        return None
+    if not refers and focus:
+        if not any(_matches_focus(candidate, focus) for candidate in candidates or []):
+            return None
+
+    refinement["focus"] = focus
+    return refinement
+
+
+def _year(candidate):
+    match = re.search(r"\d{4}", str(candidate["doc"].metadata.get("year", "")))
+    return int(match.group()) if match else None
+
+
+def _book_key(candidate):
+    metadata = candidate["doc"].metadata
+    return metadata.get("title", "无题名"), metadata.get("author", "未知作者")
+
+
+def _matches_focus(candidate, focus):
+    title, author = _book_key(candidate)
+    return focus in title or focus in author or author in focus
+
+
+class ConversationState:
+    """一个会话的多轮状态：上一轮的候选集、当前筛选条件和已展示的书籍"""
+
+    def __init__(self):
+        self.query = None
+        self.candidates = []
+        self.filters = {}
+        self.shown = set()
+        self.lock = threading.Lock()
+
+    def reset(self, query, candidates, shown_count=8):
+        """新的完整查询：按书籍去重并保存候选集，前 shown_count 本视为已展示"""
+        books = {}
+        for candidate in sorted(candidates, key=lambda c: c["score"], reverse=True):
+            books.setdefault(_book_key(candidate), candidate)
+
+        self.query = query
+        self.candidates = list(books.values())
+        self.filters = {}
+        self.shown = set(list(books)[:shown_count])
+
+    def refine(self, refinement, page_size=5, embed_query=None):
+        """在候选集上应用追问条件，返回 (本次展示的候选, 生效的筛选条件, 符合条件的总数)"""
+        filters = dict(self.filters)
+        for key in ("min_year", "max_year", "sort"):
+            if refinement[key]:
+                filters[key] = refinement[key]
+        if refinement["focus"]:
+            filters["focus"] = refinement["focus"]
+
+        books = list(self.candidates)
+        if filters.get("min_year"):
+            books = [c for c in books if _year(c) is not None and _year(c) >= filters["min_year"]]
+        if filters.get("max_year"):
+            books = [c for c in books if _year(c) is not None and _year(c) <= filters["max_year"]]
+
+        focus = filters.get("focus")
+        if focus:
+            by_author = [c for c in books if focus in _book_key(c)[1] or _book_key(c)[1] in focus]
+            if by_author:
+                books = by_author
+            elif embed_query is not None and books and all(c["vector"] is not None for c in books):
+                # 用候选集缓存的向量按追问关键词重排，只需一次查询嵌入
+                focus_vector = np.asarray(embed_query(focus), dtype=np.float32)
+                similarities = np.stack([c["vector"] for c in books]) @ focus_vector
+                books = [books[i] for i in np.argsort(-similarities)]
+
+        if filters.get("sort"):
+            known = [c for c in books if _year(c) is not None]
+            unknown = [c for c in books if _year(c) is None]
+            books = sorted(known, key=_year, reverse=filters["sort"] == "desc") + unknown
+
+        total = len(books)
+        if refinement["more"]:
+            books = [c for c in books if _book_key(c) not in self.shown]
+
+        page = books[:page_size]
+        self.filters = filters
+        self.shown.update(_book_key(c) for c in page)
+        return page, filters, total
+
+
+def render_followup(page, filters, total, pool_size):
+    """将追问结果渲染为文本回答"""
+    conditions = []
+    if filters.get("min_year") and filters.get("max_year"):
+        conditions.append(f"{filters['min_year']}~{filters['max_year']}年出版")
+    elif filters.get("min_year"):
+        conditions.append(f"{filters['min_year']}年以后出版")
+    elif filters.get("max_year"):
+        conditions.append(f"{filters['max_year']}年以前出版")
+    if filters.get("focus"):
+        conditions.append(f"与「{filters['focus']}」相关")
+    if filters.get("sort"):
+        conditions.append("按出版年份从新到旧" if filters["sort"] == "desc" else "按出版年份从早到晚")
+
+    header = f"在上一轮检索到的 {pool_size} 本候选书籍中"
+    if conditions:
+        header += f"（{'，'.join(conditions)}，共 {total} 本符合）"
+
+    if not page:
+        return header + "，没有更多符合条件的书籍了。可以换个说法重新查询。"
+
+    lines = [header + "，为您找到："]
+    for i, candidate in enumerate(page, 1):
+        metadata = candidate["doc"].metadata
+        line = f"{i}. 《{metadata.get('title', '无题名')}》 - {metadata.get('author', '未知作者')}"
+        year = _year(candidate)
+        if year:
+            line += f"（{year}）"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,164 @@
+"""
+建索引前的重复文本块检测
+
+书目中同一本书的不同版次、重印本的文本块往往完全相同或只差几个字（出版年、出版社），
+既浪费索引内存，又会在 top-k 中挤掉其他书籍。这里先按规范化文本精确哈希去重，
+再用 MinHash + LSH 找出近似重复（字符 n-gram 的 Jaccard 相似度不低于阈值），
+每组只保留一个规范文本块，其元数据中的 book_ids 记录组内全部 book_id。
+"""
+import hashlib
+import re
+
+import numpy as np
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", str(text)).strip().lower()
+
+
+def _shingles(text, size):
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def _shingle_hashes(shingles):
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles],
+        dtype=np.uint64
+    )
+
+
+class MinHasher:
+    """MinHash 签名：num_perm 个 (a*x + b) mod p 的随机哈希"""
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.default_rng(seed)
+        # a, b, x 都小于 2^32，a*x + b 不会溢出 uint64
+        self.a = rng.integers(1, _MAX_HASH, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MAX_HASH, num_perm, dtype=np.uint64)
+
+    def signature(self, hashes):
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % np.uint64(_PRIME)).min(axis=1)
+
+
+class _UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, x):
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            # 以较早出现的文本块为根，保证规范块稳定
+            self.parent[max(x, y)] = min(x, y)
+
+
+def find_duplicate_groups(texts, threshold=0.9, num_perm=64, bands=8, shingle_size=3, seed=1):
+    """返回 (每个文本块所属组的规范下标列表, 统计信息)"""
+    size = len(texts)
+    union = _UnionFind(size)
+    normalized = [_normalize(text) for text in texts]
+
+    # 1. 精确重复
+    first_seen = {}
+    exact = 0
+    for i, text in enumerate(normalized):
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        if digest in first_seen:
+            union.union(first_seen[digest], i)
+            exact += 1
+        else:
+            first_seen[digest] = i
+
+    # 2. 近似重复：只对精确去重后的代表块计算 MinHash，LSH 分桶得到候选对，再用真实 Jaccard 确认
+    near = 0
+    if threshold < 1.0:
+        representatives = sorted(first_seen.values())
+        hasher = MinHasher(num_perm, seed)
+        rows = num_perm // bands
+        shingle_sets = {}
+        buckets = {}
+        for i in representatives:
+            shingle_sets[i] = _shingles(normalized[i], shingle_size)
+            signature = hasher.signature(_shingle_hashes(shingle_sets[i]))
+            for band in range(bands):
+                key = (band, signature[band * rows:(band + 1) * rows].tobytes())
+                buckets.setdefault(key, []).append(i)
+
+        # 桶内每个成员依次与本桶已形成的各簇代表（簇内最早的成员）比较，相似则并入该簇，否则自成新簇。
+        # 桶首成员与其余成员都不相似时也不会漏掉其余成员之间的重复；只与簇内非代表成员相似的块
+        # 可能在本桶漏判，通常由其他分带的桶补上。簇数远小于成员数，避免大桶中的两两比较
+        checked = set()
+        for members in buckets.values():
+            seeds = []
+            for j in members:
+                for seed in seeds:
+                    if union.find(seed) == union.find(j):
+                        break
+                    if (seed, j) in checked:
+                        continue
+                    checked.add((seed, j))
+                    a, b = shingle_sets[seed], shingle_sets[j]
+                    if len(a & b) / len(a | b) >= threshold:
+                        union.union(seed, j)
+                        near += 1
+                        break
+                else:
+                    seeds.append(j)
+
+    canonical = [union.find(i) for i in range(size)]
+    return canonical, {"exact_duplicates": exact, "near_duplicate_merges": near}
+
+
+def deduplicate_chunks(texts, metadatas, embeddings, threshold=0.9, num_perm=64, bands=8, shingle_size=3):
+    """去除重复文本块，返回 (texts, metadatas, embeddings, report)
+
+    每组保留最早出现的文本块及其向量；其元数据增加 book_ids（组内全部 book_id，按出现顺序）
+    和 duplicate_count（组内文本块数）。
+    """
+    canonical, stats = find_duplicate_groups(texts, threshold, num_perm, bands, shingle_size)
+
+    groups = {}
+    for i, root in enumerate(canonical):
+        groups.setdefault(root, []).append(i)
+
+    kept_texts, kept_metadatas, kept_embeddings = [], [], []
+    for root in sorted(groups):
+        members = groups[root]
+        metadata = dict(metadatas[root])
+        book_ids = [str(metadatas[i].get("book_id", "")) for i in members]
+        metadata["book_ids"] = list(dict.fromkeys(book_id for book_id in book_ids if book_id))
+        metadata["duplicate_count"] = len(members)
+        kept_texts.append(texts[root])
+        kept_metadatas.append(metadata)
+        kept_embeddings.append(embeddings[root])
+
+    dimension = len(embeddings[0]) if len(embeddings) else 0
+    removed = len(texts) - len(kept_texts)
+    report = {
+        "chunks_before": len(texts),
+        "chunks_after": len(kept_texts),
+        "removed": removed,
+        "shrink_ratio": removed / len(texts) if texts else 0.0,
+        "vector_bytes_saved": removed * dimension * 4,
+        "largest_group": max((len(members) for members in groups.values()), default=0),
+        **stats
+    }
+    return kept_texts, kept_metadatas, kept_embeddings, report
+
+
+def print_dedup_report(report):
+    print(f"🧹 重复文本块去重: {report['chunks_before']} -> {report['chunks_after']} 条 "
+          f"(减少 {report['removed']} 条, {report['shrink_ratio']:.1%})")
+    print(f"   - 精确重复: {report['exact_duplicates']} 条, 近似重复合并: {report['near_duplicate_merges']} 次, "
+          f"最大重复组: {report['largest_group']} 条")
+    print(f"   - 向量内存节省: {report['vector_bytes_saved'] / 1024 / 1024:.1f} MB")
@@ -32,11 +32,10 @@ def main():
         print(f"📊 处理步骤: {result['conversation_steps']}步")
 
         # 显示搜索到的书籍
-        if 'task_results' in result:
+        if result.get('books'):
             print(f"\n🔍 搜索到的书籍:")
-            for task in result['task_results']:
-                if 'knowledge_base_search' in task.get('result', ''):
-                    print(f"  - {task['description']}")
+            for book in result['books'][:10]:
+                print(f"  - {book.label()}")
 
 
 if __name__ == "__main__":
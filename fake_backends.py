@@ -0,0 +1,221 @@
+"""
+本地确定性后端替身
+
+Config.BACKEND_MODE = "fake" 时用于替换 SiliconFlowEmbeddings 和 ChatOpenAI，
+不访问网络，可注入延迟和错误，用于压测和离线测试。
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage
+
+from cache import LRUCache
+from coalescer import EmbeddingCoalescer
+from tracing import span
+
+
+class FakeBackendError(RuntimeError):
+    """注入的模拟后端错误"""
+
+
+class _FaultInjector:
+    """按配置注入延迟和错误（线程安全、可复现）"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=42):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay_and_maybe_fail(self, what):
+        with self._lock:
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            raise FakeBackendError(f"模拟{what}错误")
+
+
+@lru_cache(maxsize=65536)
+def _hashed_vector(token, dimension):
+    """以 token 的哈希值为种子生成固定向量"""
+    seed = int.from_bytes(hashlib.md5(token.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+
+
+class FakeEmbeddings(Embeddings):
+    """确定性嵌入替身：字符 1-gram/2-gram 特征哈希
+
+    同一文本总是得到同一向量；字面相近的文本向量也相近，检索结果有意义。
+    """
+
+    def __init__(self, dimension=1024, latency=0.0, jitter=0.0, error_rate=0.0, seed=42, cache_size=0,
+                 coalesce=False, coalesce_window=0.003, coalesce_max_batch=16):
+        self.model_name = "fake-embedding"
+        self.dimension = dimension
+        self.faults = _FaultInjector(latency, jitter, error_rate, seed)
+        self.query_cache = LRUCache(cache_size)
+        # 与真实客户端一致：注入的延迟按"每次请求"计，合并后一批只付一次
+        self.coalescer = EmbeddingCoalescer(
+            self._request_query_embeddings, window=coalesce_window, max_batch=coalesce_max_batch
+        ) if coalesce else None
+
+    def _embed(self, text):
+        text = re.sub(r"\s+", "", str(text))
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        if not grams:
+            grams = ["<empty>"]
+
+        vector = np.sum([_hashed_vector(gram, self.dimension) for gram in grams], axis=0)
+        vector /= max(np.linalg.norm(vector), 1e-12)
+        return vector.tolist()
+
+    def embed_query(self, text):
+        """为查询生成嵌入向量"""
+        with span("embedding.query", model=self.model_name) as s:
+            cached = self.query_cache.get(text)
+            s.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached
+
+            if self.coalescer is not None:
+                embedding, usage = self.coalescer.embed(text)
+            else:
+                embedding, usage = self._request_query_embeddings([text])[0]
+            if usage is not None:
+                s.set(input_tokens=usage["prompt_tokens"], batch_size=usage["batch_size"])
+                self.query_cache.put(text, embedding)
+            return embedding
+
+    def _request_query_embeddings(self, texts):
+        """模拟一次批量查询嵌入请求，返回 [(向量, usage)]"""
+        try:
+            self.faults.delay_and_maybe_fail("查询嵌入")
+        except FakeBackendError as e:
+            # 与真实客户端一致：失败时降级为随机向量，且不缓存
+            print(f"❌ 查询向量生成失败: {e}")
+            return [(np.random.normal(0, 0.1, self.dimension).tolist(), None) for _ in texts]
+
+        return [(self._embed(text), {"prompt_tokens": len(text), "batch_size": len(texts)}) for text in texts]
+
+    def embed_documents(self, texts):
+        """为文档生成嵌入向量"""
+        embeddings = []
+        with span("embedding.batch", model=self.model_name, batch_size=len(texts)):
+            for text in texts:
+                try:
+                    self.faults.delay_and_maybe_fail("文档嵌入")
+                    embeddings.append(self._embed(text))
+                except FakeBackendError as e:
+                    print(f"  ❌ 文档嵌入失败: {e}")
+                    embeddings.append(np.random.normal(0, 0.1, self.dimension).tolist())
+        return embeddings
+
+
+class FakeChatModel:
+    """LLM 替身：意图分析提示返回预设 JSON 规划，其余提示返回预设总结文本"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=42, max_tokens=1000):
+        self.model_name = "fake-llm"
+        self.max_tokens = max_tokens
+        self.faults = _FaultInjector(latency, jitter, error_rate, seed)
+
+    def invoke(self, prompt):
+        prompt = prompt if isinstance(prompt, str) else str(prompt)
+        self.faults.delay_and_maybe_fail("LLM调用")
+
+        query_match = re.search(r'用户查询: "(.*)"', prompt)
+        if query_match and "JSON格式" in prompt:
+            content = json.dumps(self._plan(query_match.group(1)), ensure_ascii=False)
+        else:
+            content = self._summary(prompt)
+
+        # 粗略按字符估算 token 数，便于下游统计
+        usage = {"input_tokens": len(prompt), "output_tokens": len(content),
+                 "total_tokens": len(prompt) + len(content)}
+        return AIMessage(content=content, usage_metadata=usage)
+
+    @staticmethod
+    def _plan(query):
+        intent = "推荐" if "推荐" in query else "搜索"
+        return {
+            "intent": intent,
+            "target_type": "书籍",
+            "target_details": query,
+            "required_tools": ["knowledge_base_search", "book_catalog_search"],
+            "tasks": [{
+                "type": "recommend" if intent == "推荐" else "search",
+                "description": f"搜索{query}",
+                "tools": ["knowledge_base_search", "book_catalog_search"]
+            }]
+        }
+
+    def _summary(self, prompt):
+        titles = list(dict.fromkeys(re.findall(r"《(.+?)》", prompt)))[:5]
+        if not titles:
+            return "未找到相关书籍，建议提供更具体的作者或书名信息。"
+
+        lines = ["根据检索结果，为您推荐以下书籍："]
+        lines += [f"{i}. 《{title}》" for i, title in enumerate(titles, 1)]
+        lines.append("以上书籍与您的查询最相关，可以进一步指定作者或出版年份缩小范围。")
+        return "\n".join(lines)[:self.max_tokens * 2]
+
+
+_SURNAMES = ["王", "李", "张", "刘", "陈", "杨", "赵", "黄", "周", "吴", "徐", "孙", "马", "朱", "胡"]
+_GIVEN_NAMES = ["明", "华", "伟", "芳", "军", "静", "磊", "洋", "勇", "艳", "杰", "涛", "强", "敏", "超"]
+_SUBJECTS = ["中国", "近代", "世界", "城市", "乡村", "科学", "历史", "哲学", "经济", "艺术", "教育", "社会"]
+_GENRES = ["小说", "散文集", "史话", "概论", "研究", "文集", "诗选", "评传", "简史", "导论"]
+_PUBLISHERS = ["人民文学出版社", "商务印书馆", "中华书局", "三联书店", "上海古籍出版社", "科学出版社"]
+
+
+def synthetic_books(size, seed=42):
+    """生成合成书目：真实作者/书名在前，其余为随机组合，返回 [(text, metadata)]"""
+    from labeled_books import load_labeled_books
+
+    rng = random.Random(seed)
+    books = []
+    for title, author in load_labeled_books():
+        books.append((title, author, "小说" if len(books) % 2 == 0 else "文学"))
+
+    while len(books) < size:
+        title = f"{rng.choice(_SUBJECTS)}{rng.choice(_SUBJECTS)}{rng.choice(_GENRES)}"
+        author = rng.choice(_SURNAMES) + rng.choice(_GIVEN_NAMES) + rng.choice(["", *_GIVEN_NAMES])
+        books.append((title, author, rng.choice(_SUBJECTS)))
+
+    records = []
+    for book_id, (title, author, subject) in enumerate(books[:size]):
+        publisher = rng.choice(_PUBLISHERS)
+        year = str(rng.randint(1920, 2023))
+        text = f"{title} {author} {publisher} {year} 简介: 本书是{author}关于{subject}的著作《{title}》。"
+        records.append((text, {
+            "title": title,
+            "author": author,
+            "publisher": publisher,
+            "year": year,
+            "chunk_id": str(book_id),
+            "book_id": str(book_id)
+        }))
+    return records
+
+
+def build_fake_vectorstore(embeddings, size, seed=42):
+    """用合成书目在内存中构建 FAISS 索引（不写磁盘）"""
+    from langchain_community.vectorstores import FAISS
+
+    records = synthetic_books(size, seed)
+    texts = [text for text, _ in records]
+    return FAISS.from_embeddings(
+        text_embeddings=list(zip(texts, [embeddings._embed(text) for text in texts])),
+        embedding=embeddings,
+        metadatas=[metadata for _, metadata in records]
+    )
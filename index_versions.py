@@ -0,0 +1,198 @@
+# index_versions.py
+"""
+版本化索引目录与热切换
+
+目录结构（Config.INDEX_VERSIONS_DIR）:
+    faiss_versions/
+        v20261019-153000/   一个完整的 LangChain FAISS 索引（及其 reduced.faiss 等附属文件）
+        v20261020-090000/
+        CURRENT             当前版本名（写临时文件后 os.replace，读者看到的总是完整内容）
+
+新版本先完整写入 <版本名>.tmp 目录再改名，最后才更新 CURRENT，运行中的应用不会读到写了一半的索引。
+LibraryTools 中的 IndexWatcher 轮询 CURRENT，发现变化后在后台加载新版本，原子切换读者，
+旧版本在其上正在进行的查询全部结束后释放。
+
+示例:
+    python index_versions.py list
+    python index_versions.py use v20261019-153000     # 回滚到旧版本
+    python index_versions.py prune --keep 3
+"""
+import argparse
+import os
+import shutil
+import threading
+import time
+
+from config import Config
+
+CURRENT_FILE = "CURRENT"
+TMP_SUFFIX = ".tmp"
+
+
+def new_version_name():
+    return time.strftime("v%Y%m%d-%H%M%S")
+
+
+def read_current(root=None):
+    """当前版本名；没有版本目录或指针时返回 None"""
+    root = root or Config.INDEX_VERSIONS_DIR
+    try:
+        with open(os.path.join(root, CURRENT_FILE), encoding="utf-8") as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    return version if version and os.path.isdir(os.path.join(root, version)) else None
+
+
+def set_current(version, root=None):
+    """原子地更新 CURRENT 指针"""
+    root = root or Config.INDEX_VERSIONS_DIR
+    if not os.path.isdir(os.path.join(root, version)):
+        raise ValueError(f"索引版本不存在: {version}")
+    tmp_path = os.path.join(root, CURRENT_FILE + TMP_SUFFIX)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+
+def publish_version(vectorstore, root=None, version=None, activate=True):
+    """把 vectorstore 保存为新版本并（默认）切换 CURRENT，返回 (版本名, 目录)"""
+    root = root or Config.INDEX_VERSIONS_DIR
+    version = version or new_version_name()
+    path = os.path.join(root, version)
+    if os.path.exists(path):
+        raise ValueError(f"索引版本已存在: {version}")
+
+    tmp_path = path + TMP_SUFFIX
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    vectorstore.save_local(tmp_path)
+    os.replace(tmp_path, path)
+    if activate:
+        set_current(version, root)
+    return version, path
+
+
+def list_versions(root=None):
+    root = root or Config.INDEX_VERSIONS_DIR
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if os.path.isdir(os.path.join(root, name)) and not name.endswith(TMP_SUFFIX))
+
+
+def prune_versions(root=None, keep=3):
+    """删除最旧的版本，只保留最近 keep 个（当前版本始终保留），返回删除的版本名"""
+    root = root or Config.INDEX_VERSIONS_DIR
+    current = read_current(root)
+    versions = list_versions(root)
+    removed = [version for version in versions[:max(0, len(versions) - keep)] if version != current]
+    for version in removed:
+        shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+    return removed
+
+
+class IndexHandle:
+    """一个已加载的索引版本及其读者计数
+
+    读者通过 acquire/release 使用；被替换后 retire，最后一个读者 release 时释放索引内存。
+    """
+
+    def __init__(self, version, vectorstore, search_index=None, path=None):
+        self.version = version
+        self.vectorstore = vectorstore
+        self.search_index = search_index
+        self.path = path
+        self._lock = threading.Lock()
+        self._readers = 0
+        self._retired = False
+
+    @property
+    def readers(self):
+        return self._readers
+
+    def acquire(self):
+        with self._lock:
+            self._readers += 1
+
+    def release(self):
+        with self._lock:
+            self._readers -= 1
+            drained = self._retired and self._readers == 0
+        if drained:
+            self._close()
+
+    def retire(self):
+        with self._lock:
+            self._retired = True
+            drained = self._readers == 0
+        if drained:
+            self._close()
+
+    def _close(self):
+        if self.vectorstore is None:
+            return
+        self.vectorstore = None
+        self.search_index = None
+        print(f"🗑️ 已释放旧索引版本: {self.version}")
+
+
+class IndexWatcher:
+    """后台轮询 CURRENT 指针，变化时调用 on_change(版本名, 目录)"""
+
+    def __init__(self, on_change, root=None, interval=5.0, current=None):
+        self.on_change = on_change
+        self.root = root or Config.INDEX_VERSIONS_DIR
+        self.interval = interval
+        self.seen = current
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="index-watcher")
+        self._thread.start()
+
+    def check(self):
+        version = read_current(self.root)
+        if version is None or version == self.seen:
+            return False
+        # 先记下，加载失败时不在每个轮询周期重复尝试同一版本
+        self.seen = version
+        try:
+            self.on_change(version, os.path.join(self.root, version))
+        except Exception as e:
+            print(f"⚠️ 加载索引版本 {version} 失败，继续使用当前版本: {e}")
+            return False
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="版本化索引管理")
+    parser.add_argument("--root", default=Config.INDEX_VERSIONS_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="列出全部版本")
+    use = subparsers.add_parser("use", help="切换 CURRENT 到指定版本（运行中的应用会自动热切换）")
+    use.add_argument("version")
+    prune = subparsers.add_parser("prune", help="删除旧版本")
+    prune.add_argument("--keep", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        current = read_current(args.root)
+        for version in list_versions(args.root):
+            print(f"{'*' if version == current else ' '} {version}")
+    elif args.command == "use":
+        set_current(args.version, args.root)
+        print(f"✅ CURRENT -> {args.version}")
+    else:
+        removed = prune_versions(args.root, args.keep)
+        print(f"🧹 已删除 {len(removed)} 个旧版本: {removed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+# inspect_index.py
+"""
+索引检查与占用报告
+
+加载一个 LangChain FAISS 索引目录，报告:
+    基本信息    向量条数、维度、索引类型
+    占用        向量/索引结构与文档库（docstore）各占多少字节，磁盘文件大小
+    书籍分布    每本书的文本块数分布、文本块最多的书、缺少 book_id 或题名/作者为占位值的条目
+    向量健康    零向量、NaN/Inf、未归一化、完全重复的向量，以及疑似随机回退向量
+    检索延迟    以库内向量加噪声作为查询的单条延迟分位数和批量 QPS
+
+疑似随机回退向量有两个特征（嵌入接口失败时 SiliconFlowEmbeddings 用 N(0, 0.1) 随机向量顶替）:
+范数接近 0.1 * sqrt(维度) 而不是 1；或者与全库质心方向的余弦相似度处于随机噪声水平，
+而正常的嵌入向量彼此共享一个公共方向（各向异性）。
+
+示例:
+    python inspect_index.py                       # 当前版本（CURRENT）或 Config.FAISS_INDEX_PATH
+    python inspect_index.py ./faiss_versions/v20261019-153000 --strict
+    python inspect_index.py --fake --output report.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import time
+from collections import Counter
+
+import numpy as np
+
+from config import Config
+from metrics import latency_summary
+
+PLACEHOLDERS = {"title": "无题名", "author": "未知作者", "publisher": "未知出版社", "year": "未知年份"}
+BLOCK_SIZE = 65536
+
+
+def iter_vectors(index, block_size=BLOCK_SIZE):
+    for start in range(0, index.ntotal, block_size):
+        yield start, index.reconstruct_n(start, min(block_size, index.ntotal - start))
+
+
+def footprint(vectorstore, index_dir=None):
+    """索引结构与文档库的字节数（序列化大小）以及磁盘文件大小"""
+    import faiss
+
+    index_bytes = len(faiss.serialize_index(vectorstore.index))
+    docstore_bytes = len(pickle.dumps((vectorstore.docstore._dict, vectorstore.index_to_docstore_id)))
+    files = {}
+    if index_dir and os.path.isdir(index_dir):
+        files = {name: os.path.getsize(os.path.join(index_dir, name)) for name in sorted(os.listdir(index_dir))
+                 if os.path.isfile(os.path.join(index_dir, name))}
+    return {
+        "raw_vector_bytes": vectorstore.index.ntotal * vectorstore.index.d * 4,
+        "index_bytes": index_bytes,
+        "docstore_bytes": docstore_bytes,
+        "total_bytes": index_bytes + docstore_bytes,
+        "files": files
+    }
+
+
+def book_distribution(vectorstore, top=5):
+    """每本书的文本块数分布和元数据问题"""
+    chunks_per_book = Counter()
+    missing_book_id = 0
+    placeholders = Counter()
+    for doc in vectorstore.docstore._dict.values():
+        metadata = doc.metadata or {}
+        book_ids = metadata.get("book_ids") or ([metadata["book_id"]] if metadata.get("book_id") else [])
+        if not book_ids:
+            missing_book_id += 1
+        for book_id in book_ids:
+            chunks_per_book[str(book_id)] += 1
+        for field, placeholder in PLACEHOLDERS.items():
+            if str(metadata.get(field, placeholder)) in (placeholder, "", "nan"):
+                placeholders[field] += 1
+
+    counts = np.array(list(chunks_per_book.values()) or [0])
+    return {
+        "books": len(chunks_per_book),
+        "chunks_per_book": {
+            "min": int(counts.min()),
+            "median": float(np.median(counts)),
+            "mean": float(counts.mean()),
+            "max": int(counts.max()),
+            "histogram": dict(sorted(Counter(np.minimum(counts, 10).tolist()).items()))  # 10 表示 >= 10
+        },
+        "top_books": chunks_per_book.most_common(top),
+        "chunks_without_book_id": missing_book_id,
+        "placeholder_fields": dict(placeholders)
+    }
+
+
+def vector_health(index, norm_tolerance=0.01, sample=20):
+    """逐块扫描全部向量，统计退化向量；返回 (报告, 有问题的向量序号)"""
+    dim = index.d
+    random_norm = 0.1 * np.sqrt(dim)
+    noise_cos = 3.0 / np.sqrt(dim)  # 随机方向与任意固定方向余弦的约 3 个标准差
+
+    norms = np.empty(index.ntotal, dtype=np.float32)
+    non_finite = []
+    centroid = np.zeros(dim, dtype=np.float64)
+    hashes = Counter()
+    for start, vectors in iter_vectors(index):
+        finite = np.isfinite(vectors).all(axis=1)
+        non_finite.extend((start + np.flatnonzero(~finite)).tolist())
+        vectors = np.where(np.isfinite(vectors), vectors, 0)
+        block_norms = np.linalg.norm(vectors, axis=1)
+        norms[start:start + len(vectors)] = block_norms
+        centroid += (vectors / np.maximum(block_norms, 1e-12)[:, None]).sum(axis=0)
+        hashes.update(hashlib.sha1(vector.tobytes()).digest() for vector in vectors)
+
+    centroid /= max(1.0, np.linalg.norm(centroid))
+    centroid_cos = np.empty(index.ntotal, dtype=np.float32)
+    for start, vectors in iter_vectors(index):
+        vectors = np.where(np.isfinite(vectors), vectors, 0)
+        centroid_cos[start:start + len(vectors)] = (vectors @ centroid) / np.maximum(norms[start:start + len(vectors)], 1e-12)
+
+    zero = np.flatnonzero(norms < 1e-6)
+    not_normalized = np.flatnonzero((np.abs(norms - 1.0) > norm_tolerance) & (norms >= 1e-6))
+    random_norm_like = np.flatnonzero(np.abs(norms - random_norm) < 0.1 * random_norm)
+    # 只有全库明显各向异性时，与质心方向无关的向量才可疑
+    median_cos = float(np.median(centroid_cos)) if index.ntotal else 0.0
+    anisotropic = median_cos > 5 * noise_cos
+    off_manifold = np.flatnonzero((np.abs(centroid_cos) < noise_cos) & (norms >= 1e-6)) if anisotropic else np.array([], dtype=np.int64)
+    suspected_random = np.union1d(random_norm_like, off_manifold)
+    duplicates = sum(count - 1 for count in hashes.values() if count > 1)
+
+    flagged = np.union1d(np.union1d(zero, suspected_random), np.array(non_finite, dtype=np.int64))
+    report = {
+        "norm": {"min": float(norms.min()), "mean": float(norms.mean()), "max": float(norms.max()),
+                 "std": float(norms.std())} if index.ntotal else {},
+        "zero_vectors": int(len(zero)),
+        "non_finite_vectors": len(non_finite),
+        "not_normalized": int(len(not_normalized)),
+        "duplicate_vectors": int(duplicates),
+        "centroid_cosine_median": median_cos,
+        "anisotropic": bool(anisotropic),
+        "suspected_random": int(len(suspected_random)),
+        "flagged_sample": flagged[:sample].tolist()
+    }
+    return report, flagged
+
+
+def latency_benchmark(index, num_queries=200, ks=(10, 30), batch_size=64, seed=0):
+    """以库内向量加少量噪声为查询，测单条延迟和批量 QPS"""
+    if index.ntotal == 0:
+        return {}
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(0, index.ntotal, num_queries)
+    queries = index.reconstruct_batch(ids.astype(np.int64))
+    queries = queries + rng.normal(0, 0.01, queries.shape).astype(np.float32)
+    queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    report = {}
+    for k in ks:
+        index.search(queries[:1], k)  # 预热
+        latencies = []
+        for i in range(num_queries):
+            start = time.perf_counter()
+            index.search(queries[i:i + 1], k)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(0, num_queries, batch_size):
+            index.search(queries[i:i + batch_size], k)
+        batch_time = time.perf_counter() - start
+        report[f"k={k}"] = {**latency_summary(latencies),
+                            "batch_qps": num_queries / batch_time if batch_time > 0 else 0.0}
+    return report
+
+
+def inspect(vectorstore, index_dir=None, num_queries=200):
+    index = vectorstore.index
+    health, flagged = vector_health(index)
+    return {
+        "path": index_dir,
+        "ntotal": int(index.ntotal),
+        "dimension": int(index.d),
+        "index_type": type(index).__name__,
+        "docstore_entries": len(vectorstore.docstore._dict),
+        "footprint": footprint(vectorstore, index_dir),
+        "books": book_distribution(vectorstore),
+        "vectors": health,
+        "latency": latency_benchmark(index, num_queries)
+    }, flagged
+
+
+def _mb(value):
+    return f"{value / 1024 / 1024:.1f} MB"
+
+
+def print_report(report):
+    footprint_report, books, vectors = report["footprint"], report["books"], report["vectors"]
+    print("=" * 60)
+    print(f"🔎 索引检查: {report['path'] or '(内存)'}")
+    print("=" * 60)
+    print(f"向量: {report['ntotal']} 条 x {report['dimension']} 维  ({report['index_type']}), "
+          f"文档库 {report['docstore_entries']} 条")
+    print(f"占用: 索引 {_mb(footprint_report['index_bytes'])}（原始向量 {_mb(footprint_report['raw_vector_bytes'])}）, "
+          f"文档库 {_mb(footprint_report['docstore_bytes'])}, 合计 {_mb(footprint_report['total_bytes'])}")
+    for name, size in footprint_report["files"].items():
+        print(f"   - {name}: {_mb(size)}")
+
+    distribution = books["chunks_per_book"]
+    print(f"书籍: {books['books']} 本, 每本文本块 min {distribution['min']} / 中位数 {distribution['median']:.0f} / "
+          f"均值 {distribution['mean']:.2f} / max {distribution['max']}")
+    print(f"   文本块数分布（10 表示 >=10）: {distribution['histogram']}")
+    print(f"   文本块最多: {', '.join(f'{book_id}({count})' for book_id, count in books['top_books'])}")
+    if books["chunks_without_book_id"] or books["placeholder_fields"]:
+        print(f"   ⚠️ 缺少 book_id: {books['chunks_without_book_id']} 条, 占位字段: {books['placeholder_fields']}")
+
+    norm = vectors["norm"]
+    if norm:
+        print(f"向量范数: min {norm['min']:.4f} / mean {norm['mean']:.4f} / max {norm['max']:.4f} (std {norm['std']:.4f}), "
+              f"质心余弦中位数 {vectors['centroid_cosine_median']:.3f}")
+    problems = {
+        "零向量": vectors["zero_vectors"],
+        "NaN/Inf": vectors["non_finite_vectors"],
+        "未归一化": vectors["not_normalized"],
+        "重复向量": vectors["duplicate_vectors"],
+        "疑似随机回退": vectors["suspected_random"]
+    }
+    status = "❌" if vectors["zero_vectors"] or vectors["non_finite_vectors"] or vectors["suspected_random"] else "✅"
+    print(f"{status} 向量健康: " + ", ".join(f"{name} {count}" for name, count in problems.items()))
+    if vectors["flagged_sample"]:
+        print(f"   问题向量示例（序号）: {vectors['flagged_sample']}")
+
+    for name, summary in report["latency"].items():
+        print(f"检索延迟 {name}: p50 {summary['p50_ms']:.3f}ms  p95 {summary['p95_ms']:.3f}ms  "
+              f"p99 {summary['p99_ms']:.3f}ms  批量 QPS {summary['batch_qps']:.0f}")
+
+
+def default_index_dir():
+    from index_versions import read_current
+
+    version = read_current()
+    return os.path.join(Config.INDEX_VERSIONS_DIR, version) if version else Config.FAISS_INDEX_PATH
+
+
+def main():
+    parser = argparse.ArgumentParser(description="索引检查与占用报告")
+    parser.add_argument("path", nargs="?", default=None, help="索引目录，默认当前版本或 Config.FAISS_INDEX_PATH")
+    parser.add_argument("--fake", action="store_true", help="检查替身模式的合成书目索引")
+    parser.add_argument("--queries", type=int, default=200, help="延迟测试的查询数")
+    parser.add_argument("--strict", action="store_true", help="发现零向量、NaN 或疑似随机向量时以非零状态退出")
+    parser.add_argument("--output", default=None, help="报告 JSON 路径")
+    args = parser.parse_args()
+
+    if args.fake:
+        Config.BACKEND_MODE = "fake"
+    from config import create_embeddings
+    embeddings = create_embeddings()
+    if args.fake:
+        from fake_backends import build_fake_vectorstore
+        index_dir = None
+        vectorstore = build_fake_vectorstore(embeddings, Config.FAKE_CATALOG_SIZE, Config.FAKE_SEED)
+    else:
+        from langchain_community.vectorstores import FAISS
+        index_dir = args.path or default_index_dir()
+        vectorstore = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+
+    report, flagged = inspect(vectorstore, index_dir, args.queries)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 报告已保存: {args.output}")
+
+    if args.strict and len(flagged):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
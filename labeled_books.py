@@ -0,0 +1,39 @@
+# labeled_books.py
+"""
+真实作者/书名对
+
+离线检索基准（benchmark.py）用它构造标注查询，替身后端（fake_backends.py）用它生成合成书目的前若干本书。
+"""
+import os
+import re
+
+from config import Config
+
+# 真实的作者/书名对，用作标注查询（另外会合并知识库图书目录中的条目）
+REAL_BOOKS = [
+    ("家", "巴金"), ("春", "巴金"), ("秋", "巴金"), ("寒夜", "巴金"), ("憩园", "巴金"),
+    ("呐喊", "鲁迅"), ("彷徨", "鲁迅"), ("朝花夕拾", "鲁迅"), ("故事新编", "鲁迅"), ("野草", "鲁迅"),
+    ("骆驼祥子", "老舍"), ("四世同堂", "老舍"), ("茶馆", "老舍"), ("龙须沟", "老舍"),
+    ("女神", "郭沫若"), ("屈原", "郭沫若"), ("十批判书", "郭沫若"),
+    ("饮冰室合集", "梁启超"), ("中国历史研究法", "梁启超"), ("清代学术概论", "梁启超"),
+    ("子夜", "茅盾"), ("林家铺子", "茅盾"),
+    ("围城", "钱锺书"), ("管锥编", "钱锺书"),
+    ("边城", "沈从文"), ("湘行散记", "沈从文"),
+    ("雷雨", "曹禺"), ("日出", "曹禺"),
+    ("平凡的世界", "路遥"), ("人生", "路遥"),
+]
+
+
+def load_labeled_books(catalog_path=None):
+    """加载真实作者/书名对：内置列表 + 知识库图书目录"""
+    books = list(REAL_BOOKS)
+    catalog_path = catalog_path or os.path.join(Config.KNOWLEDGE_BASE_PATH, "图书目录.txt")
+
+    if os.path.exists(catalog_path):
+        with open(catalog_path, encoding="utf-8") as f:
+            for line in f:
+                match = re.search(r"《(.+?)》\s*-\s*(.+?)\s*-", line)
+                if match and (match.group(1), match.group(2)) not in books:
+                    books.append((match.group(1), match.group(2)))
+
+    return books
@@ -0,0 +1,235 @@
+# libraries.py
+"""
+多馆（分馆）索引注册表
+
+每个分馆有自己的书目和索引，在 Config.LIBRARIES 中配置:
+    LIBRARIES = {
+        "east": {
+            "index_path": "./libraries/east/faiss_index",           # 不存在时由 books_data_path 构建
+            "books_data_path": "./libraries/east/books.csv",
+            "versions_dir": "./libraries/east/faiss_versions"       # 可选，有 CURRENT 指针时优先并支持热切换
+        }
+    }
+Config.DEFAULT_LIBRARY 对应原有的单索引配置（FAISS_INDEX_PATH / BOOKS_DATA_PATH / INDEX_VERSIONS_DIR），
+启动时加载且常驻内存。
+
+请求用 use_library(名称) 指定分馆，名称保存在 contextvars 中（与 tracing.py 相同），调用方无需逐层传参。
+嵌入客户端、LLM 客户端和各级缓存由所有分馆共享，缓存键包含分馆名。
+其他分馆的索引在第一次被请求时加载；已加载索引的估算内存超过 LIBRARY_MEMORY_BUDGET_MB 时，
+按最近最少使用淘汰其他分馆。被淘汰的索引由 IndexHandle 读者计数保护，进行中的查询结束后才释放。
+"""
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import Config
+
+_current_library = contextvars.ContextVar("current_library", default=None)
+
+
+class UnknownLibrary(ValueError):
+    pass
+
+
+def library_names():
+    return [Config.DEFAULT_LIBRARY] + [name for name in Config.LIBRARIES if name != Config.DEFAULT_LIBRARY]
+
+
+def resolve_library(name=None):
+    """规范化分馆名，None 表示默认分馆；未配置的分馆抛出 UnknownLibrary"""
+    name = name or Config.DEFAULT_LIBRARY
+    if name != Config.DEFAULT_LIBRARY and name not in Config.LIBRARIES:
+        raise UnknownLibrary(f"未知图书馆: {name}")
+    return name
+
+
+def current_library():
+    return _current_library.get() or Config.DEFAULT_LIBRARY
+
+
+@contextmanager
+def use_library(name=None):
+    """在当前上下文中切换分馆；提交到线程池的任务需用 contextvars.copy_context().run(...) 继承"""
+    token = _current_library.set(resolve_library(name))
+    try:
+        yield _current_library.get()
+    finally:
+        _current_library.reset(token)
+
+
+def estimate_bytes(vectorstore, search_index=None):
+    """索引常驻内存的粗略估算（字节）：全维向量 + 低维索引向量 + 文档库文本和元数据"""
+    if vectorstore is None:
+        return 0
+    index = vectorstore.index
+    total = index.ntotal * index.d * 4
+    reduced = getattr(search_index, "reduced_index", None)
+    if reduced is not None:
+        inner = getattr(reduced, "index", reduced)  # IndexPreTransform 的 d 是输入维度，取内层索引
+        total += reduced.ntotal * inner.d * 4
+    for doc in vectorstore.docstore._dict.values():
+        total += len(doc.page_content.encode("utf-8")) + sum(len(str(value)) for value in doc.metadata.values())
+        total += 400  # Document、元数据字典和 id 映射的对象开销
+    return total
+
+
+class LoadedLibrary:
+    __slots__ = ("handle", "bytes", "watcher", "loaded_at")
+
+    def __init__(self, handle, size, watcher=None):
+        self.handle = handle
+        self.bytes = size
+        self.watcher = watcher
+        self.loaded_at = time.time()
+
+
+class LibraryRegistry:
+    """按需加载、LRU 淘汰的分馆索引
+
+    loader(名称) 返回已加载的 IndexHandle；watch(名称, handle) 可返回该分馆的 IndexWatcher（淘汰时停止）。
+    常驻的默认分馆用 pin 登记其内存，计入预算但不会被淘汰。
+    """
+
+    def __init__(self, loader, budget_bytes=0, watch=None):
+        self.loader = loader
+        self.watch = watch
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()  # 名称 -> LoadedLibrary，按最近使用排序
+        self._load_locks = {}         # 名称 -> 锁，同一分馆并发请求只加载一次
+        self._pinned = {}
+        self._counts = {"hits": 0, "loads": 0, "load_errors": 0, "evictions": 0}
+
+    def pin(self, name, size):
+        with self._lock:
+            self._pinned[name] = size
+
+    def _used_bytes(self):
+        return sum(self._pinned.values()) + sum(entry.bytes for entry in self._loaded.values())
+
+    def _acquire_loaded(self, name):
+        """已加载时取得读者引用并更新 LRU 顺序（需持有 _lock）"""
+        entry = self._loaded.get(name)
+        if entry is None:
+            return None
+        self._loaded.move_to_end(name)
+        entry.handle.acquire()
+        return entry.handle
+
+    def acquire(self, name):
+        """取得分馆索引（未加载时在调用线程中加载），使用完毕后必须 release"""
+        with self._lock:
+            handle = self._acquire_loaded(name)
+            if handle is not None:
+                self._counts["hits"] += 1
+                return handle
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                handle = self._acquire_loaded(name)
+                if handle is not None:
+                    self._counts["hits"] += 1
+                    return handle
+
+            start = time.perf_counter()
+            try:
+                handle = self.loader(name)
+            except Exception:
+                with self._lock:
+                    self._counts["load_errors"] += 1
+                raise
+            entry = LoadedLibrary(handle, estimate_bytes(handle.vectorstore, handle.search_index))
+            if self.watch is not None:
+                try:
+                    entry.watcher = self.watch(name, handle)
+                except Exception as e:
+                    print(f"⚠️ 分馆 {name} 的索引版本监视启动失败: {e}")
+
+            with self._lock:
+                self._loaded[name] = entry
+                self._counts["loads"] += 1
+                handle.acquire()
+                evicted = self._evict(keep=name)
+                used = self._used_bytes()
+
+        print(f"📚 已加载分馆 {name} ({handle.vectorstore.index.ntotal} 条, 约 {entry.bytes / 1024 / 1024:.1f} MB, "
+              f"{time.perf_counter() - start:.1f}s)，已用 {used / 1024 / 1024:.1f} MB")
+        if self.budget_bytes > 0 and used > self.budget_bytes:
+            print(f"⚠️ 已加载索引超出内存预算 ({used / 1024 / 1024:.1f} / {self.budget_bytes / 1024 / 1024:.1f} MB)")
+        self._unload(evicted)
+        return handle
+
+    @contextmanager
+    def use(self, name):
+        handle = self.acquire(name)
+        try:
+            yield handle
+        finally:
+            handle.release()
+
+    def replace(self, name, handle):
+        """热切换分馆的索引版本；分馆已被淘汰时丢弃新版本"""
+        size = estimate_bytes(handle.vectorstore, handle.search_index)
+        with self._lock:
+            entry = self._loaded.get(name)
+            if entry is None:
+                old = handle
+            else:
+                old, entry.handle, entry.bytes = entry.handle, handle, size
+            evicted = self._evict(keep=name)
+        if entry is not None:
+            print(f"🔀 分馆 {name} 索引已切换: {old.version} -> {handle.version}")
+        old.retire()
+        self._unload(evicted)
+
+    def _evict(self, keep=None):
+        """超出预算时按 LRU 移出其他分馆（需持有 _lock），返回 [(名称, LoadedLibrary)]"""
+        evicted = []
+        if self.budget_bytes <= 0:
+            return evicted
+        while self._used_bytes() > self.budget_bytes:
+            victim = next((name for name in self._loaded if name != keep), None)
+            if victim is None:
+                break
+            evicted.append((victim, self._loaded.pop(victim)))
+            self._counts["evictions"] += 1
+        return evicted
+
+    def _unload(self, evicted):
+        for name, entry in evicted:
+            if entry.watcher is not None:
+                entry.watcher.stop()
+            print(f"♻️ 淘汰分馆 {name}（约 {entry.bytes / 1024 / 1024:.1f} MB，进行中的查询 {entry.handle.readers} 个）")
+            entry.handle.retire()
+
+    def evict(self, name):
+        """主动卸载一个分馆，返回是否已加载"""
+        with self._lock:
+            entry = self._loaded.pop(name, None)
+        if entry is None:
+            return False
+        self._unload([(name, entry)])
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            entries = list(self._loaded.items())
+            self._loaded.clear()
+        self._unload(entries)
+
+    def stats(self):
+        with self._lock:
+            loaded = [{"name": name, "version": entry.handle.version, "readers": entry.handle.readers,
+                       "mb": entry.bytes / 1024 / 1024, "loaded_at": entry.loaded_at}
+                      for name, entry in self._loaded.items()]
+            return {
+                "configured": library_names(),
+                "pinned": {name: size / 1024 / 1024 for name, size in self._pinned.items()},
+                "loaded": loaded,  # 按最近使用排序，最后一个最近使用
+                "used_mb": self._used_bytes() / 1024 / 1024,
+                "budget_mb": self.budget_bytes / 1024 / 1024,
+                **self._counts
+            }
@@ -1,6 +1,9 @@
-from base_agent import BaseAgent
-from config import LibraryTools, Config
-from langchain_openai import ChatOpenAI
+import time
+from base_agent import BaseAgent, DEFAULT_SESSION
+from config import Config, LibraryTools, create_llm, normalize_query
+from context_packer import count_tokens, effective_budget, pack_context, truncate_to_tokens
+from records import ToolResult, merge_hits, render_task_result
+from tracing import span, traced_invoke
 
 
 class LibraryAgent(BaseAgent):
@@ -11,49 +14,74 @@ class LibraryAgent(BaseAgent):
         self.tools_manager = LibraryTools()
         self.available_tools = {tool.name: tool for tool in self.tools_manager.get_tools()}
 
-        # 初始化LLM - 使用硅基流动API
-        self.llm = ChatOpenAI(
-            api_key=Config.SILICONFLOW_API_KEY,
-            base_url=Config.SILICONFLOW_API_BASE,
-            model=Config.LLM_MODEL,
-            temperature=0.1,
-            max_tokens=1000
-        )
+        # 初始化LLM - 默认使用硅基流动API
+        self.llm = create_llm(max_tokens=1000)
 
-    def execute_task(self, task: dict) -> str:
-        """执行单个任务"""
+    def execute_task(self, task: dict, session_id: str = DEFAULT_SESSION) -> dict:
+        """执行单个任务，返回 {"tool_results": [ToolResult], "hits": [BookHit], "summary": str}"""
         task_type = task["type"]
         description = task["description"]
         tools = task.get("tools", [])
 
-        self.remember(f"执行任务: {description}")
+        self.remember(f"执行任务: {description}", session_id=session_id)
 
         # 根据任务类型选择工具和执行策略
         if tools:
             # 使用工具执行任务
-            results = []
+            tool_results = []
             for tool_name in tools:
                 if tool_name in self.available_tools:
+                    # 从描述中提取查询词，支持中文关键词
+                    query_keywords = self._extract_search_query(description)
                     try:
-                        # 从描述中提取查询词，支持中文关键词
-                        query_keywords = self._extract_search_query(description)
-                        result = self.available_tools[tool_name].func(query_keywords)
-                        results.append(f"【{tool_name} 搜索结果】\n{result}")
+                        with span(f"tool.{tool_name}", query=query_keywords) as s:
+                            result = self.available_tools[tool_name].func(query_keywords)
+                            s.set(hits=len(result.hits))
                     except Exception as e:
-                        results.append(f"工具 {tool_name} 执行出错: {str(e)}")
+                        result = ToolResult(tool_name, query_keywords, error=f"工具 {tool_name} 执行出错: {str(e)}")
+                    tool_results.append(result)
 
+            summary = None
             # 如果是搜索类型的任务，使用LLM进行总结和推荐
-            if task_type in ["search", "recommend"] and results:
-                prompt = self._build_summary_prompt(description, results)
-                llm_result = self.llm.invoke(prompt)
-                results.append(f"【智能总结与推荐】\n{llm_result.content}")
-
-            return "\n\n".join(results)
+            if task_type in ["search", "recommend"] and tool_results:
+                # 提示词只放打包后的结构化书籍列表；没有候选集（如工具出错）时才退回渲染后的工具输出
+                candidates = self._task_candidates(task)
+                fallback = [] if candidates else [r.render() for r in tool_results]
+                prompt, usage = self._build_summary_prompt(
+                    description, [candidates] if candidates else [], fallback
+                )
+                llm_result = traced_invoke(self.llm, prompt, "llm.task_summary", **usage)
+                summary = llm_result.content
+
+            return {
+                "tool_results": tool_results,
+                "hits": merge_hits(r.hits for r in tool_results),
+                "summary": summary
+            }
         else:
             # 无工具任务，使用LLM处理
             prompt = f"请处理以下图书馆相关任务：{description}"
-            llm_result = self.llm.invoke(prompt)
-            return f"任务处理结果:\n{llm_result.content}"
+            llm_result = traced_invoke(self.llm, prompt, "llm.task")
+            return {"tool_results": [], "hits": [], "summary": llm_result.content}
+
+    def _task_candidates(self, task: dict) -> list:
+        """任务检索到的候选集，供多轮追问使用（命中检索缓存，不会重复检索）"""
+        search_tools = {"knowledge_base_search", "book_catalog_search"}
+        if not search_tools.intersection(task.get("tools", [])):
+            return []
+        try:
+            return self.tools_manager.retrieve(self._extract_search_query(task["description"]))
+        except Exception as e:
+            print(f"⚠️ 获取候选集失败: {e}")
+            return []
+
+    def planned_search_queries(self, tasks: list) -> set:
+        """规划中各检索任务实际会检索的（归一化）查询词"""
+        search_tools = {"knowledge_base_search", "book_catalog_search"}
+        return {
+            normalize_query(self._extract_search_query(task.get("description", "")))
+            for task in tasks if search_tools.intersection(task.get("tools", []))
+        }
 
     def _extract_search_query(self, description: str) -> str:
         """从任务描述中提取搜索关键词"""
@@ -64,9 +92,39 @@ class LibraryAgent(BaseAgent):
             query = query.replace(word, "")
         return query.strip()
 
-    def _build_summary_prompt(self, original_query: str, search_results: list) -> str:
-        """构建总结提示词"""
-        results_text = "\n".join(search_results)
+    def _pack_context(self, candidate_groups: list, extra_texts: list, budget: int):
+        """在 token 预算内打包检索结果：先放去重排序后的书籍，剩余预算放其他任务的文本结果"""
+        with span("context.pack", budget=budget) as s:
+            limit = effective_budget(budget)  # 按字符估算 token 时留出余量
+            packed = pack_context(candidate_groups, limit, Config.SUMMARY_PREVIEW_CHARS, Config.SUMMARY_MAX_BOOKS)
+            sections = [packed.text] if packed.text else []
+            remaining = limit - packed.tokens
+            for text in extra_texts:
+                text = truncate_to_tokens(text, remaining)
+                if not text:
+                    break
+                sections.append(text)
+                remaining -= count_tokens(text)
+
+            usage = packed.usage()
+            usage["context_tokens"] = limit - remaining
+            usage["context_budget"] = budget
+            s.set(**usage)
+            return "\n\n".join(sections), usage
+
+    @staticmethod
+    def _report_usage(name: str, prompt: str, usage: dict):
+        usage["prompt_tokens"] = count_tokens(prompt)
+        estimated = "（估算）" if usage.get("tokens_estimated") else ""
+        print(f"📦 {name}: 提示词 {usage['prompt_tokens']} tokens{estimated}，检索结果 "
+              f"{usage['context_tokens']}/{usage['context_budget']} tokens，"
+              f"书籍 {usage['books_included']}/{usage['books_total']} 本")
+
+    def _build_summary_prompt(self, original_query: str, candidate_groups: list, extra_texts: list = ()):
+        """构建总结提示词，返回 (提示词, token 用量)"""
+        results_text, usage = self._pack_context(
+            candidate_groups, list(extra_texts), Config.TASK_SUMMARY_CONTEXT_TOKENS
+        )
 
         prompt = f"""根据用户查询和搜索结果，提供有用的书籍推荐和总结。
 
@@ -83,54 +141,78 @@ class LibraryAgent(BaseAgent):
 
 请用中文回复，保持友好和专业的语气。"""
 
-        return prompt
+        self._report_usage("任务总结", prompt, usage)
+        return prompt, usage
 
     def process_query(self, query: dict, context: dict[str, any] = None) -> dict[str, any]:
         """处理任务执行请求"""
         if "tasks" not in query:
             return self.format_response("错误: 未找到任务信息")
 
-        self.remember(f"接收任务: {len(query['tasks'])}个任务")
+        session_id = (context or {}).get("session_id", DEFAULT_SESSION)
+        self.remember(f"接收任务: {len(query['tasks'])}个任务", session_id=session_id)
 
         # 执行所有任务
+        start_time = time.time()
         task_results = []
+        candidates = []
+        candidate_groups = []
         for i, task in enumerate(query["tasks"]):
-            self.remember(f"开始执行任务 {i + 1}: {task['description']}")
-            result = self.execute_task(task)
+            self.remember(f"开始执行任务 {i + 1}: {task['description']}", session_id=session_id)
+            result = self.execute_task(task, session_id)
             task_results.append({
                 "task_id": i + 1,
                 "description": task["description"],
-                "result": result
+                **result
             })
-            self.remember(f"任务 {i + 1} 完成")
+            task_candidates = self._task_candidates(task)
+            candidates.extend(task_candidates)
+            candidate_groups.append(task_candidates)
+            self.remember(f"任务 {i + 1} 完成", session_id=session_id)
+
+        execution_time = time.time() - start_time
 
         # 汇总结果
-        summary = self.summarize_results(task_results, query.get("original_query", ""))
+        start_time = time.time()
+        summary = self.summarize_results(task_results, query.get("original_query", ""), candidate_groups)
+        summary_time = time.time() - start_time
 
         response = self.format_response(summary, "task_results")
         response.update({
             "task_results": task_results,
+            "books": merge_hits(task["hits"] for task in task_results),
             "summary": summary,
+            "stage_times": {"task_execution": execution_time, "final_summary": summary_time},
+            "candidates": candidates,
             "next_agent": "UserAgent"  # 返回给用户智能体进行总结
         })
 
         return response
 
-    def summarize_results(self, task_results: list[dict], original_query: str) -> str:
-        """汇总任务结果"""
+    def summarize_results(self, task_results: list[dict], original_query: str,
+                          candidate_groups: list = None) -> str:
+        """汇总任务结果
+
+        candidate_groups 为每个任务的检索候选集：检索类任务只把去重后的书籍放进提示词，
+        不再拼接各工具的原始输出和任务级 LLM 总结；其余任务的文本结果在剩余预算内截断放入。
+        """
         if not task_results:
             return "未找到相关信息"
 
-        # 提取所有结果中的关键信息
-        all_results = []
-        for task in task_results:
-            all_results.append(task['result'])
+        candidate_groups = candidate_groups or [[] for _ in task_results]
+        extra_texts = [f"{task['description']}:\n{render_task_result(task)}"
+                       for task, candidates in zip(task_results, candidate_groups) if not candidates]
+        results_text, usage = self._pack_context(
+            [candidates for candidates in candidate_groups if candidates],
+            extra_texts,
+            Config.FINAL_SUMMARY_CONTEXT_TOKENS
+        )
 
         # 使用LLM进行最终总结
         summary_prompt = f"""用户查询：{original_query}
 
 所有搜索结果：
-{"\n".join(all_results)}
+{results_text}
 
 请根据以上信息提供一个简洁、有用的最终回答，包括：
 1. 主要找到的书籍
@@ -138,9 +220,10 @@ class LibraryAgent(BaseAgent):
 3. 下一步建议
 
 用中文回复，保持专业和友好："""
+        self._report_usage("最终总结", summary_prompt, usage)
 
         try:
-            llm_result = self.llm.invoke(summary_prompt)
+            llm_result = traced_invoke(self.llm, summary_prompt, "llm.final_summary", **usage)
             return llm_result.content
         except Exception as e:
             # 如果LLM总结失败，返回简单汇总
@@ -148,6 +231,7 @@ class LibraryAgent(BaseAgent):
             for task in task_results:
                 simple_summary += f"\n{task['description']}:\n"
                 # 显示前200字符
-                preview = task['result'][:200] + "..." if len(task['result']) > 200 else task['result']
+                text = render_task_result(task)
+                preview = text[:200] + "..." if len(text) > 200 else text
                 simple_summary += f"  {preview}\n"
             return simple_summary
\ No newline at end of file
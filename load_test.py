@@ -0,0 +1,182 @@
+# load_test.py
+"""
+端到端压测驱动
+
+使用替身后端（Config.BACKEND_MODE = "fake"）运行 MultiAgentOrchestrator，
+模拟 N 个并发用户，报告吞吐量以及各处理阶段的尾延迟。
+
+示例:
+    python load_test.py --users 16 --requests 20 --llm-latency 0.5 --llm-error-rate 0.05
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from metrics import latency_summary
+
+DEFAULT_QUERIES = [
+    "推荐几本巴金的小说",
+    "鲁迅的作品有哪些？",
+    "找一些历史类的书籍",
+    "老舍的代表作",
+    "郭沫若的诗歌",
+    "梁启超的著作",
+    "关于中国近代史的书",
+    "推荐几本哲学概论",
+]
+
+
+def configure_fake_backend(args):
+    """切换到替身后端并设置注入的延迟和错误率"""
+    Config.BACKEND_MODE = "fake"
+    Config.FAKE_LLM_LATENCY = args.llm_latency
+    Config.FAKE_LLM_LATENCY_JITTER = args.llm_jitter
+    Config.FAKE_LLM_ERROR_RATE = args.llm_error_rate
+    Config.FAKE_EMBED_LATENCY = args.embed_latency
+    Config.FAKE_EMBED_ERROR_RATE = args.embed_error_rate
+    Config.FAKE_CATALOG_SIZE = args.catalog_size
+    Config.FAKE_SEED = args.seed
+    Config.EMBED_COALESCE = not args.no_coalesce
+    Config.EMBED_COALESCE_WINDOW = args.coalesce_window / 1000
+    Config.EMBED_COALESCE_MAX_BATCH = args.coalesce_max_batch
+    Config.WARMUP_ENABLED = args.warmup  # 默认冷启动，便于各版本之间对比
+
+
+def run_load(orchestrator, queries, users, requests_per_user, think_time=0.0, seed=42):
+    """运行压测，返回每个请求的记录列表和总耗时"""
+    records = []
+    lock = threading.Lock()
+
+    def user_loop(user_id):
+        rng = random.Random(seed + user_id)
+        for _ in range(requests_per_user):
+            query = rng.choice(queries)
+            start = time.perf_counter()
+            # 每个虚拟用户使用独立会话，否则所有请求共用默认会话，多轮状态相互干扰
+            result = orchestrator.process_user_query(query, f"load-test-{user_id}")
+            latency = time.perf_counter() - start
+
+            with lock:
+                records.append({
+                    "user": user_id,
+                    "query": query,
+                    "latency": latency,
+                    "stage_times": result.get("stage_times", {}),
+                    "spans": [(span["name"], span["duration_ms"] / 1000)
+                              for span in result.get("trace", {}).get("spans", [])],
+                    "error": result.get("error")
+                })
+
+            if think_time > 0:
+                time.sleep(rng.uniform(0, 2 * think_time))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        for future in [executor.submit(user_loop, user_id) for user_id in range(users)]:
+            future.result()
+    return records, time.perf_counter() - start
+
+
+def build_report(records, wall_time, users):
+    """汇总吞吐量、错误率、总延迟和各阶段延迟"""
+    stage_latencies = {}
+    span_latencies = {}
+    for record in records:
+        for stage, duration in record["stage_times"].items():
+            stage_latencies.setdefault(stage, []).append(duration)
+        for name, duration in record["spans"]:
+            span_latencies.setdefault(name, []).append(duration)
+
+    errors = [record for record in records if record["error"]]
+    return {
+        "users": users,
+        "requests": len(records),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(records) if records else 0.0,
+        "wall_time_s": wall_time,
+        "throughput_rps": len(records) / wall_time if wall_time > 0 else 0.0,
+        "total": latency_summary([record["latency"] for record in records]),
+        "stages": {stage: latency_summary(values) for stage, values in stage_latencies.items()},
+        "spans": {name: latency_summary(values) for name, values in span_latencies.items()}
+    }
+
+
+def print_report(report):
+    print("=" * 60)
+    print(f"📈 压测结果: {report['users']} 并发用户, {report['requests']} 个请求")
+    print("=" * 60)
+    print(f"吞吐量: {report['throughput_rps']:.2f} 请求/秒   总耗时: {report['wall_time_s']:.2f}秒")
+    print(f"错误: {report['errors']} ({report['error_rate']:.1%})")
+    print(f"{'阶段':<28}{'次数':>8}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}{'max(ms)':>12}")
+    rows = [("total", report["total"])] + list(report["stages"].items()) + list(report["spans"].items())
+    for stage, summary in rows:
+        print(f"{stage:<28}{summary['count']:>8}{summary['p50_ms']:>12.1f}{summary['p95_ms']:>12.1f}"
+              f"{summary['p99_ms']:>12.1f}{summary['max_ms']:>12.1f}")
+
+    speculation = report.get("speculation")
+    if speculation and speculation["enabled"]:
+        print(f"推测检索: 命中 {speculation['hits']}/{speculation['attempts']} ({speculation['hit_rate']:.1%})")
+
+    coalescer = report.get("embedding_coalescer")
+    if coalescer:
+        delay = coalescer["queue_delay"]
+        print(f"查询嵌入合并: {coalescer['requests']} 条请求 / {coalescer['batches']} 批, "
+              f"平均批大小 {coalescer['mean_batch_size']:.2f}, 批大小分布 {coalescer['batch_sizes']}")
+        print(f"合并等待: p50 {delay['p50_ms']:.1f}ms  p95 {delay['p95_ms']:.1f}ms  max {delay['max_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测（替身后端）")
+    parser.add_argument("--users", type=int, default=8, help="并发用户数")
+    parser.add_argument("--requests", type=int, default=10, help="每个用户的请求数")
+    parser.add_argument("--think-time", type=float, default=0.0, help="用户两次请求间的平均间隔（秒）")
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--llm-jitter", type=float, default=0.05)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--embed-latency", type=float, default=0.02)
+    parser.add_argument("--embed-error-rate", type=float, default=0.0)
+    parser.add_argument("--coalesce-window", type=float, default=Config.EMBED_COALESCE_WINDOW * 1000,
+                        help="查询嵌入合并窗口（毫秒）")
+    parser.add_argument("--coalesce-max-batch", type=int, default=Config.EMBED_COALESCE_MAX_BATCH)
+    parser.add_argument("--no-coalesce", action="store_true", help="关闭查询嵌入合并")
+    parser.add_argument("--catalog-size", type=int, default=Config.FAKE_CATALOG_SIZE)
+    parser.add_argument("--seed", type=int, default=Config.FAKE_SEED)
+    parser.add_argument("--warmup", action="store_true", help="压测前完成启动预热（示例查询 + 查询日志）")
+    parser.add_argument("--verbose", action="store_true", help="显示协调器的逐请求日志")
+    parser.add_argument("--output", default=None, help="结果 JSON 路径")
+    args = parser.parse_args()
+
+    configure_fake_backend(args)
+
+    from orchestrator import MultiAgentOrchestrator
+    orchestrator = MultiAgentOrchestrator()
+    if orchestrator.warmer is not None:
+        orchestrator.warmer.wait()
+
+    print(f"🚀 开始压测: {args.users} 用户 x {args.requests} 请求")
+    log_sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with log_sink:
+        records, wall_time = run_load(orchestrator, DEFAULT_QUERIES, args.users, args.requests,
+                                      args.think_time, args.seed)
+
+    report = build_report(records, wall_time, args.users)
+    coalescer = orchestrator.library_agent.tools_manager.embeddings.coalescer
+    if coalescer is not None:
+        report["embedding_coalescer"] = coalescer.stats()
+    report["speculation"] = orchestrator.speculation_stats()
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import sys
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+
+
+def default_summarizer(entries, max_chars=200):
+    """基于规则的压缩：保留每条记忆的开头部分"""
+    parts = [f"{entry['agent']}: {entry['message'][:30]}" for entry in entries]
+    return f"[已压缩 {len(entries)} 条] " + "; ".join(parts)[:max_chars]
+
+
+class SessionMemory:
+    """单个会话的记忆
+
+    固定容量的环形缓冲区；写满时若开启压缩，则将最早的若干条合并为一条摘要，
+    摘要本身也只保留最近的若干条，因此整体占用有上界。
+    """
+
+    def __init__(self, max_entries=50, compaction=True, compact_batch=10, max_summaries=5,
+                 summarizer=None, summary_chars=200):
+        self.entries = deque(maxlen=max_entries)
+        self.summaries = deque(maxlen=max_summaries)
+        self.compaction = compaction
+        self.compact_batch = max(1, min(compact_batch, max_entries))
+        self.summarizer = summarizer or default_summarizer
+        self.summary_chars = summary_chars
+        self.evicted = 0
+        self.compactions = 0
+        self._lock = threading.Lock()
+
+    def append(self, entry):
+        with self._lock:
+            if len(self.entries) == self.entries.maxlen:
+                if self.compaction:
+                    self._compact()
+                else:
+                    self.evicted += 1  # deque 会自动丢弃最早的一条
+            self.entries.append(entry)
+
+    def _compact(self):
+        old_entries = [self.entries.popleft() for _ in range(self.compact_batch)]
+        try:
+            message = self.summarizer(old_entries, self.summary_chars)
+        except Exception:
+            message = default_summarizer(old_entries, self.summary_chars)
+
+        if len(self.summaries) == self.summaries.maxlen:
+            self.evicted += self.summaries[0]["count"]
+        self.summaries.append({"agent": "summary", "message": message, "count": len(old_entries)})
+        self.compactions += 1
+
+    def recent(self, n=5):
+        """最近 n 条记忆，耗时只与 n 有关"""
+        with self._lock:
+            latest = list(islice(reversed(self.entries), n))
+        latest.reverse()
+        return latest
+
+    def footprint(self):
+        """记忆占用统计（字节数为字符串和容器的近似值）"""
+        with self._lock:
+            items = list(self.entries) + list(self.summaries)
+        approx_bytes = sys.getsizeof(self.entries) + sys.getsizeof(self.summaries)
+        approx_bytes += sum(sys.getsizeof(item) + sys.getsizeof(item["message"]) for item in items)
+        return {
+            "entries": len(self.entries),
+            "capacity": self.entries.maxlen,
+            "summaries": len(self.summaries),
+            "compactions": self.compactions,
+            "evicted": self.evicted,
+            "approx_bytes": approx_bytes
+        }
+
+
+class MemoryStore:
+    """按会话隔离的记忆存储，会话数超过上限时淘汰最久未使用的会话"""
+
+    def __init__(self, max_sessions=1000, **session_options):
+        self.max_sessions = max_sessions
+        self.session_options = session_options
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted_sessions = 0
+
+    def session(self, session_id):
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is None:
+                memory = SessionMemory(**self.session_options)
+                self._sessions[session_id] = memory
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evicted_sessions += 1
+            else:
+                self._sessions.move_to_end(session_id)
+            return memory
+
+    def drop(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        footprints = [memory.footprint() for memory in sessions]
+        return {
+            "sessions": len(sessions),
+            "max_sessions": self.max_sessions,
+            "evicted_sessions": self.evicted_sessions,
+            "entries": sum(f["entries"] for f in footprints),
+            "summaries": sum(f["summaries"] for f in footprints),
+            "compactions": sum(f["compactions"] for f in footprints),
+            "evicted_entries": sum(f["evicted"] for f in footprints),
+            "approx_bytes": sum(f["approx_bytes"] for f in footprints)
+        }
@@ -1,45 +1,260 @@
 import time
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from user_agent import UserAgent  # 确保导入修复后的UserAgent
 from library_agent import LibraryAgent
+from config import Config, normalize_query
+from base_agent import DEFAULT_SESSION
+from conversation import ConversationState, parse_refinement, render_followup
+from records import BookHit
+from tracing import start_trace, export_trace, span
+from cache import LRUCache
+from libraries import current_library, resolve_library, use_library
+from query_log import build_record, create_query_logger
+from warmup import WARMUP_SESSION_PREFIX, start_warmup
+from context_packer import load_tokenizer
 
 
 class MultiAgentOrchestrator:
     """多智能体协调器 - 完整版"""
 
     def __init__(self):
-        self.conversation_history = []
+        self.conversation_history = OrderedDict()  # session_id（非默认分馆为 分馆:session_id）-> ConversationState
+        self._history_lock = threading.Lock()
         self.user_agent = UserAgent()
         self.library_agent = LibraryAgent()
+        self._speculation_pool = ThreadPoolExecutor(
+            max_workers=Config.SPECULATIVE_WORKERS, thread_name_prefix="speculative-retrieval"
+        ) if Config.SPECULATIVE_RETRIEVAL else None
+        self._speculation_lock = threading.Lock()
+        self._speculation_counts = {"attempts": 0, "hits": 0, "misses": 0, "errors": 0}
+        self.answer_cache = LRUCache(Config.ANSWER_CACHE_SIZE)
+        self.query_log = create_query_logger()
         print("✅ 多智能体系统初始化完成")
 
-    def process_user_query(self, query: str) -> dict:
-        """处理用户查询"""
+        load_tokenizer()  # 摘要提示词的 token 计数，在启动时而不是首个请求中加载
+        self.warmer = None
+        if Config.WARMUP_ENABLED:
+            try:
+                self.warmer = start_warmup(self)
+            except Exception as e:
+                print(f"⚠️ 预热启动失败: {e}")
+
+    def _conversation(self, session_id: str) -> ConversationState:
+        """获取会话的多轮状态，超出上限时淘汰最久未使用的会话"""
+        with self._history_lock:
+            state = self.conversation_history.get(session_id)
+            if state is None:
+                state = ConversationState()
+                self.conversation_history[session_id] = state
+                while len(self.conversation_history) > Config.CONVERSATION_MAX_SESSIONS:
+                    self.conversation_history.popitem(last=False)
+            else:
+                self.conversation_history.move_to_end(session_id)
+            return state
+
+    def _start_speculation(self, query: str):
+        """与意图 LLM 调用并行，按原始查询提前做嵌入和 FAISS 检索（结果进入检索缓存）
+
+        检索词与任务执行时一样用 _extract_search_query 从文本中提取，归一化后作为核对规划结果的键。
+        检索缓存关闭时推测结果无处复用，不做推测。
+        """
+        tools = self.library_agent.tools_manager
+        if self._speculation_pool is None or tools.retrieval_cache.maxsize <= 0:
+            return None
+
+        text = self.library_agent._extract_search_query(query)
+        key = normalize_query(text)
+
+        def speculate():
+            with span("speculative_retrieval", query=key):
+                return tools.retrieve(text)
+
+        # 复制上下文，后台线程中的 Span 记入当前 Trace
+        future = self._speculation_pool.submit(contextvars.copy_context().run, speculate)
+        return key, future
+
+    def _settle_speculation(self, speculation, tasks: list) -> bool:
+        """规划完成后核对推测：检索词一致时等待推测检索完成，后续工具调用直接命中缓存
+
+        结果确实进入了检索缓存才算命中；分片缺失等不完整结果不缓存，计为未命中。
+        """
+        key, future = speculation
+        hit = key in self.library_agent.planned_search_queries(tasks)
+        with span("speculation.settle", hit=hit) as s:
+            if hit:
+                try:
+                    future.result()
+                    hit = self.library_agent.tools_manager.is_retrieval_cached(key)
+                    s.set(hit=hit)
+                except Exception as e:
+                    hit = False
+                    s.set(hit=False, error=str(e))
+                    with self._speculation_lock:
+                        self._speculation_counts["errors"] += 1
+            # 未命中时推测检索在后台自然结束，结果留在缓存中，不阻塞本次请求
+
+        with self._speculation_lock:
+            self._speculation_counts["attempts"] += 1
+            self._speculation_counts["hits" if hit else "misses"] += 1
+        return hit
+
+    def speculation_stats(self) -> dict:
+        """推测检索命中率"""
+        with self._speculation_lock:
+            stats = dict(self._speculation_counts)
+        stats["enabled"] = self._speculation_pool is not None
+        stats["hit_rate"] = stats["hits"] / stats["attempts"] if stats["attempts"] else 0.0
+        return stats
+
+    def process_user_query(self, query: str, session_id: str = DEFAULT_SESSION, library: str = None,
+                           deadline: float = None) -> dict:
+        """处理用户查询，结果中附带本次查询的 Trace
+
+        library 指定分馆（None 为默认分馆，未配置的分馆抛出 libraries.UnknownLibrary）；
+        各分馆的多轮对话状态相互独立。
+        deadline 为 time.monotonic() 时刻，意图规划结束后已超过时跳过任务执行，返回超时错误。
+        会话中已有上一轮候选集时，追问（更多/按年份筛选/排序）直接在候选集上处理。
+        会话锁只保护多轮状态的读取和更新，新查询的 LLM 调用和检索不持有锁，同一会话的请求可以并发。
+        """
+        start_time = time.perf_counter()
+        library = resolve_library(library)
+        with use_library(library), start_trace("process_user_query", query=query, library=library) as trace:
+            state = self._conversation(session_id if library == Config.DEFAULT_LIBRARY else f"{library}:{session_id}")
+            with state.lock:
+                refinement = parse_refinement(query, state.candidates) if state.candidates else None
+                if refinement:
+                    result = self._answer_followup(query, state, refinement, session_id)
+            if not refinement:
+                result = self._answer_new_query(query, session_id, deadline)
+                candidates = result.pop("candidates", [])
+                if candidates:
+                    with state.lock:
+                        state.reset(query, candidates)
+
+        if self.query_log is not None and not session_id.startswith(WARMUP_SESSION_PREFIX):
+            self.query_log.log(build_record(query, session_id, result, time.perf_counter() - start_time, library))
+
+        result["trace"] = trace.to_dict()
+        if Config.TRACE_EXPORT_PATH:
+            try:
+                export_trace(result["trace"], Config.TRACE_EXPORT_PATH)
+            except Exception as e:
+                print(f"⚠️ Trace 导出失败: {e}")
+        return result
+
+    def _answer_followup(self, query: str, state: ConversationState, refinement: dict, session_id: str) -> dict:
+        """在上一轮候选集上回答追问，不调用意图 LLM，也不重新检索"""
+        print(f"\n=== 追问: {query}（基于上一轮: {state.query}）===")
+        start_time = time.time()
+        self.user_agent.remember(f"追问: {query}", session_id=session_id)
+
+        with span("conversation.followup", pool_size=len(state.candidates)) as s:
+            page, filters, total = state.refine(
+                refinement,
+                page_size=Config.FOLLOWUP_PAGE_SIZE,
+                embed_query=self.library_agent.tools_manager.embeddings.embed_query
+            )
+            s.set(matched=total, returned=len(page))
+        answer = render_followup(page, filters, total, len(state.candidates))
+        books = [BookHit.from_candidate(candidate) for candidate in page]
+
+        return {
+            "final_answer": answer,
+            "conversation_steps": 1,
+            "processing_time": time.time() - start_time,
+            "stage_times": {"followup": time.time() - start_time},
+            "followup": True,
+            "books": books,
+            "task_results": [{
+                "task_id": 1,
+                "description": f"在上一轮「{state.query}」的结果中筛选",
+                "tool_results": [],
+                "hits": books,
+                "summary": answer
+            }]
+        }
+
+    def _answer_new_query(self, query: str, session_id: str, deadline: float = None) -> dict:
+        """新查询：回答缓存开启时按归一化查询复用完整结果（命中时不调用 LLM，也不写入智能体记忆）
+
+        缓存键包含索引版本，索引热切换（包括分馆淘汰后以新版本重新加载）后旧回答不会再被命中。
+        """
+        if self.answer_cache.maxsize <= 0:
+            return self._run_pipeline(query, session_id, deadline)
+
+        version = self.library_agent.tools_manager.index_version()
+        key = (current_library(), version, normalize_query(query))
+        with span("answer_cache", query=key[2], index_version=version) as s:
+            cached = self.answer_cache.get(key)
+            s.set(hit=cached is not None)
+        if cached is not None:
+            return {**cached, "answer_cache_hit": True, "processing_time": 0.0, "stage_times": {}}
+
+        result = self._run_pipeline(query, session_id, deadline)
+        if "error" not in result and result.get("books"):
+            self.answer_cache.put(key, dict(result))
+        return result
+
+    def _run_pipeline(self, query: str, session_id: str, deadline: float = None) -> dict:
+        """执行意图规划和任务执行流水线"""
         print(f"\n=== 开始处理用户查询 ===")
         print(f"用户查询: {query}")
 
         steps = 0
         start_time = time.time()
+        stage_times = {}
 
         try:
             # 步骤1: 用户智能体分析意图和规划任务
             steps += 1
             print("--- 用户智能体规划任务 ---")
-            user_response = self.user_agent.process_query(query)
+            stage_start = time.time()
+            context = {"session_id": session_id}
+            speculation = self._start_speculation(query)
+            user_response = self.user_agent.process_query(query, context)
+            stage_times["intent_planning"] = time.time() - stage_start
+
+            speculation_hit = None
+            if speculation is not None:
+                stage_start = time.time()
+                speculation_hit = self._settle_speculation(speculation, user_response.get("tasks") or [])
+                stage_times["speculation_wait"] = time.time() - stage_start
 
             if "tasks" not in user_response or not user_response["tasks"]:
                 return {
                     "final_answer": "抱歉，我没有理解您的需求。请尝试更具体地描述您想找什么书籍。",
                     "conversation_steps": steps,
                     "processing_time": time.time() - start_time,
-                    "task_results": []
+                    "stage_times": stage_times,
+                    "task_results": [],
+                    "books": [],
+                    "speculation_hit": speculation_hit
                 }
 
             print(f"规划任务: {len(user_response['tasks'])}个")
 
+            if deadline is not None and time.monotonic() > deadline:
+                # 调用方已按超时返回，不再执行任务和总结，尽早释放工作线程
+                print("⏱️ 已超过请求期限，跳过任务执行")
+                return {
+                    "final_answer": "请求处理超时，请稍后重试。",
+                    "error": "请求处理超时",
+                    "conversation_steps": steps,
+                    "processing_time": time.time() - start_time,
+                    "stage_times": stage_times,
+                    "task_results": [],
+                    "books": [],
+                    "speculation_hit": speculation_hit
+                }
+
             # 步骤2: 图书馆智能体执行任务
             steps += 1
             print("--- 图书馆智能体执行任务 ---")
-            library_response = self.library_agent.process_query(user_response)
+            library_response = self.library_agent.process_query(user_response, context)
+            stage_times.update(library_response.get("stage_times", {}))
 
             # 步骤3: 生成最终回答
             steps += 1
@@ -56,15 +271,22 @@ class MultiAgentOrchestrator:
                 "final_answer": final_answer,
                 "conversation_steps": steps,
                 "processing_time": time.time() - start_time,
+                "stage_times": stage_times,
                 "task_results": library_response.get("task_results", []),
-                "task_details": library_response.get("task_results", [])
+                "task_details": library_response.get("task_results", []),
+                "books": library_response.get("books", []),
+                "speculation_hit": speculation_hit,
+                "candidates": library_response.get("candidates", [])
             }
 
         except Exception as e:
             print(f"❌ 处理过程出错: {e}")
             return {
                 "final_answer": f"处理过程中出现错误: {str(e)}",
+                "error": str(e),
                 "conversation_steps": steps,
                 "processing_time": time.time() - start_time,
-                "task_results": []
+                "stage_times": stage_times,
+                "task_results": [],
+                "books": []
             }
\ No newline at end of file
@@ -0,0 +1,111 @@
+# query_log.py
+"""
+查询日志
+
+每次查询结束后把一条记录放入有界队列，由后台线程批量追加写入 JSON lines 文件，
+请求线程不做任何磁盘 I/O；队列满时丢弃记录并计数，不阻塞请求。
+
+每行记录:
+    ts              查询完成时间（Unix 时间戳）
+    query_hash      归一化查询的 sha1（前 16 位），便于聚合同一查询的不同写法
+    query           原始查询文本
+    session         会话 ID 的哈希
+    library         分馆名
+    plan            规划出的任务描述
+    stage_times     各阶段耗时（秒）
+    latency         总耗时（秒）
+    book_ids        返回的书籍 ID
+    followup / speculation_hit / answer_cache_hit / error
+
+replay.py 可按原始节奏或缩放后的 QPS 重放日志；warmup.py 从日志中取高频查询预热。
+"""
+import hashlib
+import json
+import queue
+import threading
+import time
+
+from config import Config, normalize_query
+
+
+def query_hash(query):
+    return hashlib.sha1(normalize_query(query).encode("utf-8")).hexdigest()[:16]
+
+
+def _book_id(book):
+    return str(book.get("book_id", "")) if isinstance(book, dict) else getattr(book, "book_id", "")
+
+
+def build_record(query, session_id, result, latency, library=None):
+    """由 process_user_query 的结果构建日志记录"""
+    return {
+        "ts": round(time.time(), 3),
+        "query_hash": query_hash(query),
+        "query": query,
+        "session": hashlib.sha1(str(session_id).encode("utf-8")).hexdigest()[:12],
+        "library": library or Config.DEFAULT_LIBRARY,
+        "plan": [task.get("description", "") for task in result.get("task_results", [])],
+        "stage_times": {stage: round(duration, 4) for stage, duration in result.get("stage_times", {}).items()},
+        "latency": round(latency, 4),
+        "book_ids": [_book_id(book) for book in result.get("books", [])],
+        "followup": bool(result.get("followup")),
+        "speculation_hit": result.get("speculation_hit"),
+        "answer_cache_hit": bool(result.get("answer_cache_hit")),
+        "error": result.get("error")
+    }
+
+
+class QueryLogger:
+    """异步 JSON lines 写入器"""
+
+    def __init__(self, path, queue_size=10000, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="query-log")
+        self._thread.start()
+
+    def log(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while not (self._closed.is_set() and self._queue.empty()):
+                try:
+                    batch = [self._queue.get(timeout=self.flush_interval)]
+                except queue.Empty:
+                    continue
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch))
+                f.flush()
+                with self._lock:
+                    self.written += len(batch)
+
+    def close(self, timeout=5.0):
+        """写完队列中剩余的记录后停止"""
+        self._closed.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"path": self.path, "written": self.written, "dropped": self.dropped,
+                    "pending": self._queue.qsize()}
+
+
+def create_query_logger():
+    """按 Config.QUERY_LOG_PATH 创建日志写入器，未配置时返回 None"""
+    if not Config.QUERY_LOG_PATH:
+        return None
+    return QueryLogger(Config.QUERY_LOG_PATH, Config.QUERY_LOG_QUEUE_SIZE)
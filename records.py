@@ -0,0 +1,138 @@
+"""
+工具、智能体和界面之间传递的结构化检索结果
+
+检索工具返回 ToolResult（内含 BookHit 列表），经 LibraryAgent、协调器一路原样传递，
+只在界面、提示词、命令行输出等边缘处渲染为文本。书籍按 book_id 精确去重。
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+PREVIEW_CHARS = 100
+
+
+@dataclass(slots=True, frozen=True)
+class BookHit:
+    """一条书籍检索结果"""
+    book_id: str
+    title: str
+    author: str
+    year: str
+    score: float
+    publisher: str = "未知出版社"
+    preview: str = ""
+
+    @classmethod
+    def from_candidate(cls, candidate, preview_chars=PREVIEW_CHARS):
+        """由 LibraryTools.retrieve 的候选构建"""
+        doc = candidate["doc"]
+        metadata = doc.metadata
+        content = doc.page_content
+        return cls(
+            book_id=str(metadata.get("book_id", candidate.get("index_id", ""))),
+            title=metadata.get("title", "无题名"),
+            author=metadata.get("author", "未知作者"),
+            year=metadata.get("year", "未知年份"),
+            score=float(candidate["score"]),
+            publisher=metadata.get("publisher", "未知出版社"),
+            preview=content[:preview_chars] + "..." if len(content) > preview_chars else content
+        )
+
+    def label(self) -> str:
+        return f"《{self.title}》 - {self.author}"
+
+    def render(self) -> str:
+        """多行文本：书名、作者、出版社、出版年、简介"""
+        text = f"《{self.title}》\n   作者: {self.author}"
+        if self.publisher != "未知出版社":
+            text += f"\n   出版社: {self.publisher}"
+        if self.year != "未知年份":
+            text += f"\n   出版年: {self.year}"
+        if self.preview:
+            text += f"\n   简介: {self.preview}"
+        return text
+
+    def to_dict(self) -> dict:
+        return {
+            "book_id": self.book_id,
+            "title": self.title,
+            "author": self.author,
+            "year": self.year,
+            "publisher": self.publisher,
+            "score": round(self.score, 6)
+        }
+
+
+@dataclass(slots=True)
+class ToolResult:
+    """一次检索工具调用的结果"""
+    tool: str
+    query: str
+    hits: List[BookHit] = field(default_factory=list)
+    error: Optional[str] = None
+
+    def render(self) -> str:
+        if self.error:
+            return self.error
+        if not self.hits:
+            return "未找到相关书籍"
+        if self.tool == "book_catalog_search":
+            return _render_catalog(self)
+        return "\n\n".join(hit.render() for hit in self.hits)
+
+    def to_dict(self) -> dict:
+        return {
+            "tool": self.tool,
+            "query": self.query,
+            "hits": [hit.to_dict() for hit in self.hits],
+            "error": self.error
+        }
+
+
+def _catalog_category(query: str) -> str:
+    if "小说" in query or "文学" in query:
+        return "文学小说"
+    if "历史" in query:
+        return "历史"
+    if "科学" in query or "技术" in query:
+        return "科学技术"
+    return "其他"
+
+
+def _render_catalog(result: ToolResult) -> str:
+    """图书目录工具的渲染方式：按作者分组（最多3个作者，每人3本），再按类别列出"""
+    author_books = {}
+    for hit in result.hits:
+        author_books.setdefault(hit.author, []).append(f"《{hit.title}》({hit.year})")
+
+    lines = ["按作者分类:"]
+    for author, books in list(author_books.items())[:3]:
+        lines.append(f"  {author}: {', '.join(books[:3])}")
+    lines.append("\n按类别分类:")
+    lines.append(f"  {_catalog_category(result.query)}: {', '.join(hit.label() for hit in result.hits[:3])}")
+    return "\n".join(lines)
+
+
+def merge_hits(hit_lists) -> List[BookHit]:
+    """按 book_id 精确去重合并多组结果，同一本书保留最高分，按分数降序"""
+    books = {}
+    for hits in hit_lists:
+        for hit in hits:
+            best = books.get(hit.book_id)
+            if best is None or hit.score > best.score:
+                books[hit.book_id] = hit
+    return sorted(books.values(), key=lambda hit: hit.score, reverse=True)
+
+
+def render_task_result(task: dict) -> str:
+    """任务结果渲染为文本：各工具结果 + 智能总结"""
+    sections = [f"【{result.tool} 搜索结果】\n{result.render()}" for result in task.get("tool_results", [])]
+    if task.get("summary"):
+        title = "智能总结与推荐" if sections else "任务处理结果"
+        sections.append(f"【{title}】\n{task['summary']}")
+    return "\n\n".join(sections)
+
+
+def to_jsonable(obj):
+    """json.dumps 的 default：结构化结果转 dict，其余转字符串"""
+    to_dict = getattr(obj, "to_dict", None)
+    return to_dict() if callable(to_dict) else str(obj)
@@ -0,0 +1,111 @@
+"""
+降维检索 + 全维重排
+
+bge-m3 向量为 1024 维，检索时每次距离计算和每条存储向量都按 1024 维计。这里在建索引时
+学习一个投影（PCA，或 Matryoshka 方式直接截取前若干维），在低维空间（默认 256 维）中
+检索 k * rerank_factor 个候选，再从原始全维索引中取回这些候选的向量精确计算距离并重排。
+
+投影和低维向量一起保存为 faiss IndexPreTransform（投影 -> L2 归一化 -> Flat），
+与原索引放在同一目录下，原索引内容或降维配置变化时自动重建。
+"""
+import hashlib
+import json
+import os
+
+import faiss
+import numpy as np
+
+REDUCED_INDEX_FILE = "reduced.faiss"
+REDUCED_META_FILE = "reduced.json"
+METHODS = ("pca", "matryoshka")
+
+
+def build_reduced_index(vectors, dim, method="pca", train_size=20000, seed=0):
+    """在全维向量上训练投影并建立低维索引"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    full_dim = vectors.shape[1]
+    if method not in METHODS:
+        raise ValueError(f"未知的降维方式: {method}")
+    dim = min(dim, full_dim)
+
+    if method == "pca":
+        index = faiss.index_factory(full_dim, f"PCA{dim},L2norm,Flat")
+        if len(vectors) > train_size:
+            sample = np.random.default_rng(seed).choice(len(vectors), train_size, replace=False)
+            index.train(vectors[np.sort(sample)])
+        else:
+            index.train(vectors)
+    else:
+        # Matryoshka 训练的模型前若干维本身就是有效的低维表示，只需截取并重新归一化
+        index = faiss.IndexPreTransform(faiss.NormalizationTransform(dim), faiss.IndexFlatL2(dim))
+        index.prepend_transform(faiss.RemapDimensionsTransform(full_dim, dim, False))
+
+    index.add(vectors)
+    return index
+
+
+class RerankedIndex:
+    """低维索引检索候选，全维索引重排；search 的接口和返回值与 faiss 索引一致（平方 L2 距离）"""
+
+    def __init__(self, full_index, reduced_index, rerank_factor=4):
+        self.full_index = full_index
+        self.reduced_index = reduced_index
+        self.rerank_factor = rerank_factor
+        self.d = full_index.d
+
+    @property
+    def ntotal(self):
+        return self.full_index.ntotal
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.rerank_factor <= 0:
+            # 不重排：返回低维空间中的距离，仅用于对比召回率
+            return self.reduced_index.search(queries, k)
+
+        fetch = min(self.ntotal, k * self.rerank_factor)
+        _, candidate_ids = self.reduced_index.search(queries, fetch)
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, candidates) in enumerate(zip(queries, candidate_ids)):
+            candidates = candidates[candidates >= 0]
+            if len(candidates) == 0:
+                continue
+            vectors = self.full_index.reconstruct_batch(candidates)
+            exact = ((vectors - query) ** 2).sum(axis=1)
+            order = np.argsort(exact)[:k]
+            distances[row, :len(order)] = exact[order]
+            ids[row, :len(order)] = candidates[order]
+        return distances, ids
+
+
+def _fingerprint(full_index, sample=64):
+    """全维索引首尾若干向量的哈希，条数相同但内容已重建时也能发现"""
+    ntotal = full_index.ntotal
+    head = full_index.reconstruct_n(0, min(sample, ntotal))
+    tail = full_index.reconstruct_n(max(0, ntotal - sample), min(sample, ntotal))
+    return hashlib.sha1(head.tobytes() + tail.tobytes()).hexdigest()
+
+
+def load_or_build(full_index, index_dir, dim, method="pca", train_size=20000):
+    """加载目录中的低维索引；不存在或与全维索引/配置不一致时重建。index_dir 为 None 时只在内存中构建"""
+    meta = {"method": method, "dim": min(dim, full_index.d), "ntotal": int(full_index.ntotal),
+            "fingerprint": _fingerprint(full_index)}
+
+    if index_dir:
+        index_path = os.path.join(index_dir, REDUCED_INDEX_FILE)
+        meta_path = os.path.join(index_dir, REDUCED_META_FILE)
+        if os.path.exists(index_path) and os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                if json.load(f) == meta:
+                    return faiss.read_index(index_path)
+
+    vectors = full_index.reconstruct_n(0, full_index.ntotal)
+    reduced = build_reduced_index(vectors, dim, method, train_size)
+
+    if index_dir:
+        faiss.write_index(reduced, index_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+    return reduced
@@ -1,100 +1,168 @@
 # regenerate_embeddings.py
+import argparse
+import hashlib
+import json
 import os
+import threading
 import pandas as pd
 import numpy as np
-import requests
 import time
-from config import Config, SiliconFlowEmbeddings
+from concurrent.futures import ThreadPoolExecutor
+from config import Config, SiliconFlowEmbeddings, create_embeddings, dedup_for_index
 
 
-def regenerate_book_embeddings():
-    """重新生成书籍嵌入向量"""
-    print("🔄 开始重新生成书籍嵌入向量...")
-
-    # 读取原始数据
-    try:
-        df = pd.read_csv("book_embeddings.csv", encoding="utf-8-sig")
-        print(f"📖 读取到 {len(df)} 条原始数据")
-    except Exception as e:
-        print(f"❌ 读取数据失败: {e}")
-        return
-
-    # 初始化嵌入生成器
-    embeddings = SiliconFlowEmbeddings()
+class RateLimiter:
+    """按每分钟请求数均匀放行（线程安全）"""
 
-    # 分批重新生成嵌入向量
-    BATCH_SIZE = 20  # 减小批次大小避免API限制
-    total_batches = (len(df) + BATCH_SIZE - 1) // BATCH_SIZE
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
 
-    new_embeddings = []
-    success_count = 0
-    failed_count = 0
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
 
-    print(f"🔄 分 {total_batches} 批重新生成嵌入向量...")
 
-    for batch_idx in range(total_batches):
-        start_idx = batch_idx * BATCH_SIZE
-        end_idx = min((batch_idx + 1) * BATCH_SIZE, len(df))
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
 
-        batch_texts = []
-        batch_indices = []
 
-        # 准备批次数据
-        for i in range(start_idx, end_idx):
+def load_checkpoint(checkpoint_file):
+    """读取检查点：{文本哈希: 嵌入字符串}；崩溃时写了一半的最后一行直接忽略"""
+    done = {}
+    if not os.path.exists(checkpoint_file):
+        return done
+    with open(checkpoint_file, "r", encoding="utf-8") as f:
+        for line in f:
             try:
-                text = str(df.iloc[i]["text"]).strip()
-                if text and len(text) > 10:  # 确保文本有效
-                    batch_texts.append(text)
-                    batch_indices.append(i)
-            except:
+                record = json.loads(line)
+                done[record["hash"]] = record["embedding"]
+            except (json.JSONDecodeError, KeyError):
                 continue
+    return done
 
-        if not batch_texts:
-            continue
 
-        print(f"处理批次 {batch_idx + 1}/{total_batches} ({len(batch_texts)}条文本)...")
+def _embed_batch(embeddings, texts):
+    """请求一批文本的嵌入向量，失败时抛出异常（不使用随机向量降级，失败批次留待下次重跑）"""
+    if not isinstance(embeddings, SiliconFlowEmbeddings):
+        return embeddings.embed_documents(texts)
 
-        # 生成嵌入向量
-        try:
-            batch_embeddings = embeddings.embed_documents(batch_texts)
-
-            for idx, embedding in zip(batch_indices, batch_embeddings):
-                if len(embedding) == 1024:
-                    # 将嵌入向量转换为字符串存储
-                    embedding_str = ",".join(map(str, embedding))
-                    new_embeddings.append((idx, embedding_str))
-                    success_count += 1
-                else:
-                    failed_count += 1
+    data = {"model": embeddings.model_name, "input": texts, "encoding_format": "float"}
+    response = embeddings._post(data, Config.HTTP_BATCH_READ_TIMEOUT)
+    response.raise_for_status()
+    result = response.json()
+    return [item["embedding"] for item in sorted(result["data"], key=lambda item: item.get("index", 0))]
 
-            print(f"✅ 批次 {batch_idx + 1} 完成")
 
-        except Exception as e:
-            print(f"❌ 批次 {batch_idx + 1} 失败: {e}")
-            failed_count += len(batch_texts)
+def regenerate_book_embeddings(input_file="book_embeddings.csv", output_file="book_embeddings_renewed.csv",
+                               checkpoint_file=None, batch_size=Config.REGEN_BATCH_SIZE,
+                               concurrency=Config.REGEN_CONCURRENCY,
+                               requests_per_minute=Config.REGEN_REQUESTS_PER_MINUTE, max_retries=3):
+    """重新生成书籍嵌入向量（可断点续跑）
+
+    每批结果一返回就追加写入检查点文件（JSON lines，按文本内容哈希记录），重启后跳过
+    已完成的文本；内容相同的文本只请求一次。多个批次在速率限制内并发请求。
+    全部完成后再由检查点生成输出 CSV。返回 (输出文件, 仍缺新向量的行数)，读取失败时返回 (None, 0)。
+    """
+    print("🔄 开始重新生成书籍嵌入向量...")
+    checkpoint_file = checkpoint_file or output_file + ".checkpoint.jsonl"
 
-        # 避免API限制
-        time.sleep(2)
+    # 读取原始数据
+    try:
+        df = pd.read_csv(input_file, encoding="utf-8-sig")
+        print(f"📖 读取到 {len(df)} 条原始数据")
+    except Exception as e:
+        print(f"❌ 读取数据失败: {e}")
+        return None, 0
+
+    done = load_checkpoint(checkpoint_file)
+    if done:
+        print(f"📌 从检查点恢复: 已完成 {len(done)} 条不同文本 ({checkpoint_file})")
+
+    # 收集待处理文本：按内容哈希去重，跳过检查点中已有的
+    row_hashes = {}
+    pending = {}
+    for i, text in enumerate(df["text"] if "text" in df.columns else []):
+        text = str(text).strip()
+        if not text or len(text) <= 10:  # 确保文本有效
+            continue
+        digest = text_hash(text)
+        row_hashes[i] = digest
+        if digest not in done:
+            pending.setdefault(digest, text)
+
+    items = list(pending.items())
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    print(f"🔄 待处理 {len(items)} 条不同文本，分 {len(batches)} 批，并发 {concurrency}，"
+          f"限速 {requests_per_minute} 次/分钟...")
+
+    embeddings = create_embeddings()
+    limiter = RateLimiter(requests_per_minute)
+    write_lock = threading.Lock()
+    counts = {"success": 0, "failed": 0, "batches_done": 0}
+
+    def run_batch(batch):
+        texts = [text for _, text in batch]
+        for attempt in range(max_retries):
+            limiter.acquire()
+            try:
+                vectors = _embed_batch(embeddings, texts)
+                break
+            except Exception as e:
+                print(f"⚠️ 批次请求失败 (第 {attempt + 1} 次): {e}")
+                time.sleep(2 ** attempt)
+        else:
+            with write_lock:
+                counts["failed"] += len(batch)
+            return
+
+        lines = []
+        for (digest, _), embedding in zip(batch, vectors):
+            if len(embedding) == 1024:
+                lines.append(json.dumps({"hash": digest, "embedding": ",".join(map(str, embedding))}) + "\n")
+
+        # 立即追加写盘，崩溃最多丢失正在进行中的批次
+        with write_lock:
+            with open(checkpoint_file, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            counts["success"] += len(lines)
+            counts["failed"] += len(batch) - len(lines)
+            counts["batches_done"] += 1
+            if counts["batches_done"] % 10 == 0 or counts["batches_done"] == len(batches):
+                print(f"✅ 已完成 {counts['batches_done']}/{len(batches)} 批")
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for future in [executor.submit(run_batch, batch) for batch in batches]:
+            future.result()
 
     print(f"\n📊 重新生成完成:")
-    print(f"   - 成功: {success_count}条")
-    print(f"   - 失败: {failed_count}条")
-
-    # 更新DataFrame
-    if success_count > 0:
-        # 创建新的嵌入向量列
-        embedding_dict = {idx: emb for idx, emb in new_embeddings}
-        df['new_embedding'] = df.index.map(embedding_dict)
-
-        # 保存新的数据文件
-        output_file = "book_embeddings_renewed.csv"
-        df.to_csv(output_file, index=False, encoding="utf-8-sig")
-        print(f"💾 新的嵌入文件已保存: {output_file}")
-
-        return output_file
-    else:
+    print(f"   - 成功: {counts['success']}条")
+    print(f"   - 失败: {counts['failed']}条" + ("（重新运行即可只补跑失败的部分）" if counts["failed"] else ""))
+
+    # 由检查点生成输出文件
+    done = load_checkpoint(checkpoint_file)
+    if not done:
         print("❌ 没有成功生成任何嵌入向量")
-        return None
+        return None, 0
+
+    df['new_embedding'] = [done.get(row_hashes.get(i)) for i in range(len(df))]
+    # 包括本次失败和此前运行遗留、仍未补齐的行
+    missing = sum(1 for digest in row_hashes.values() if digest not in done)
+    tmp_file = output_file + ".tmp"
+    df.to_csv(tmp_file, index=False, encoding="utf-8-sig")
+    os.replace(tmp_file, output_file)
+    print(f"💾 新的嵌入文件已保存: {output_file}（{df['new_embedding'].notna().sum()}/{len(df)} 行有新向量）")
+    if missing:
+        print(f"⚠️ {missing} 行有效文本仍缺少新向量")
+
+    return output_file, missing
 
 
 def test_new_embeddings(file_path):
@@ -126,8 +194,8 @@ def test_new_embeddings(file_path):
         print(f"❌ 测试失败: {e}")
 
 
-def create_faiss_with_new_embeddings(file_path):
-    """使用新嵌入向量创建FAISS索引"""
+def create_faiss_with_new_embeddings(file_path, activate=True):
+    """使用新嵌入向量创建FAISS索引并保存为新版本；activate 为 False 时不切换 CURRENT"""
     print(f"\n🔧 使用新嵌入向量创建FAISS索引...")
 
     try:
@@ -174,6 +242,8 @@ def create_faiss_with_new_embeddings(file_path):
         if success_count == 0:
             raise Exception("没有有效的记录")
 
+        texts, metadatas, embeddings_list = dedup_for_index(texts, metadatas, embeddings_list)
+
         # 创建FAISS索引
         embeddings = SiliconFlowEmbeddings()
         from langchain_community.vectorstores import FAISS
@@ -185,16 +255,16 @@ def create_faiss_with_new_embeddings(file_path):
             metadatas=metadatas
         )
 
-        # 保存索引
-        new_index_path = "./faiss_renewed_index"
-        vectorstore.save_local(new_index_path)
-        print(f"💾 新FAISS索引已保存到: {new_index_path}")
+        # 保存为新的索引版本；激活时切换 CURRENT，运行中的应用会自动热切换
+        from index_versions import publish_version
+        version, new_index_path = publish_version(vectorstore, Config.INDEX_VERSIONS_DIR, activate=activate)
+        print(f"💾 新FAISS索引已保存为版本 {version}: {new_index_path}" + ("" if activate else "（未激活）"))
 
-        return new_index_path, vectorstore
+        return version, new_index_path, vectorstore
 
     except Exception as e:
         print(f"❌ 创建FAISS索引失败: {e}")
-        return None, None
+        return None, None, None
 
 
 def test_search_accuracy(vectorstore):
@@ -236,9 +306,21 @@ def main():
     print("🔄 书籍嵌入向量重新生成工具")
     print("=" * 60)
 
+    parser = argparse.ArgumentParser(description="书籍嵌入向量重新生成（可断点续跑）")
+    parser.add_argument("--input", default="book_embeddings.csv")
+    parser.add_argument("--output", default="book_embeddings_renewed.csv")
+    parser.add_argument("--checkpoint", default=None, help="检查点文件，默认 <output>.checkpoint.jsonl")
+    parser.add_argument("--batch-size", type=int, default=Config.REGEN_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=Config.REGEN_CONCURRENCY)
+    parser.add_argument("--rpm", type=int, default=Config.REGEN_REQUESTS_PER_MINUTE, help="每分钟最多请求数")
+    parser.add_argument("--activate-partial", action="store_true",
+                        help="有文本未能生成新向量时仍激活新索引版本（默认只发布、不切换 CURRENT）")
+    args = parser.parse_args()
+
     # 步骤1: 重新生成嵌入向量
     print("\n1. 重新生成嵌入向量")
-    new_file = regenerate_book_embeddings()
+    new_file, missing = regenerate_book_embeddings(args.input, args.output, args.checkpoint,
+                                          args.batch_size, args.concurrency, args.rpm)
 
     if not new_file:
         print("❌ 重新生成失败，退出程序")
@@ -250,7 +332,9 @@ def main():
 
     # 步骤3: 创建新的FAISS索引
     print("\n3. 创建新的FAISS索引")
-    new_index_path, vectorstore = create_faiss_with_new_embeddings(new_file)
+    # 有失败时新索引缺少部分书籍，默认不自动上线
+    activate = missing == 0 or args.activate_partial
+    version, new_index_path, vectorstore = create_faiss_with_new_embeddings(new_file, activate=activate)
 
     if vectorstore:
         # 步骤4: 测试搜索准确性
@@ -260,9 +344,12 @@ def main():
         print(f"\n🎉 重新生成完成!")
         print(f"   新数据文件: {new_file}")
         print(f"   新索引路径: {new_index_path}")
-        print(f"\n💡 请更新 config.py 中的路径配置:")
-        print(f"   FAISS_INDEX_PATH = '{new_index_path}'")
-        print(f"   BOOKS_DATA_PATH = '{new_file}'")
+        if activate:
+            print(f"\n💡 CURRENT 已指向新版本，运行中的应用将在 {Config.INDEX_WATCH_INTERVAL:.0f} 秒内自动切换")
+            print(f"   回滚: python index_versions.py use <旧版本名>")
+        else:
+            print(f"\n⚠️ {missing} 行缺少新向量，新版本未激活，CURRENT 保持不变")
+            print(f"   重新运行可只补跑失败的部分；确认后手动激活: python index_versions.py use {version}")
 
 
 if __name__ == "__main__":
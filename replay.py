@@ -0,0 +1,187 @@
+# replay.py
+"""
+查询日志重放
+
+按 query_log.py 记录的时间间隔重新发出查询（开环：不等上一条返回），可整体加速/减速，
+或忽略原始节奏以固定 QPS 发送；目标可以是进程内的 MultiAgentOrchestrator，
+也可以是 api_server.py 的 /query 或 /search 接口。报告吞吐量、延迟分位数、发送滞后和最慢的查询。
+
+示例:
+    python replay.py query_log.jsonl --fake --speed 2                        # 两倍原始 QPS，替身后端
+    python replay.py query_log.jsonl --target http --url http://127.0.0.1:8000 --mode search --qps 50
+"""
+import argparse
+import contextlib
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from config import Config
+from metrics import latency_summary
+
+
+def load_log(path, limit=0, include_followups=False):
+    """读取查询日志，返回 [(相对时间, 查询, 会话, 分馆)]，按时间排序"""
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(record, dict) or not record.get("query"):
+                continue
+            if record.get("followup") and not include_followups:
+                continue
+            entries.append((float(record.get("ts", 0.0)), record["query"], record.get("session", "replay"),
+                            record.get("library")))
+
+    entries.sort(key=lambda entry: entry[0])
+    if limit:
+        entries = entries[:limit]
+    if not entries:
+        return []
+    start = entries[0][0]
+    return [(ts - start, query, session, library) for ts, query, session, library in entries]
+
+
+def schedule(entries, speed=1.0, qps=0.0):
+    """每条查询的发送时间（秒，相对开始）：固定 QPS 时均匀分布，否则按原始间隔除以 speed"""
+    if qps > 0:
+        return [index / qps for index in range(len(entries))]
+    return [entry[0] / speed for entry in entries]
+
+
+def orchestrator_target(args):
+    if args.fake:
+        Config.BACKEND_MODE = "fake"
+    Config.QUERY_LOG_PATH = None  # 重放的查询不再写回日志
+    Config.WARMUP_ENABLED = args.warmup
+    from orchestrator import MultiAgentOrchestrator
+
+    orchestrator = MultiAgentOrchestrator()
+    if orchestrator.warmer is not None:
+        orchestrator.warmer.wait()
+
+    def send(query, session, library):
+        result = orchestrator.process_user_query(query, f"replay-{session}", library)
+        return result.get("error")
+    return send
+
+
+def http_target(args):
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+    url = f"{args.url.rstrip('/')}/{args.mode}"
+
+    def send(query, replay_session, library):
+        body = {"query": query} if args.mode == "search" else {"query": query, "session_id": f"replay-{replay_session}"}
+        if library:
+            body["library"] = library
+        response = session.post(url, json=body, timeout=args.timeout)
+        return None if response.status_code == 200 else f"HTTP {response.status_code}"
+    return send
+
+
+def replay(entries, send_times, send, concurrency):
+    """按计划时间发送，返回 (记录列表, 总耗时)"""
+    records = []
+    lock = threading.Lock()
+
+    def run(query, session, library, planned, start):
+        lag = time.perf_counter() - start - planned
+        begin = time.perf_counter()
+        try:
+            error = send(query, session, library)
+        except Exception as e:
+            error = str(e)
+        latency = time.perf_counter() - begin
+        with lock:
+            records.append({"query": query, "latency": latency, "lag": max(0.0, lag), "error": error})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay") as executor:
+        for (_, query, session, library), planned in zip(entries, send_times):
+            delay = planned - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, query, session, library, planned, start)
+    return records, time.perf_counter() - start
+
+
+def build_report(records, wall_time, send_times):
+    errors = [record for record in records if record["error"]]
+    planned_duration = send_times[-1] if send_times else 0.0
+    slowest = sorted(records, key=lambda record: record["latency"], reverse=True)[:5]
+    return {
+        "requests": len(records),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(records) if records else 0.0,
+        "wall_time_s": wall_time,
+        "offered_qps": len(send_times) / planned_duration if planned_duration > 0 else 0.0,
+        "throughput_rps": len(records) / wall_time if wall_time > 0 else 0.0,
+        "latency": latency_summary([record["latency"] for record in records]),
+        "send_lag": latency_summary([record["lag"] for record in records]),
+        "slowest": [{"query": record["query"], "latency_ms": record["latency"] * 1000} for record in slowest]
+    }
+
+
+def print_report(report):
+    latency, lag = report["latency"], report["send_lag"]
+    print("=" * 60)
+    print(f"📼 重放结果: {report['requests']} 个请求, 错误 {report['errors']} ({report['error_rate']:.1%})")
+    print("=" * 60)
+    print(f"计划 QPS: {report['offered_qps']:.2f}   实际吞吐: {report['throughput_rps']:.2f} 请求/秒   "
+          f"总耗时: {report['wall_time_s']:.2f}秒")
+    print(f"延迟: p50 {latency['p50_ms']:.1f}ms  p95 {latency['p95_ms']:.1f}ms  "
+          f"p99 {latency['p99_ms']:.1f}ms  max {latency['max_ms']:.1f}ms")
+    print(f"发送滞后: p95 {lag['p95_ms']:.1f}ms  max {lag['max_ms']:.1f}ms（滞后大说明 --concurrency 不足）")
+    print("最慢的查询:")
+    for item in report["slowest"]:
+        print(f"   {item['latency_ms']:>10.1f}ms  {item['query']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查询日志重放")
+    parser.add_argument("log", help="query_log.py 写出的 JSON lines 文件")
+    parser.add_argument("--target", choices=["orchestrator", "http"], default="orchestrator")
+    parser.add_argument("--url", default=f"http://{Config.API_HOST}:{Config.API_PORT}")
+    parser.add_argument("--mode", choices=["query", "search"], default="query", help="http 目标的接口")
+    parser.add_argument("--speed", type=float, default=1.0, help="原始节奏的加速倍数，2 表示两倍 QPS")
+    parser.add_argument("--qps", type=float, default=0.0, help="忽略原始节奏，以固定 QPS 发送")
+    parser.add_argument("--concurrency", type=int, default=32, help="同时进行的请求上限")
+    parser.add_argument("--limit", type=int, default=0, help="只重放前 N 条")
+    parser.add_argument("--include-followups", action="store_true", help="同时重放追问（依赖原会话状态，默认跳过）")
+    parser.add_argument("--timeout", type=float, default=60.0, help="http 请求超时（秒）")
+    parser.add_argument("--fake", action="store_true", help="orchestrator 目标使用替身后端")
+    parser.add_argument("--warmup", action="store_true", help="重放前完成启动预热")
+    parser.add_argument("--verbose", action="store_true", help="显示协调器的逐请求日志")
+    parser.add_argument("--output", default=None, help="结果 JSON 路径")
+    args = parser.parse_args()
+
+    entries = load_log(args.log, args.limit, args.include_followups)
+    if not entries:
+        print("❌ 日志中没有可重放的查询")
+        return
+    send_times = schedule(entries, args.speed, args.qps)
+
+    send = orchestrator_target(args) if args.target == "orchestrator" else http_target(args)
+    print(f"🚀 开始重放: {len(entries)} 条查询, 计划时长 {send_times[-1]:.1f}秒")
+    log_sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with log_sink:
+        records, wall_time = replay(entries, send_times, send, args.concurrency)
+
+    report = build_report(records, wall_time, send_times)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# sharding.py
+"""
+分片检索：按 book_id 哈希切分索引，协调器并发查询各分片并合并 top-k
+
+    分片索引    同一本书的全部文本块落在同一分片，每个分片是一个独立的 LangChain FAISS 索引
+    分片服务    每个进程/主机加载一个分片，通过 HTTP 提供 POST /search
+    协调器      LibraryTools 中的 ShardCoordinator 把查询向量同时发给所有分片，在期限内
+                合并已返回的结果；超时或出错的分片被跳过，结果标记为不完整（不进入检索缓存）
+
+分片默认只返回 id、距离和文档；候选向量按需请求（with_vectors），与查询向量一样以
+base64 编码的 float32 字节传输，避免 1024 维浮点数列表的 JSON 开销。
+
+测试时可用 LocalShardClient 在进程内模拟分片服务，并注入延迟和错误。
+
+示例:
+    python sharding.py build --shards 4 --output ./faiss_shards
+    python sharding.py serve --shard-dir ./faiss_shards/shard_0 --port 9100
+"""
+import argparse
+import base64
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+from tracing import span
+
+SHARDS_META_FILE = "shards.json"
+
+
+def encode_vector(vector):
+    """向量编码为 base64 的小端 float32 字节"""
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+def decode_vector(data):
+    return np.frombuffer(base64.b64decode(data), dtype="<f4").astype(np.float32)
+
+
+def shard_of(book_id, num_shards):
+    """book_id 所属分片（crc32，跨进程、跨主机稳定）"""
+    return zlib.crc32(str(book_id).encode("utf-8")) % num_shards
+
+
+def partition_vectorstore(vectorstore, embeddings, num_shards):
+    """把一个 FAISS 索引按 book_id 切分为 num_shards 个索引，向量直接取回，不重新嵌入"""
+    from langchain_community.vectorstores import FAISS
+
+    index = vectorstore.index
+    vectors = index.reconstruct_n(0, index.ntotal)
+    parts = [([], [], []) for _ in range(num_shards)]
+    for idx in range(index.ntotal):
+        doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[idx])
+        texts, metadatas, shard_vectors = parts[shard_of(doc.metadata.get("book_id", idx), num_shards)]
+        texts.append(doc.page_content)
+        metadatas.append(doc.metadata)
+        shard_vectors.append(vectors[idx])
+
+    shards = []
+    for shard_id, (texts, metadatas, shard_vectors) in enumerate(parts):
+        if not texts:
+            raise ValueError(f"分片 {shard_id} 为空，请减少分片数")
+        shards.append(FAISS.from_embeddings(list(zip(texts, shard_vectors)), embeddings, metadatas=metadatas))
+    return shards
+
+
+def build_shards(vectorstore, embeddings, num_shards, output_dir, source_version=None):
+    """切分并保存到 output_dir/shard_<i>，返回各分片条数
+
+    先写入临时目录再整体替换 output_dir，shards.json 记录源索引版本、条数和分片数。
+    """
+    shards = partition_vectorstore(vectorstore, embeddings, num_shards)
+    tmp_dir = output_dir.rstrip("/\\") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    sizes = []
+    for shard_id, shard in enumerate(shards):
+        shard.save_local(os.path.join(tmp_dir, f"shard_{shard_id}"))
+        sizes.append(int(shard.index.ntotal))
+    with open(os.path.join(tmp_dir, SHARDS_META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"num_shards": num_shards, "sizes": sizes, "source_version": source_version,
+                   "source_ntotal": int(vectorstore.index.ntotal)}, f)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    return sizes
+
+
+def stale_shards_reason(output_dir, vectorstore, num_shards, source_version=None):
+    """已有分片与源索引不一致的原因，一致时返回 None"""
+    meta_path = os.path.join(output_dir, SHARDS_META_FILE)
+    if not os.path.exists(meta_path):
+        return "尚未生成分片"
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("num_shards") != num_shards:
+        return f"分片数 {meta.get('num_shards')} != {num_shards}"
+    if meta.get("source_version") != source_version:
+        return f"源索引版本 {meta.get('source_version')} != {source_version}"
+    if meta.get("source_ntotal") != int(vectorstore.index.ntotal):
+        return f"源索引条数 {meta.get('source_ntotal')} != {vectorstore.index.ntotal}"
+    return None
+
+
+def load_shards(output_dir, embeddings):
+    from langchain_community.vectorstores import FAISS
+
+    with open(os.path.join(output_dir, SHARDS_META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    return [FAISS.load_local(os.path.join(output_dir, f"shard_{shard_id}"), embeddings,
+                             allow_dangerous_deserialization=True)
+            for shard_id in range(meta["num_shards"])]
+
+
+class ShardWorker:
+    """单个分片的检索：返回可 JSON 序列化的结果，with_vectors 时附带编码后的候选向量"""
+
+    def __init__(self, vectorstore, shard_id=0):
+        self.vectorstore = vectorstore
+        self.shard_id = shard_id
+
+    def search(self, vector, k, with_vectors=False):
+        index = self.vectorstore.index
+        distances, ids = index.search(np.asarray([vector], dtype=np.float32), min(k, index.ntotal))
+        valid = [(float(distance), int(idx)) for distance, idx in zip(distances[0], ids[0]) if idx >= 0]
+
+        results = []
+        for distance, idx in valid:
+            doc = self.vectorstore.docstore.search(self.vectorstore.index_to_docstore_id[idx])
+            results.append({
+                "shard": self.shard_id,
+                "id": idx,
+                "distance": distance,
+                "page_content": doc.page_content,
+                "metadata": doc.metadata
+            })
+        if with_vectors and valid:
+            vectors = index.reconstruct_batch(np.array([idx for _, idx in valid], dtype=np.int64))
+            for result, stored in zip(results, vectors):
+                result["vector"] = encode_vector(stored)
+        return results
+
+
+class LocalShardClient:
+    """进程内的分片服务替身，可注入延迟和错误，用于测试协调器的容错"""
+
+    def __init__(self, worker, latency=0.0, jitter=0.0, error_rate=0.0, seed=42):
+        from fake_backends import _FaultInjector
+
+        self.worker = worker
+        self.name = f"local:{worker.shard_id}"
+        self.faults = _FaultInjector(latency, jitter, error_rate, seed + worker.shard_id)
+
+    def search(self, vector, k, with_vectors=False):
+        self.faults.delay_and_maybe_fail(f"分片{self.worker.shard_id}检索")
+        return self.worker.search(vector, k, with_vectors)
+
+
+class HttpShardClient:
+    """远程分片服务客户端（keep-alive 连接池）"""
+
+    def __init__(self, url, timeout=Config.SHARD_DEADLINE):
+        self.url = url.rstrip("/")
+        self.name = self.url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=Config.HTTP_POOL_SIZE))
+
+    def search(self, vector, k, with_vectors=False):
+        body = {"vector_b64": encode_vector(vector), "k": k, "with_vectors": with_vectors}
+        response = self.session.post(f"{self.url}/search", json=body,
+                                     timeout=(Config.HTTP_CONNECT_TIMEOUT, self.timeout))
+        response.raise_for_status()
+        return response.json()["results"]
+
+
+class ShardCoordinator:
+    """并发查询全部分片，合并 top-k；期限内未返回或出错的分片被跳过"""
+
+    def __init__(self, clients, deadline=0.5, max_workers=None):
+        self.clients = clients
+        self.deadline = deadline
+        # 超时的分片请求仍占用线程直到返回，线程数按分片数留出余量
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or 4 * len(clients), thread_name_prefix="shard")
+        self._lock = threading.Lock()
+        self._queries = 0
+        self._partial = 0
+        self._timeouts = Counter()
+        self._errors = Counter()
+
+    def search(self, vector, k, with_vectors=False):
+        """返回 (合并后的 top-k 结果, 缺失的分片名列表)；with_vectors 时结果带 base64 编码的候选向量"""
+        vector = np.asarray(vector, dtype=np.float32)
+        with span("shard.search", shards=len(self.clients), k=k) as s:
+            futures = {self._executor.submit(client.search, vector, k, with_vectors): client
+                       for client in self.clients}
+            done, not_done = wait(futures, timeout=self.deadline)
+
+            results, missing = [], []
+            for future, client in futures.items():
+                if future in not_done:
+                    future.cancel()
+                    missing.append(client.name)
+                    self._count(self._timeouts, client.name)
+                elif future.exception() is not None:
+                    missing.append(client.name)
+                    self._count(self._errors, client.name)
+                else:
+                    results.extend(future.result())
+
+            results.sort(key=lambda result: result["distance"])
+            with self._lock:
+                self._queries += 1
+                self._partial += bool(missing)
+            s.set(responded=len(self.clients) - len(missing), missing=len(missing))
+            return results[:k], missing
+
+    def _count(self, counter, name):
+        with self._lock:
+            counter[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "shards": [client.name for client in self.clients],
+                "deadline": self.deadline,
+                "queries": self._queries,
+                "partial_results": self._partial,
+                "timeouts": dict(self._timeouts),
+                "errors": dict(self._errors)
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_shard_coordinator(vectorstore, embeddings, source_version=None):
+    """按 Config.SHARD_MODE 创建协调器
+
+    local:  进程内分片（替身模式在内存中切分，否则加载 SHARD_INDEX_DIR；与源索引版本、
+            条数或 SHARD_COUNT 不一致时重新切分）
+    remote: 连接 SHARD_ENDPOINTS 中的分片服务
+    """
+    if Config.SHARD_MODE == "remote":
+        clients = [HttpShardClient(url) for url in Config.SHARD_ENDPOINTS]
+    elif Config.BACKEND_MODE == "fake":
+        shards = partition_vectorstore(vectorstore, embeddings, Config.SHARD_COUNT)
+        clients = [LocalShardClient(ShardWorker(shard, shard_id)) for shard_id, shard in enumerate(shards)]
+    else:
+        reason = stale_shards_reason(Config.SHARD_INDEX_DIR, vectorstore, Config.SHARD_COUNT, source_version)
+        if reason:
+            print(f"🔧 重新切分索引（{reason}）: {Config.SHARD_INDEX_DIR}")
+            build_shards(vectorstore, embeddings, Config.SHARD_COUNT, Config.SHARD_INDEX_DIR, source_version)
+        shards = load_shards(Config.SHARD_INDEX_DIR, embeddings)
+        clients = [LocalShardClient(ShardWorker(shard, shard_id)) for shard_id, shard in enumerate(shards)]
+    if not clients:
+        raise ValueError("没有可用的分片")
+    return ShardCoordinator(clients, Config.SHARD_DEADLINE)
+
+
+def serve_shard(worker, host="127.0.0.1", port=9100):
+    """启动分片服务（后台线程），返回 ThreadingHTTPServer"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, {"status": "ok", "shard": worker.shard_id, "ntotal": int(worker.vectorstore.index.ntotal)})
+            else:
+                self._send(404, {"error": f"未知路径: {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/search":
+                self._send(404, {"error": f"未知路径: {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                vector = decode_vector(body["vector_b64"]) if "vector_b64" in body else body["vector"]
+                results = worker.search(vector, int(body.get("k", 10)), bool(body.get("with_vectors")))
+                self._send(200, {"results": results})
+            except Exception as e:
+                self._send(400, {"error": str(e)})
+
+        def _send(self, status, payload):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name=f"shard-{worker.shard_id}").start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分片索引构建与分片服务")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="把现有索引按 book_id 切分")
+    build.add_argument("--shards", type=int, default=Config.SHARD_COUNT)
+    build.add_argument("--output", default=Config.SHARD_INDEX_DIR)
+
+    serve = subparsers.add_parser("serve", help="加载一个分片并提供 HTTP 检索")
+    serve.add_argument("--shard-dir", required=True)
+    serve.add_argument("--shard-id", type=int, default=0)
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    from langchain_community.vectorstores import FAISS
+    from config import LibraryTools, create_embeddings
+
+    if args.command == "build":
+        tools = LibraryTools()
+        sizes = build_shards(tools.vectorstore, tools.embeddings, args.shards, args.output,
+                             source_version=tools.index_stats()["version"])
+        print(f"💾 已切分为 {args.shards} 个分片: {sizes} -> {args.output}")
+        return
+
+    vectorstore = FAISS.load_local(args.shard_dir, create_embeddings(), allow_dangerous_deserialization=True)
+    server = serve_shard(ShardWorker(vectorstore, args.shard_id), args.host, args.port)
+    print(f"🚀 分片 {args.shard_id} ({vectorstore.index.ntotal} 条) 监听 http://{args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""API 服务集成测试：使用替身后端，不访问网络"""
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from config import Config
+
+
+@pytest.fixture(scope="module")
+def server():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(Config, "BACKEND_MODE", "fake")
+        mp.setattr(Config, "FAKE_CATALOG_SIZE", 300)
+        mp.setattr(Config, "LIBRARIES", {"east": {"fake_catalog_size": 100}})
+        from api_server import LibraryAPIServer
+
+        app = LibraryAPIServer(port=0, workers=2, queue_size=4).start()
+        yield app
+        app.shutdown()
+
+
+def _request(server, path, body=None):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(server.address + path, data=data,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def _block_workers(pool, fill_queue=False):
+    """用阻塞任务占满工作线程（可选同时占满队列），返回 (释放事件, 任务列表)"""
+    release = threading.Event()
+    blockers = [pool.submit(release.wait) for _ in range(pool.workers)]
+    deadline = time.monotonic() + 5
+    while pool.stats()["in_flight"] < pool.workers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    if fill_queue:
+        blockers += [pool.submit(release.wait) for _ in range(pool.queue_size)]
+    return release, blockers
+
+
+def _release(release, blockers):
+    release.set()
+    for future in blockers:
+        future.result(timeout=5)
+
+
+def test_query(server):
+    status, result = _request(server, "/query", {"query": "推荐几本巴金的小说", "session_id": "t1"})
+    assert status == 200
+    assert "巴金" in json.dumps(result["task_results"], ensure_ascii=False)
+    assert result["trace"]["spans"]
+
+
+def test_anonymous_queries_do_not_share_session(server):
+    assert _request(server, "/query", {"query": "推荐几本巴金的小说"})[0] == 200
+    status, result = _request(server, "/query", {"query": "再推荐几本"})
+    assert status == 200
+    assert not result.get("followup")
+
+
+def test_answer_cache_is_invalidated_by_index_swap(server):
+    from index_versions import IndexHandle
+
+    orchestrator = server.orchestrator
+    tools = orchestrator.library_agent.tools_manager
+    orchestrator.answer_cache.maxsize = 16
+    try:
+        first = _request(server, "/query", {"query": "老舍的小说"})[1]
+        second = _request(server, "/query", {"query": "老舍的小说"})[1]
+        assert not first.get("answer_cache_hit") and second.get("answer_cache_hit")
+
+        handle = tools._handle
+        tools.swap_index(IndexHandle("v-test", handle.vectorstore, handle.search_index, handle.path))
+        third = _request(server, "/query", {"query": "老舍的小说"})[1]
+        assert not third.get("answer_cache_hit")
+    finally:
+        orchestrator.answer_cache.maxsize = 0
+        orchestrator.answer_cache.clear()
+
+
+def test_search(server):
+    status, result = _request(server, "/search", {"query": "鲁迅", "k": 5})
+    assert status == 200
+    assert len(result["hits"]) == 5
+    assert result["hits"][0]["author"] == "鲁迅"
+
+
+def test_batch(server):
+    status, result = _request(server, "/batch", {"queries": ["老舍", "巴金", "郭沫若"], "mode": "search", "k": 3})
+    assert status == 200
+    assert [len(item["hits"]) for item in result["results"]] == [3, 3, 3]
+
+
+def test_bad_request(server):
+    assert _request(server, "/query", {"query": ""})[0] == 400
+    assert _request(server, "/batch", {"queries": ["巴金"], "mode": "unknown"})[0] == 400
+    assert _request(server, "/unknown", {})[0] == 404
+
+
+def test_invalid_k_and_timeout_are_rejected(server):
+    for k in (0, -1, "abc", None):
+        assert _request(server, "/search", {"query": "巴金", "k": k})[0] == 400
+    assert _request(server, "/batch", {"queries": ["巴金"], "k": "ten"})[0] == 400
+    for timeout in ("soon", 0, -5):
+        assert _request(server, "/query", {"query": "巴金", "timeout": timeout})[0] == 400
+        assert _request(server, "/search", {"query": "巴金", "timeout": timeout})[0] == 400
+
+
+def test_large_k_is_clamped(server):
+    status, result = _request(server, "/search", {"query": "巴金", "k": 10 ** 9})
+    assert status == 200
+    assert 0 < len(result["hits"]) <= Config.API_MAX_K
+
+
+def test_expired_query_skips_task_execution(server):
+    result = server.orchestrator.process_user_query("推荐几本巴金的小说", "expired",
+                                                    deadline=time.monotonic() - 1)
+    assert result["error"] == "请求处理超时"
+    assert result["task_results"] == [] and result["books"] == []
+    assert set(result["stage_times"]) <= {"intent_planning", "speculation_wait"}
+
+
+def test_overload_returns_503(server):
+    release, blockers = _block_workers(server.pool, fill_queue=True)
+    try:
+        status, _ = _request(server, "/search", {"query": "巴金"})
+        assert status == 503
+    finally:
+        _release(release, blockers)
+
+
+def test_deadline_returns_504(server):
+    release, blockers = _block_workers(server.pool)
+    try:
+        status, _ = _request(server, "/search", {"query": "巴金", "timeout": 0.1})
+        assert status == 504
+    finally:
+        _release(release, blockers)
+
+
+def test_metrics(server):
+    _request(server, "/search", {"query": "茅盾"})
+    status, metrics = _request(server, "/metrics")
+    assert status == 200
+    assert metrics["status"]["POST /search"]["200"] >= 1
+    assert metrics["pool"]["workers"] == 2
+    assert "retrieval" in metrics["caches"]
+
+
+def test_library(server):
+    assert _request(server, "/search", {"query": "巴金", "library": "nowhere"})[0] == 404
+    status, result = _request(server, "/search", {"query": "巴金", "k": 3, "library": "east"})
+    assert status == 200
+    assert len(result["hits"]) == 3
+    status, metrics = _request(server, "/metrics")
+    assert [library["name"] for library in metrics["libraries"]["loaded"]] == ["east"]
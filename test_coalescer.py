@@ -0,0 +1,99 @@
+"""查询嵌入微批合并测试：批次分发、批内去重和错误传递"""
+import threading
+
+import pytest
+
+from coalescer import EmbeddingCoalescer
+
+
+class _RecordingBatchFn:
+    """记录每次批量调用的输入；可选在调用中阻塞，便于让并发请求落入同一批次"""
+
+    def __init__(self, fail=None):
+        self.calls = []
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+        if self.fail is not None:
+            raise self.fail
+        return [f"vec:{text}" for text in texts]
+
+
+def _embed_concurrently(coalescer, texts):
+    """同时提交多条文本，返回 {下标: 结果或异常}"""
+    results = {}
+    barrier = threading.Barrier(len(texts))
+
+    def run(i, text):
+        barrier.wait()
+        try:
+            results[i] = coalescer.embed(text)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=item) for item in enumerate(texts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_single_request_passes_through():
+    batch_fn = _RecordingBatchFn()
+    coalescer = EmbeddingCoalescer(batch_fn, window=0.001)
+    assert coalescer.embed("巴金") == "vec:巴金"
+    assert batch_fn.calls == [["巴金"]]
+
+
+def test_concurrent_requests_fan_out_from_one_batch():
+    batch_fn = _RecordingBatchFn()
+    coalescer = EmbeddingCoalescer(batch_fn, window=0.5, max_batch=4)
+    texts = ["巴金", "老舍", "鲁迅", "茅盾"]
+    results = _embed_concurrently(coalescer, texts)
+
+    assert [results[i] for i in range(len(texts))] == [f"vec:{text}" for text in texts]
+    assert len(batch_fn.calls) == 1  # 凑满 max_batch 立即发送，不等窗口结束
+    assert sorted(batch_fn.calls[0]) == sorted(texts)
+    stats = coalescer.stats()
+    assert stats["requests"] == 4 and stats["batches"] == 1 and stats["batch_sizes"] == {4: 1}
+
+
+def test_duplicate_texts_are_requested_once():
+    batch_fn = _RecordingBatchFn()
+    coalescer = EmbeddingCoalescer(batch_fn, window=0.5, max_batch=4)
+    results = _embed_concurrently(coalescer, ["巴金", "巴金", "老舍", "巴金"])
+
+    assert len(batch_fn.calls) == 1
+    assert sorted(batch_fn.calls[0]) == ["巴金", "老舍"]
+    assert [results[i] for i in range(4)] == ["vec:巴金", "vec:巴金", "vec:老舍", "vec:巴金"]
+
+
+def test_error_is_delivered_to_every_waiter():
+    batch_fn = _RecordingBatchFn(fail=RuntimeError("接口超时"))
+    coalescer = EmbeddingCoalescer(batch_fn, window=0.5, max_batch=3)
+    results = _embed_concurrently(coalescer, ["巴金", "老舍", "鲁迅"])
+
+    assert len(batch_fn.calls) == 1
+    assert all(isinstance(result, RuntimeError) and str(result) == "接口超时" for result in results.values())
+    assert len(results) == 3
+
+
+def test_short_result_list_raises_for_whole_batch():
+    coalescer = EmbeddingCoalescer(lambda texts: ["only-one"], window=0.5, max_batch=2)
+    results = _embed_concurrently(coalescer, ["巴金", "老舍"])
+    assert all(isinstance(result, ValueError) for result in results.values())
+
+
+def test_batches_are_independent_after_dispatch():
+    batch_fn = _RecordingBatchFn()
+    coalescer = EmbeddingCoalescer(batch_fn, window=0.001)
+    assert coalescer.embed("巴金") == "vec:巴金"
+    assert coalescer.embed("老舍") == "vec:老舍"
+    assert batch_fn.calls == [["巴金"], ["老舍"]]
+
+    with pytest.raises(RuntimeError):
+        EmbeddingCoalescer(_RecordingBatchFn(fail=RuntimeError("x")), window=0.001).embed("巴金")
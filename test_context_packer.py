@@ -0,0 +1,28 @@
+"""上下文分词器加载测试：下载卡住时按期限返回并按字符数估算，加载完成后切换为精确计数"""
+import threading
+import time
+
+import context_packer
+
+
+def test_slow_tokenizer_load_falls_back_to_estimate(monkeypatch):
+    release = threading.Event()
+
+    def slow_load():
+        release.wait(5)
+        return (lambda text: 1), "test"
+
+    monkeypatch.setattr(context_packer, "_load_counter", slow_load)
+    monkeypatch.setattr(context_packer, "_loader", None)
+    monkeypatch.setattr(context_packer, "_counter", None)
+
+    started = time.perf_counter()
+    assert context_packer.load_tokenizer(timeout=0.1) is False
+    assert time.perf_counter() - started < 1
+    assert context_packer.tokens_estimated()
+    assert context_packer.count_tokens("巴金的家") == 4
+
+    release.set()
+    context_packer._loader.join(5)
+    assert not context_packer.tokens_estimated()
+    assert context_packer.count_tokens("巴金的家") == 1
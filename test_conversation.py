@@ -0,0 +1,124 @@
+"""多轮对话测试：追问识别和候选集上的筛选/排序/翻页"""
+import numpy as np
+from langchain_core.documents import Document
+
+from conversation import ConversationState, parse_refinement
+
+BOOKS = [
+    ("家", "巴金", "1933"), ("春", "巴金", "1938"), ("寒夜", "巴金", "1947"),
+    ("骆驼祥子", "老舍", "1939"), ("四世同堂", "老舍", "1950"), ("茶馆", "老舍", "1957"),
+    ("围城", "钱锺书", "1947"), ("边城", "沈从文", "1934"), ("平凡的世界", "路遥", "1986"),
+]
+
+
+def _candidates():
+    rng = np.random.default_rng(0)
+    candidates = []
+    for i, (title, author, year) in enumerate(BOOKS):
+        doc = Document(page_content=f"{title} {author}", metadata={"title": title, "author": author, "year": year})
+        candidates.append({"doc": doc, "index_id": i, "distance": i * 0.1, "score": 1.0 - i * 0.05,
+                           "vector": rng.normal(size=8).astype(np.float32)})
+    return candidates
+
+
+def _titles(page):
+    return [candidate["doc"].metadata["title"] for candidate in page]
+
+
+def test_plain_queries_are_not_followups():
+    assert parse_refinement("推荐几本巴金的小说", _candidates()) is None
+    assert parse_refinement("鲁迅的作品有哪些？", _candidates()) is None
+
+
+def test_explicit_signals_are_followups():
+    assert parse_refinement("再推荐几本")["more"]
+    refinement = parse_refinement("只要1949年以后的")
+    assert refinement["min_year"] == 1949 and refinement["focus"] == ""
+    assert parse_refinement("其中老舍的")["focus"] == "老舍"
+    assert parse_refinement("这些里面哪本最新")["sort"] == "desc"
+
+
+def test_conditions_without_focus_are_followups():
+    assert parse_refinement("1940年以前的")["max_year"] == 1940
+    assert parse_refinement("按年份排序")["sort"] == "asc"
+    refinement = parse_refinement("1930到1940年的")
+    assert (refinement["min_year"], refinement["max_year"]) == (1930, 1940)
+
+
+def test_condition_with_unrelated_focus_is_new_query():
+    candidates = _candidates()
+    assert parse_refinement("2020年后出版的科幻小说", candidates) is None
+    assert parse_refinement("最新的科幻小说", candidates) is None
+    assert parse_refinement("最新的科幻小说") is None  # 没有候选集时不当作追问
+
+
+def test_more_with_new_author_or_topic_is_new_query():
+    candidates = _candidates()
+    assert parse_refinement("再推荐几本鲁迅的书", candidates) is None
+    assert parse_refinement("有没有更多关于量子物理的书", candidates) is None
+    assert parse_refinement("鲁迅还有什么作品", candidates) is None
+    assert parse_refinement("只看科幻小说", candidates) is None
+
+
+def test_more_with_focus_in_pool_is_followup():
+    refinement = parse_refinement("再推荐几本老舍的", _candidates())
+    assert refinement["more"] and refinement["focus"] == "老舍"
+    # 明确指向上一轮结果时，不相符的关键词用于在候选集上重排
+    assert parse_refinement("其中写湘西", _candidates())["focus"] == "写湘西"
+    assert parse_refinement("这些里面哪本最新", _candidates())["focus"] == ""
+
+
+def test_condition_with_focus_in_pool_is_followup():
+    refinement = parse_refinement("1935年以后老舍的", _candidates())
+    assert refinement["min_year"] == 1935 and refinement["focus"] == "老舍"
+
+
+def test_reset_dedups_books_and_marks_shown():
+    state = ConversationState()
+    candidates = _candidates()
+    state.reset("现代文学", candidates + [dict(candidates[0], score=0.1)], shown_count=3)
+    assert len(state.candidates) == len(BOOKS)
+    assert state.candidates[0]["score"] == 1.0
+    assert len(state.shown) == 3
+
+
+def test_more_pages_skip_shown_books():
+    state = ConversationState()
+    state.reset("现代文学", _candidates(), shown_count=3)
+    first, _, total = state.refine(parse_refinement("再推荐几本"), page_size=3)
+    second, _, _ = state.refine(parse_refinement("更多"), page_size=3)
+    assert total == len(BOOKS)
+    assert _titles(first) == ["骆驼祥子", "四世同堂", "茶馆"]
+    assert _titles(second) == ["围城", "边城", "平凡的世界"]
+
+
+def test_year_filter_and_sort():
+    state = ConversationState()
+    state.reset("现代文学", _candidates())
+    page, filters, total = state.refine(parse_refinement("只要1945年以后的"), page_size=10)
+    assert total == 5
+    assert all(int(candidate["doc"].metadata["year"]) >= 1945 for candidate in page)
+
+    # 筛选条件在后续追问中保留
+    page, filters, _ = state.refine(parse_refinement("从新到旧"), page_size=10)
+    assert filters == {"min_year": 1945, "sort": "desc"}
+    assert _titles(page) == ["平凡的世界", "茶馆", "四世同堂", "寒夜", "围城"]
+
+
+def test_author_focus_filters_pool():
+    state = ConversationState()
+    state.reset("现代文学", _candidates())
+    page, _, total = state.refine(parse_refinement("其中巴金的"), page_size=10)
+    assert total == 3
+    assert {candidate["doc"].metadata["author"] for candidate in page} == {"巴金"}
+
+
+def test_unknown_focus_reranks_by_vector():
+    state = ConversationState()
+    candidates = _candidates()
+    state.reset("现代文学", candidates)
+    target = candidates[7]["vector"]  # 边城
+
+    page, _, total = state.refine(parse_refinement("其中写湘西"), page_size=1, embed_query=lambda text: target)
+    assert total == len(BOOKS)
+    assert _titles(page) == ["边城"]
@@ -0,0 +1,116 @@
+"""重复文本块检测测试：精确/近似重复分组、MinHash 估计和 book_ids 合并"""
+import numpy as np
+
+from dedup import MinHasher, _shingle_hashes, _shingles, deduplicate_chunks, find_duplicate_groups
+
+INTRO = "简介：一部描写封建大家庭由盛而衰的长篇小说，讲述了高家三兄弟在新旧思想冲突中的不同命运，是激流三部曲的第一部。"
+
+
+def _record(title, author, publisher, year):
+    return f"书名：{title} 作者：{author} 出版社：{publisher} 出版年：{year} {INTRO}"
+
+
+def _jaccard(a, b, size=3):
+    a, b = _shingles(a, size), _shingles(b, size)
+    return len(a & b) / len(a | b)
+
+
+def test_exact_duplicates_ignore_whitespace_and_case():
+    texts = ["Family  巴金", "family 巴金", "寒夜 巴金", " FAMILY 巴金 "]
+    canonical, stats = find_duplicate_groups(texts, threshold=1.0)
+    assert canonical == [0, 0, 2, 0]
+    assert stats == {"exact_duplicates": 2, "near_duplicate_merges": 0}
+
+
+def test_near_duplicates_are_grouped():
+    reprint = _record("家", "巴金", "人民文学出版社", "1981")
+    original = _record("家", "巴金", "人民文学出版社", "1953")
+    other = "书名：骆驼祥子 作者：老舍 出版社：人民文学出版社 出版年：1955 简介：北平人力车夫祥子三起三落的故事。"
+    assert _jaccard(original, reprint) >= 0.9 and _jaccard(original, other) < 0.3
+
+    canonical, stats = find_duplicate_groups([original, other, reprint], threshold=0.9)
+    assert canonical == [0, 1, 0]
+    assert stats == {"exact_duplicates": 0, "near_duplicate_merges": 1}
+
+    # 阈值 1.0 时只做精确去重
+    assert find_duplicate_groups([original, other, reprint], threshold=1.0)[0] == [0, 1, 2]
+
+
+def test_groups_are_transitive_and_rooted_at_first_chunk():
+    texts = [
+        _record("家", "巴金", "开明书店", "1933"),
+        _record("家", "巴金", "开明书店", "1937"),
+        _record("家", "巴金", "人民文学出版社", "1937"),
+    ]
+    # 首尾两块低于阈值，但经由中间一块连成同一组；更多、更窄的 LSH 分带保证候选对都能被找到
+    assert _jaccard(texts[0], texts[1]) >= 0.8 and _jaccard(texts[1], texts[2]) >= 0.8
+    assert _jaccard(texts[0], texts[2]) < 0.8
+    canonical, stats = find_duplicate_groups(texts, threshold=0.8, num_perm=128, bands=32)
+    assert canonical == [0, 0, 0]
+    assert stats["near_duplicate_merges"] == 2
+
+
+def test_dissimilar_bucket_anchor_does_not_hide_duplicates(monkeypatch):
+    import dedup
+
+    # 签名全相同时所有块落入同一批桶，桶首是一段不相关的文本
+    monkeypatch.setattr(dedup.MinHasher, "signature", lambda self, hashes: np.zeros(len(self.a), dtype=np.uint64))
+    other = "书名：骆驼祥子 作者：老舍 出版社：人民文学出版社 出版年：1955 简介：北平人力车夫祥子三起三落的故事。"
+    original = _record("家", "巴金", "人民文学出版社", "1953")
+    reprint = _record("家", "巴金", "人民文学出版社", "1981")
+
+    canonical, stats = find_duplicate_groups([other, original, reprint], threshold=0.9)
+    assert canonical == [0, 1, 1]
+    assert stats["near_duplicate_merges"] == 1
+
+
+def test_minhash_signature_estimates_jaccard():
+    hasher = MinHasher(num_perm=256, seed=7)
+    a = _shingles(_record("家", "巴金", "开明书店", "1933"), 3)
+    b = _shingles(_record("春", "巴金", "开明书店", "1938"), 3)
+    signature_a = hasher.signature(_shingle_hashes(a))
+    signature_b = hasher.signature(_shingle_hashes(b))
+
+    assert np.array_equal(signature_a, hasher.signature(_shingle_hashes(set(a))))
+    estimate = float(np.mean(signature_a == signature_b))
+    assert abs(estimate - len(a & b) / len(a | b)) < 0.1
+
+
+def test_deduplicate_chunks_merges_book_ids():
+    texts = [
+        _record("家", "巴金", "人民文学出版社", "1953"),
+        "骆驼祥子 老舍",
+        _record("家", "巴金", "人民文学出版社", "1981"),
+        _record("家", "巴金", "人民文学出版社", "1953"),
+        "骆驼祥子  老舍",
+    ]
+    metadatas = [
+        {"title": "家", "book_id": "b1"},
+        {"title": "骆驼祥子", "book_id": "b2"},
+        {"title": "家", "book_id": "b3"},
+        {"title": "家", "book_id": "b1"},  # 同一本书的重复文本块
+        {"title": "骆驼祥子"},               # 缺少 book_id
+    ]
+    embeddings = [np.full(4, i, dtype=np.float32) for i in range(len(texts))]
+
+    kept_texts, kept_metadatas, kept_embeddings, report = deduplicate_chunks(texts, metadatas, embeddings)
+
+    assert kept_texts == [texts[0], texts[1]]
+    assert [embedding[0] for embedding in kept_embeddings] == [0, 1]
+    assert kept_metadatas[0] == {"title": "家", "book_id": "b1", "book_ids": ["b1", "b3"], "duplicate_count": 3}
+    assert kept_metadatas[1]["book_ids"] == ["b2"] and kept_metadatas[1]["duplicate_count"] == 2
+    assert "book_ids" not in metadatas[0]  # 不修改输入的元数据
+
+    assert report["chunks_before"] == 5 and report["chunks_after"] == 2 and report["removed"] == 3
+    assert report["largest_group"] == 3
+    assert report["vector_bytes_saved"] == 3 * 4 * 4
+    assert report["exact_duplicates"] == 2 and report["near_duplicate_merges"] == 1
+
+
+def test_deduplicate_chunks_without_duplicates_is_identity():
+    texts = ["家 巴金", "春 巴金", "秋 巴金"]
+    metadatas = [{"book_id": str(i)} for i in range(3)]
+    kept_texts, kept_metadatas, _, report = deduplicate_chunks(texts, metadatas, [[0.0]] * 3)
+    assert kept_texts == texts
+    assert [metadata["book_ids"] for metadata in kept_metadatas] == [["0"], ["1"], ["2"]]
+    assert report["removed"] == 0 and report["shrink_ratio"] == 0.0
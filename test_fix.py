@@ -18,7 +18,7 @@ def test_vector_db():
     for query in test_queries:
         print(f"\n🔍 测试搜索: '{query}'")
         result = tools.search_knowledge_base(query)
-        print(f"结果: {result[:200]}...")
+        print(f"结果: {result.render()[:200]}...")
 
 
 def test_specific_books():
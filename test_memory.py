@@ -0,0 +1,78 @@
+"""会话记忆测试：环形缓冲区、压缩和会话 LRU 淘汰"""
+from memory import MemoryStore, SessionMemory
+
+
+def _entry(i):
+    return {"agent": "UserAgent", "message": f"消息{i}"}
+
+
+def test_ring_buffer_drops_oldest_without_compaction():
+    memory = SessionMemory(max_entries=3, compaction=False)
+    for i in range(5):
+        memory.append(_entry(i))
+    assert [entry["message"] for entry in memory.recent(10)] == ["消息2", "消息3", "消息4"]
+    assert memory.footprint()["evicted"] == 2
+    assert memory.footprint()["summaries"] == 0
+
+
+def test_recent_returns_latest_in_order():
+    memory = SessionMemory(max_entries=10)
+    for i in range(6):
+        memory.append(_entry(i))
+    assert [entry["message"] for entry in memory.recent(2)] == ["消息4", "消息5"]
+
+
+def test_compaction_summarizes_oldest_batch():
+    memory = SessionMemory(max_entries=4, compact_batch=2, max_summaries=5)
+    for i in range(5):
+        memory.append(_entry(i))
+    footprint = memory.footprint()
+    assert footprint["compactions"] == 1
+    assert footprint["entries"] == 3
+    assert [entry["message"] for entry in memory.recent(10)] == ["消息2", "消息3", "消息4"]
+    summary = memory.summaries[0]
+    assert summary["count"] == 2
+    assert "消息0" in summary["message"] and "消息1" in summary["message"]
+
+
+def test_summaries_are_bounded_and_count_evictions():
+    memory = SessionMemory(max_entries=2, compact_batch=2, max_summaries=1)
+    for i in range(7):
+        memory.append(_entry(i))
+    footprint = memory.footprint()
+    assert footprint["summaries"] == 1
+    assert footprint["compactions"] == 3
+    assert footprint["evicted"] == 4  # 被挤出的两条摘要各代表 2 条记忆
+
+
+def test_failing_summarizer_falls_back_to_default():
+    def broken(entries, max_chars):
+        raise RuntimeError("LLM 不可用")
+
+    memory = SessionMemory(max_entries=2, compact_batch=1, summarizer=broken)
+    for i in range(3):
+        memory.append(_entry(i))
+    assert memory.summaries[0]["message"].startswith("[已压缩 1 条]")
+
+
+def test_store_evicts_least_recently_used_session():
+    store = MemoryStore(max_sessions=2, max_entries=5)
+    store.session("a").append(_entry(0))
+    store.session("b").append(_entry(1))
+    store.session("a")  # a 变为最近使用
+    store.session("c")
+    assert store.stats()["evicted_sessions"] == 1
+    assert store.session("a").recent(1)[0]["message"] == "消息0"
+    assert store.session("b").recent(1) == []  # b 已被淘汰，重新创建为空会话
+
+
+def test_store_stats_aggregate_sessions():
+    store = MemoryStore(max_sessions=10, max_entries=5)
+    for session_id in ("a", "b"):
+        for i in range(3):
+            store.session(session_id).append(_entry(i))
+    stats = store.stats()
+    assert stats["sessions"] == 2
+    assert stats["entries"] == 6
+    store.drop("a")
+    assert store.stats()["sessions"] == 1
@@ -0,0 +1,124 @@
+"""分片检索测试：按 book_id 切分、合并 top-k 与单索引一致、慢/出错分片的容错和不完整结果不缓存"""
+import numpy as np
+import pytest
+
+from config import Config
+from fake_backends import FakeEmbeddings
+from sharding import LocalShardClient, ShardCoordinator, ShardWorker, partition_vectorstore, shard_of
+
+AUTHORS = ["巴金", "老舍", "鲁迅", "茅盾", "沈从文", "钱锺书", "路遥", "萧红"]
+
+
+def _vectorstore(embeddings, books=40, chunks=3):
+    """每本书 chunks 个文本块的小索引"""
+    from langchain_community.vectorstores import FAISS
+
+    texts, metadatas = [], []
+    for book_id in range(books):
+        author = AUTHORS[book_id % len(AUTHORS)]
+        for chunk in range(chunks):
+            texts.append(f"第{book_id}本 {author} 第{chunk}段 关于{author}的文学作品")
+            metadatas.append({"title": f"书{book_id}", "author": author, "book_id": str(book_id)})
+    vectors = [embeddings._embed(text) for text in texts]
+    return FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas)
+
+
+def _docs(vectorstore):
+    return [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in range(vectorstore.index.ntotal)]
+
+
+@pytest.fixture(scope="module")
+def embeddings():
+    return FakeEmbeddings(dimension=64)
+
+
+@pytest.fixture(scope="module")
+def flat(embeddings):
+    return _vectorstore(embeddings)
+
+
+@pytest.fixture(scope="module")
+def shards(flat, embeddings):
+    return partition_vectorstore(flat, embeddings, 4)
+
+
+def _coordinator(shards, deadline=1.0, faults=None):
+    """faults: {分片号: LocalShardClient 的延迟/错误参数}"""
+    faults = faults or {}
+    clients = [LocalShardClient(ShardWorker(shard, shard_id), **faults.get(shard_id, {}))
+               for shard_id, shard in enumerate(shards)]
+    return ShardCoordinator(clients, deadline)
+
+
+def test_partition_keeps_each_book_in_one_shard(flat, shards):
+    assert sum(shard.index.ntotal for shard in shards) == flat.index.ntotal
+    owners = {}
+    for shard_id, shard in enumerate(shards):
+        for doc in _docs(shard):
+            book_id = doc.metadata["book_id"]
+            assert shard_of(book_id, len(shards)) == shard_id
+            owners.setdefault(book_id, set()).add(shard_id)
+    assert all(len(shard_ids) == 1 for shard_ids in owners.values())
+    assert len(owners) == 40
+
+
+def test_merged_top_k_matches_flat_index(flat, shards, embeddings):
+    coordinator = _coordinator(shards)
+    for query in ["巴金", "老舍 第3本", "文学作品"]:
+        vector = embeddings.embed_query(query)
+        results, missing = coordinator.search(vector, 10)
+
+        distances, ids = flat.index.search(np.asarray([vector], dtype=np.float32), 10)
+        expected = [flat.docstore.search(flat.index_to_docstore_id[i]).page_content for i in ids[0]]
+        assert missing == []
+        assert [result["page_content"] for result in results] == expected
+        assert np.allclose([result["distance"] for result in results], distances[0], atol=1e-4)
+    coordinator.shutdown()
+
+
+def test_vectors_are_only_returned_on_request(shards, embeddings):
+    from sharding import decode_vector
+
+    coordinator = _coordinator(shards)
+    vector = embeddings.embed_query("鲁迅")
+    plain, _ = coordinator.search(vector, 5)
+    assert all("vector" not in result for result in plain)
+
+    full, _ = coordinator.search(vector, 5, with_vectors=True)
+    stored = shards[full[0]["shard"]].index.reconstruct(full[0]["id"])
+    assert np.array_equal(decode_vector(full[0]["vector"]), stored)
+    coordinator.shutdown()
+
+
+def test_slow_and_failing_shards_are_reported_missing(shards, embeddings):
+    coordinator = _coordinator(shards, deadline=0.2, faults={1: {"latency": 1.0}, 2: {"error_rate": 1.0}})
+    results, missing = coordinator.search(embeddings.embed_query("茅盾"), 10)
+
+    assert sorted(missing) == ["local:1", "local:2"]
+    assert {result["shard"] for result in results} <= {0, 3}
+    stats = coordinator.stats()
+    assert stats["timeouts"] == {"local:1": 1} and stats["errors"] == {"local:2": 1}
+    assert stats["queries"] == 1 and stats["partial_results"] == 1
+    coordinator.shutdown()
+
+
+def test_partial_results_are_not_cached(monkeypatch):
+    monkeypatch.setattr(Config, "BACKEND_MODE", "fake")
+    monkeypatch.setattr(Config, "FAKE_CATALOG_SIZE", 200)
+    monkeypatch.setattr(Config, "SHARD_MODE", "local")
+    monkeypatch.setattr(Config, "SHARD_COUNT", 3)
+    from config import LibraryTools
+
+    tools = LibraryTools()
+    coordinator = tools.shard_coordinator
+    healthy = coordinator.clients[0]
+    coordinator.clients[0] = LocalShardClient(healthy.worker, error_rate=1.0)
+
+    assert tools.retrieve("巴金", 10)
+    assert len(tools.retrieval_cache) == 0
+
+    coordinator.clients[0] = healthy
+    complete = tools.retrieve("巴金", 10)
+    assert len(tools.retrieval_cache) == 1
+    assert tools.retrieve("巴金", 10) is complete
+    coordinator.shutdown()
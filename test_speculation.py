@@ -0,0 +1,47 @@
+"""推测检索测试：只有结果确实进入检索缓存才计为命中，检索缓存关闭时不做推测"""
+import pytest
+
+from config import Config
+
+
+@pytest.fixture(scope="module")
+def orchestrator():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(Config, "BACKEND_MODE", "fake")
+        mp.setattr(Config, "FAKE_CATALOG_SIZE", 300)
+        mp.setattr(Config, "WARMUP_ENABLED", False)
+        from orchestrator import MultiAgentOrchestrator
+
+        yield MultiAgentOrchestrator()
+
+
+def _counts(orchestrator):
+    stats = orchestrator.speculation_stats()
+    return stats["attempts"], stats["hits"], stats["misses"]
+
+
+def test_cached_speculation_is_a_hit(orchestrator):
+    attempts, hits, misses = _counts(orchestrator)
+    result = orchestrator.process_user_query("推荐几本巴金的小说", session_id="speculation-hit")
+    assert result["speculation_hit"] is True
+    assert _counts(orchestrator) == (attempts + 1, hits + 1, misses)
+
+
+def test_uncached_result_is_a_miss(orchestrator, monkeypatch):
+    tools = orchestrator.library_agent.tools_manager
+    # 模拟分片缺失：返回不完整结果且不写入缓存
+    monkeypatch.setattr(tools, "retrieve", lambda query, k=None: [])
+    attempts, hits, misses = _counts(orchestrator)
+    result = orchestrator.process_user_query("推荐几本老舍的小说", session_id="speculation-partial")
+    assert result["speculation_hit"] is False
+    assert _counts(orchestrator) == (attempts + 1, hits, misses + 1)
+
+
+def test_no_speculation_without_retrieval_cache(orchestrator, monkeypatch):
+    tools = orchestrator.library_agent.tools_manager
+    monkeypatch.setattr(tools.retrieval_cache, "maxsize", 0)
+    before = _counts(orchestrator)
+    assert orchestrator._start_speculation("推荐几本茅盾的小说") is None
+    result = orchestrator.process_user_query("推荐几本茅盾的小说", session_id="speculation-off")
+    assert "error" not in result
+    assert _counts(orchestrator) == before
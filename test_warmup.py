@@ -0,0 +1,30 @@
+"""启动预热测试：预热写入的检索缓存条目能被实际查询命中"""
+import pytest
+
+from config import Config
+
+
+@pytest.fixture(scope="module")
+def orchestrator():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(Config, "BACKEND_MODE", "fake")
+        mp.setattr(Config, "FAKE_CATALOG_SIZE", 300)
+        mp.setattr(Config, "WARMUP_ENABLED", False)
+        from orchestrator import MultiAgentOrchestrator
+
+        yield MultiAgentOrchestrator()
+
+
+def test_warmed_examples_are_retrieval_cache_hits(orchestrator):
+    from warmup import CacheWarmer
+
+    tools = orchestrator.library_agent.tools_manager
+    warmer = CacheWarmer(orchestrator, Config.EXAMPLE_QUERIES)
+    warmer.run()
+    assert warmer.stats()["done"] == len(Config.EXAMPLE_QUERIES)
+
+    for i, query in enumerate(Config.EXAMPLE_QUERIES):
+        misses = tools.retrieval_cache.misses
+        result = orchestrator.process_user_query(query, session_id=f"warmup-test-{i}")
+        assert "error" not in result
+        assert tools.retrieval_cache.misses == misses, query
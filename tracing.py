@@ -0,0 +1,182 @@
+"""
+分阶段追踪
+
+每次用户查询对应一个 Trace，流水线各环节（意图理解、嵌入请求、FAISS 检索、工具、LLM 调用）
+记录为 Span，包含耗时、token 数和缓存命中等属性。
+
+当前 Trace/Span 保存在 contextvars 中，调用方无需逐层传参；提交到线程池的任务
+需要用 contextvars.copy_context().run(...) 才能继承当前 Trace。
+"""
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_export_lock = threading.Lock()
+
+
+class Span:
+    """一个计时区间"""
+
+    __slots__ = ("name", "span_id", "parent_id", "start", "duration", "attributes")
+
+    def __init__(self, name, parent_id=None, attributes=None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attributes = dict(attributes or {})
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, trace_start):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ms": (self.start - trace_start) * 1000,
+            "duration_ms": (self.duration or 0.0) * 1000,
+            "attributes": self.attributes
+        }
+
+
+class _NullSpan:
+    """没有活动 Trace 时使用的空 Span"""
+
+    def set(self, **attributes):
+        pass
+
+
+class Trace:
+    """一次查询的全部 Span"""
+
+    def __init__(self, name, attributes=None):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """按 Span 名称汇总耗时、token 数和缓存命中"""
+        stages = {}
+        totals = {"input_tokens": 0, "output_tokens": 0, "cache_hits": 0, "cache_misses": 0}
+
+        with self._lock:
+            spans = list(self.spans)
+
+        for span in spans:
+            stage = stages.setdefault(span.name, {"count": 0, "total_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += (span.duration or 0.0) * 1000
+
+            totals["input_tokens"] += span.attributes.get("input_tokens", 0) or 0
+            totals["output_tokens"] += span.attributes.get("output_tokens", 0) or 0
+            if "cache_hit" in span.attributes:
+                totals["cache_hits" if span.attributes["cache_hit"] else "cache_misses"] += 1
+
+        return {"stages": stages, **totals}
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration_ms": (self.duration or time.perf_counter() - self.start) * 1000,
+            "attributes": self.attributes,
+            "spans": [span.to_dict(self.start) for span in spans],
+            "summary": self.summary()
+        }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """开始一个 Trace，期间产生的 Span 都记录到其中"""
+    trace = Trace(name, attributes)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        trace.duration = time.perf_counter() - trace.start
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """记录一个 Span；没有活动 Trace 时不做任何记录"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NullSpan()
+        return
+
+    parent = _current_span.get()
+    current = Span(name, parent.span_id if parent else None, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.set(error=str(e))
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span.reset(token)
+        trace.add_span(current)
+
+
+def traced_invoke(llm, prompt, name="llm.invoke", **attributes):
+    """调用 llm.invoke 并记录耗时和 token 数，attributes 附加到 Span 上"""
+    with span(name, prompt_chars=len(prompt), **attributes) as s:
+        result = llm.invoke(prompt)
+
+        usage = getattr(result, "usage_metadata", None)
+        if usage:
+            s.set(input_tokens=usage.get("input_tokens", 0), output_tokens=usage.get("output_tokens", 0))
+        else:
+            token_usage = getattr(result, "response_metadata", {}).get("token_usage") or {}
+            s.set(input_tokens=token_usage.get("prompt_tokens", 0),
+                  output_tokens=token_usage.get("completion_tokens", 0))
+        return result
+
+
+def trace_to_jsonl(trace_dict):
+    """将 Trace 转为 JSON lines：每个 Span 一行，附带 trace_id 和查询信息"""
+    lines = []
+    for span_dict in trace_dict["spans"]:
+        record = {
+            "trace_id": trace_dict["trace_id"],
+            "trace_name": trace_dict["name"],
+            "timestamp": trace_dict["timestamp"],
+            **trace_dict["attributes"],
+            **span_dict
+        }
+        lines.append(json.dumps(record, ensure_ascii=False))
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def export_trace(trace_dict, path):
+    """以 JSON lines 格式追加写入 Trace"""
+    content = trace_to_jsonl(trace_dict)
+    with _export_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(content)
@@ -1,6 +1,6 @@
-from base_agent import BaseAgent
-from langchain_openai import ChatOpenAI
-from config import Config
+from base_agent import BaseAgent, DEFAULT_SESSION
+from config import create_llm
+from tracing import span, traced_invoke
 import json
 
 
@@ -9,13 +9,7 @@ class UserAgent(BaseAgent):
 
     def __init__(self):
         super().__init__("UserAgent", "用户意图理解与任务规划")
-        self.llm = ChatOpenAI(
-            api_key=Config.SILICONFLOW_API_KEY,
-            base_url=Config.SILICONFLOW_API_BASE,
-            model=Config.LLM_MODEL,
-            temperature=0.1,
-            max_tokens=800
-        )
+        self.llm = create_llm(max_tokens=800)
 
     def understand_intent(self, query: str) -> dict:
         """理解用户意图"""
@@ -42,12 +36,15 @@ class UserAgent(BaseAgent):
 请确保tasks数组至少包含一个任务。
 """
 
-        try:
-            response = self.llm.invoke(prompt)
-            return json.loads(response.content)
-        except:
-            # 如果LLM解析失败，使用基于规则的回退
-            return self._fallback_intent_understanding(query)
+        with span("user_agent.understand_intent") as s:
+            try:
+                response = traced_invoke(self.llm, prompt, "llm.intent")
+                s.set(fallback=False)
+                return json.loads(response.content)
+            except:
+                # 如果LLM解析失败，使用基于规则的回退
+                s.set(fallback=True)
+                return self._fallback_intent_understanding(query)
 
     def _fallback_intent_understanding(self, query: str) -> dict:
         """基于规则的回退意图理解"""
@@ -81,5 +78,6 @@ class UserAgent(BaseAgent):
 
     def process_query(self, query: str, context: dict = None) -> dict:
         """处理用户查询"""
-        self.remember(f"处理用户查询: {query}")
+        session_id = (context or {}).get("session_id", DEFAULT_SESSION)
+        self.remember(f"处理用户查询: {query}", session_id=session_id)
         return self.plan_tasks(query)
\ No newline at end of file
@@ -0,0 +1,136 @@
+# warmup.py
+"""
+启动预热
+
+MultiAgentOrchestrator 初始化后在后台线程中，对最常见的查询（配置的示例查询 +
+查询日志中出现次数最多的前 N 条）预先计算查询向量和检索候选集，填充查询嵌入缓存和检索缓存
+（检索词与服务时一样用 _extract_search_query 从查询中提取，保证缓存键和嵌入文本一致）；
+开启 WARMUP_ANSWERS 时还会完整运行一次流水线（调用 LLM），填充回答缓存。
+
+查询日志为 JSON lines，每行一个含 "query" 字段的对象（query_log.py 的查询日志）；TRACE_EXPORT_PATH 导出的 Trace
+（每个 Span 一行）也可以直接使用，同一 trace_id 只计一次。
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config, normalize_query
+
+WARMUP_SESSION_PREFIX = "__warmup__"
+
+
+def top_logged_queries(log_path, n, max_lines=200000):
+    """查询日志中出现次数最多的 n 条查询（按归一化结果合并，返回最常见的原始写法）"""
+    if not log_path or not os.path.exists(log_path) or n <= 0:
+        return []
+
+    counts = Counter()
+    spellings = {}
+    seen_traces = set()
+    with open(log_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            if line_number >= max_lines:
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            query = record.get("query") if isinstance(record, dict) else None
+            if not isinstance(query, str) or not query.strip():
+                continue
+            trace_id = record.get("trace_id")
+            if trace_id is not None:
+                if trace_id in seen_traces:
+                    continue
+                seen_traces.add(trace_id)
+
+            key = normalize_query(query)
+            counts[key] += 1
+            spellings.setdefault(key, Counter())[query.strip()] += 1
+
+    return [spellings[key].most_common(1)[0][0] for key, _ in counts.most_common(n)]
+
+
+def warmup_queries(log_path=None, examples=None, n=None):
+    """预热查询列表：示例查询在前，随后是日志中的高频查询，按归一化结果去重"""
+    n = Config.WARMUP_TOP_N if n is None else n
+    examples = Config.EXAMPLE_QUERIES if examples is None else examples
+    queries = {}
+    for query in list(examples) + top_logged_queries(log_path, n):
+        queries.setdefault(normalize_query(query), query)
+    return list(queries.values())
+
+
+class CacheWarmer:
+    """后台预热；失败的查询只计数，不影响服务"""
+
+    def __init__(self, orchestrator, queries, answers=False, workers=2):
+        self.orchestrator = orchestrator
+        self.queries = queries
+        self.answers = answers
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._counts = {"done": 0, "errors": 0}
+        self._started = None
+        self._finished = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True, name="cache-warmup")
+        self._thread.start()
+        return self
+
+    def run(self):
+        self._started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="warmup") as executor:
+            list(executor.map(self._warm, enumerate(self.queries)))
+        self._finished = time.perf_counter()
+        stats = self.stats()
+        print(f"🔥 预热完成: {stats['done']}/{len(self.queries)} 条查询, "
+              f"{stats['errors']} 条失败, 耗时 {stats['duration']:.2f}s")
+
+    def _warm(self, item):
+        index, query = item
+        try:
+            if self.answers:
+                # 每条查询使用独立会话，避免被当作上一条的追问；完成后移除该会话
+                session_id = f"{WARMUP_SESSION_PREFIX}{index}"
+                self.orchestrator.process_user_query(query, session_id)
+                with self.orchestrator._history_lock:
+                    self.orchestrator.conversation_history.pop(session_id, None)
+            else:
+                library_agent = self.orchestrator.library_agent
+                library_agent.tools_manager.retrieve(library_agent._extract_search_query(query))
+            key = "done"
+        except Exception:
+            key = "errors"
+        with self._lock:
+            self._counts[key] += 1
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        end = self._finished or time.perf_counter()
+        return {
+            "queries": len(self.queries),
+            "answers": self.answers,
+            "running": self._started is not None and self._finished is None,
+            "duration": end - self._started if self._started else 0.0,
+            **counts
+        }
+
+
+def start_warmup(orchestrator):
+    """按配置启动后台预热，没有可预热的查询时返回 None"""
+    queries = warmup_queries(Config.WARMUP_QUERY_LOG or Config.QUERY_LOG_PATH or Config.TRACE_EXPORT_PATH)
+    if not queries:
+        return None
+    print(f"🔥 后台预热 {len(queries)} 条常见查询" + ("（含完整回答）" if Config.WARMUP_ANSWERS else ""))
+    return CacheWarmer(orchestrator, queries, Config.WARMUP_ANSWERS, Config.WARMUP_WORKERS).start()